@@ -1,391 +1,1662 @@
 # app.py
+import time
+start_time = time.monotonic() # Startup report offsets are measured from here
 import os
-import io
 import base64
 import json
+import re
 import logging
 import threading
-import time # <--- Add time import
+import queue
+import collections
+import contextlib
+import math
+import random
+import bisect
+import mmap
+import struct
+import sqlite3
+import urllib.parse
+import types
+import asyncio
+import signal
+import subprocess
+import sys
 import cv2 # OpenCV for camera
 import numpy as np # For placeholder image
 from flask import Flask, render_template, request, jsonify, Response
 from dotenv import load_dotenv
-from PIL import Image # For image manipulation (cropping, format conversion)
 import atexit # For cleanup on exit
 import google.api_core.exceptions # <--- Import for specific exception handling
 
-start_time = time.monotonic() # <--- Define start time early
-print(f"[{time.monotonic() - start_time:.3f}s] Starting imports...")
+# --- Startup Timing ---
+class StartupReport:
+    """
+    Named startup steps with their offset from process start and their duration, in place of ad-hoc
+    "[x.xxxs]" prints. Background steps (the AI backend) are recorded when they finish. The report is
+    logged once the web server listens and served at /healthz.
+    """
+    def __init__(self, started_at):
+        self.started_at = started_at; self.ready_at = None
+        self._steps = []; self._lock = threading.Lock()
 
-# --- Conditionally import AI Libraries ---
-# Determine AI backend from environment variable
-AI_BACKEND_MODE = os.getenv("AI_BACKEND", "STUDIO").upper() # Default to STUDIO
+    def record(self, name, began, ended=None, **info):
+        ended = time.monotonic() if ended is None else ended
+        with self._lock:
+            self._steps.append({"step": name, "atMs": round((began - self.started_at) * 1000, 1), "durationMs": round((ended - began) * 1000, 1), **info})
 
-# Keep track if imports succeed
-vertex_imported = False
-genai_imported = False
+    @contextlib.contextmanager
+    def step(self, name):
+        began = time.monotonic()
+        try: yield
+        finally: self.record(name, began)
 
-if AI_BACKEND_MODE == "VERTEX":
-    try:
-        import vertexai
-        from vertexai.generative_models import GenerativeModel, Part
-        vertex_imported = True
-        print(f"[{time.monotonic() - start_time:.3f}s] Vertex AI libraries imported.")
-        logging.info("Attempting to use Vertex AI Backend.")
-    except ImportError:
-        logging.error("Vertex AI library (google-cloud-aiplatform) not installed. Set AI_BACKEND to STUDIO or install the library.")
-        # AI_BACKEND_MODE = "NONE" # Set later based on final success
-elif AI_BACKEND_MODE == "STUDIO":
-    try:
-        import google.generativeai as genai
-        genai_imported = True
-        print(f"[{time.monotonic() - start_time:.3f}s] AI Studio libraries imported.")
-        logging.info("Attempting to use AI Studio Backend.")
-    except ImportError:
-        logging.error("AI Studio library (google-generativeai) not installed. Set AI_BACKEND to VERTEX or install the library.")
-        # AI_BACKEND_MODE = "NONE" # Set later based on final success
-# else: # Handled later after checking import success
-#     logging.warning(f"Invalid AI_BACKEND value '{AI_BACKEND_MODE}'. Defaulting to no AI.")
-#     AI_BACKEND_MODE = "NONE"
+    def mark_ready(self):
+        """ The web server is accepting connections. """
+        self.ready_at = time.monotonic()
+
+    def as_dict(self):
+        with self._lock: steps = sorted(self._steps, key=lambda s: s["atMs"])
+        return {"readyMs": round((self.ready_at - self.started_at) * 1000, 1) if self.ready_at else None, "steps": steps}
+
+    def log(self):
+        report = self.as_dict()
+        lines = [f"  {s['atMs']:8.1f} ms  +{s['durationMs']:7.1f} ms  {s['step']}{'  (background)' if s.get('background') else ''}" for s in report["steps"]]
+        logging.info("Startup timing (offset, duration, step):\n" + "\n".join(lines) + (f"\n  Serving after {report['readyMs']:.1f} ms." if report["readyMs"] else ""))
 
-print(f"[{time.monotonic() - start_time:.3f}s] Core imports finished.")
+startup = StartupReport(start_time)
+startup.record("imports", start_time)
 
 # --- Configuration & Setup ---
-print(f"[{time.monotonic() - start_time:.3f}s] Loading .env...")
-load_dotenv()
-print(f"[{time.monotonic() - start_time:.3f}s] .env loaded.")
+with startup.step(".env"): load_dotenv()
+
+# Frame sources, device opening and shared-memory frames, shared with capture processes (capture_worker.py).
+# Imported after load_dotenv(): it reads SHM_* and CAPTURE_RECONNECT_* on import.
+from frame_capture import (CAPTURE_RECONNECT_INITIAL_SEC, CAPTURE_RECONNECT_MAX_SEC, CAPTURE_WORKER_BUSY,
+                           SharedFrameBuffer, SharedMemorySource, capture_running, grab_frame, open_configured_device)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
-print(f"[{time.monotonic() - start_time:.3f}s] Flask app initialized.")
 
+# --- Metrics (Prometheus text format, served at /metrics) ---
+# Hot paths bind a labelled child once (e.g. CAPTURE_FRAME_INTERVAL.labels(camera="0")) and then only do
+# an uncontended lock + a few adds per event; all formatting happens at scrape time.
+class MetricsRegistry:
+    def __init__(self): self._metrics = []
+    def register(self, metric): self._metrics.append(metric); return metric
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}"); lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+
+def _escape_label_value(value):
+    """ Label value as the text format requires: backslash, double quote and line feed escaped. """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape_label_value(v)}"' for n, v in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    kind = "untyped"
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name; self.help = help_text; self.label_names = tuple(label_names)
+        self._children = {}; self._lock = threading.Lock()
+        METRICS.register(self)
+
+    def labels(self, **labels):
+        """ Returns the child for these label values, creating it on first use. Bind it once outside hot loops. """
+        key = tuple(str(labels[n]) for n in self.label_names)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None: child = self._children[key] = self._new_child()
+            return child
+
+    def remove(self, **labels):
+        with self._lock: self._children.pop(tuple(str(labels[n]) for n in self.label_names), None)
+
+    def _items(self):
+        with self._lock: return list(self._children.items())
+
+class _ValueChild:
+    __slots__ = ("value", "_lock")
+    def __init__(self): self.value = 0.0; self._lock = threading.Lock()
+    def inc(self, amount=1.0):
+        with self._lock: self.value += amount
+    def dec(self, amount=1.0):
+        with self._lock: self.value -= amount
+    def set(self, value): self.value = value
+
+class Counter(_Metric):
+    kind = "counter"
+    def _new_child(self): return _ValueChild()
+    def inc(self, amount=1.0, **labels): self.labels(**labels).inc(amount)
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {child.value:g}" for key, child in self._items()]
+
+class Gauge(Counter):
+    """ Set/inc/dec gauge, or computed at scrape time by `collect()` returning [(label_values_tuple, value), ...]. """
+    kind = "gauge"
+    def __init__(self, name, help_text, label_names=(), collect=None):
+        super().__init__(name, help_text, label_names); self.collect = collect
+    def samples(self):
+        if self.collect is None: return super().samples()
+        try: items = self.collect()
+        except Exception as e: logging.warning(f"Metrics: collecting {self.name} failed: {e}"); return []
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value:g}" for key, value in items]
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+    def __init__(self, bounds):
+        self.bounds = bounds; self.counts = [0] * (len(bounds) + 1); self.sum = 0.0; self.count = 0
+        self._lock = threading.Lock()
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock: self.counts[i] += 1; self.sum += value; self.count += 1
+
+class Histogram(_Metric):
+    kind = "histogram"
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names); self.buckets = tuple(sorted(buckets))
+    def _new_child(self): return _HistogramChild(self.buckets)
+    def observe(self, value, **labels): self.labels(**labels).observe(value)
+    def samples(self):
+        lines = []
+        for key, child in self._items():
+            with child._lock: counts = list(child.counts); total = child.sum; count = child.count
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="' + ("+Inf" if bound == float("inf") else f"{bound:g}") + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+CAPTURE_FRAMES = Counter("capture_frames_total", "Frames published by the capture thread.", ["camera"])
+CAPTURE_FRAME_INTERVAL = Histogram("capture_frame_interval_seconds", "Time between consecutive published frames.", ["camera"],
+                                   buckets=(0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0))
+CAPTURE_READ_FAILURES = Counter("capture_read_failures_total", "Failed frame reads (the capture loop stops or reconnects).", ["camera"])
+FRAME_LOCK_WAIT = Histogram("frame_lock_wait_seconds", "Time spent acquiring the frame hand-off locks (ring publish, stream publish).", ["lock"],
+                            buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05))
+STREAM_ENCODE_SECONDS = Histogram("stream_encode_seconds", "Crop + JPEG encode time per stream frame.", ["stream"])
+STREAM_CAPTURE_TO_ENCODE_SECONDS = Histogram("stream_capture_to_encode_seconds", "Age of a frame when its stream encode finished.", ["stream"])
+CLIP_FRAMES = Counter("clip_frames_total", "Frames stored in the camera's clip buffer.", ["camera"])
+CAPTURE_JPEG_DECODES = Counter("capture_jpeg_decodes_total", "MJPEG passthrough frames decoded to pixels on demand (crop stream, analysis, pre-filter).", ["camera"])
+CAPTURE_RECONNECTS = Counter("capture_reconnects_total", "Times a lost capture device was being reopened.", ["camera"])
+ANALYSIS_HISTORY_ROWS = Counter("analysis_history_rows_total", "Analysis results written to or dropped from the history store.", ["outcome"])
+ANALYSIS_CAPTURE_TO_RESULT_SECONDS = Histogram("analysis_capture_to_result_seconds", "Age of the analyzed frame when its result was published.", ["camera"])
+ANALYSIS_PREPROCESS_SECONDS = Histogram("analysis_preprocess_seconds", "Crop/composite, change detection and payload encode time before the AI call.", ["camera"])
+ANALYSIS_UPSTREAM_SECONDS = Histogram("analysis_upstream_seconds", "AI backend call latency.", ["backend", "outcome"])
+ANALYSIS_PARSE_FAILURES = Counter("analysis_parse_failures_total", "AI replies that could not be used, by kind (json, format, unexpected).", ["kind"])
+ANALYSIS_QUOTA_EXCEEDED = Counter("analysis_quota_exceeded_total", "ResourceExhausted (HTTP 429) replies from the AI backend.", ["camera"])
+EVENTS_PUBLISHED = Counter("events_published_total", "Events published on the event bus, by type.", ["type"])
+EVENTS_CLIENTS = Gauge("events_clients", "Connected Server-Sent Events clients.")
+EVENTS_CLIENTS.labels() # Export 0 before the first client
+EVENTS_CLIENTS_DROPPED = Counter("events_clients_dropped_total", "Event stream clients disconnected by the server, by reason (slow, full).", ["reason"])
+ANALYSIS_REJECTED = Counter("analysis_rejected_total", "Analysis requests refused locally, by reason (rate_limit, queue_full, circuit_open, stalled).", ["reason"])
+ANALYSIS_EFFECTIVE_CALLS_PER_MINUTE = Gauge("analysis_effective_calls_per_minute", "Analysis call rate after backing off from quota errors and upstream failures.")
+ANALYSIS_BREAKER_TRANSITIONS = Counter("analysis_breaker_transitions_total", "AI call circuit breaker state changes, by new state (open, half_open, closed).", ["state"])
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", "10")) # Worker threads passed to waitress.serve()
+PORT = int(os.getenv("PORT", "5000")) # Web server port; extra web processes sharing the capture processes use their own
+# Buffered bytes per connection before a write blocks. Kept low so a slow MJPEG client stalls within a few
+# frames (and backs off, see AdaptiveStreamRate) instead of buffering up to Waitress's 16 MB default.
+WAITRESS_OUTBUF_HIGH_WATERMARK = int(os.getenv("WAITRESS_OUTBUF_HIGH_WATERMARK", str(256 * 1024)))
+WAITRESS_THREADS_BUSY = Gauge("waitress_threads_busy", "Waitress worker threads currently serving a request (streams hold one each).")
+WAITRESS_THREADS_BUSY.labels() # Export 0 before the first request
+
+class WsgiThreadMetrics:
+    """ WSGI middleware counting requests in flight. Waitress runs each request on one worker thread until its body is closed. """
+    def __init__(self, wsgi_app, busy_gauge):
+        self.wsgi_app = wsgi_app; self.busy = busy_gauge.labels()
+
+    def __call__(self, environ, start_response):
+        self.busy.inc()
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.busy.dec(); raise
+        return _ClosingIterable(body, self.busy.dec)
+
+class _ClosingIterable:
+    def __init__(self, iterable, on_close): self._iterable = iterable; self._on_close = on_close
+    def __iter__(self): return iter(self._iterable)
+    def close(self):
+        try:
+            if hasattr(self._iterable, "close"): self._iterable.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close: on_close()
 
-# --- AI Model Initialization ---
-print(f"[{time.monotonic() - start_time:.3f}s] Initializing AI Backend ({AI_BACKEND_MODE})...")
+app.wsgi_app = WsgiThreadMetrics(app.wsgi_app, WAITRESS_THREADS_BUSY)
+
+
+# --- Mock AI Backend (AI_BACKEND=MOCK, for load testing) ---
+class MockResponse:
+    def __init__(self, text): self.text = text
+
+class MockGeminiModel:
+    """
+    Local stand-in for the Gemini model with the same generate_content(...).text contract, so the whole
+    analysis path can be load-tested without quota or network. Latency is drawn from MOCK_LATENCY
+    ("fixed:MS", "uniform:MIN_MS,MAX_MS", "normal:MEAN_MS,STD_MS" or "lognormal:MEDIAN_MS,SIGMA").
+    MOCK_MALFORMED_RATE, MOCK_FENCED_RATE and MOCK_QUOTA_RATE are per-call probabilities of broken JSON,
+    ```json fenced output and ResourceExhausted. With MOCK_SEED the n-th call always returns the same counts.
+    """
+    model_name = "mock-gemini"
+    _REGION_LINE = re.compile(r'^\s*"([^"]+)": \{"Vehicles_Present"', re.MULTILINE) # Region names in the prompt's example block
+
+    def __init__(self, latency="lognormal:800,0.5", malformed_rate=0.0, fenced_rate=0.2, quota_rate=0.0, occupancy=0.6, seed=None):
+        kind, _, params = latency.partition(":")
+        self.latency_kind = kind.strip().lower(); self.latency_params = [float(p) for p in params.split(",") if p.strip()]
+        assert self.latency_kind in ("fixed", "uniform", "normal", "lognormal"), f"Unknown MOCK_LATENCY distribution '{kind}'."
+        self.latency_spec = latency
+        self.malformed_rate = malformed_rate; self.fenced_rate = fenced_rate; self.quota_rate = quota_rate
+        self.occupancy = occupancy
+        seed = None if seed in (None, "") else int(seed)
+        self._rng = random.Random(seed) # Outcomes and counts: deterministic call sequence for a seed
+        self._latency_rng = random.Random(None if seed is None else seed + 1)
+        self._lock = threading.Lock()
+        self.calls = 0; self.outcomes = collections.Counter()
+
+    def sample_latency_sec(self):
+        p = self.latency_params
+        with self._lock:
+            if self.latency_kind == "fixed": ms = p[0]
+            elif self.latency_kind == "uniform": ms = self._latency_rng.uniform(p[0], p[1])
+            elif self.latency_kind == "normal": ms = self._latency_rng.gauss(p[0], p[1])
+            else: ms = p[0] * math.exp(self._latency_rng.gauss(0.0, p[1] if len(p) > 1 else 0.5))
+        return max(0.0, ms) / 1000.0
+
+    def _counts(self):
+        present = self._rng.random() < self.occupancy
+        counts = {"Cars": self._rng.randint(1, 6) if present else 0,
+                  "Bikes": self._rng.randint(0, 2) if present else 0,
+                  "Trucks": self._rng.randint(0, 2) if present else 0,
+                  "Buses": self._rng.randint(0, 1) if present else 0,
+                  "Unknown": self._rng.randint(0, 1) if present else 0}
+        return {"Vehicles_Present": str(present), **counts}
+
+    def generate_content(self, contents, request_options=None):
+        prompt = contents[0] if contents else ""
+        with self._lock:
+            self.calls += 1
+            roll = self._rng.random()
+            region_names = self._REGION_LINE.findall(prompt) if "\"Regions\"" in prompt else []
+            result = {"Regions": {name: self._counts() for name in region_names}} if region_names else self._counts()
+            fenced = self._rng.random() < self.fenced_rate
+        latency = self.sample_latency_sec()
+        timeout = (request_options or {}).get("timeout")
+        if timeout and latency > timeout:
+            time.sleep(timeout); self.outcomes["timeout"] += 1
+            raise google.api_core.exceptions.DeadlineExceeded(f"Mock call exceeded {timeout}s (sampled {latency:.2f}s).")
+        time.sleep(latency)
+        if roll < self.quota_rate:
+            self.outcomes["quota"] += 1
+            raise google.api_core.exceptions.ResourceExhausted("Mock quota exceeded.")
+        text = json.dumps(result, indent=2)
+        if roll < self.quota_rate + self.malformed_rate:
+            self.outcomes["malformed"] += 1
+            return MockResponse(text[: len(text) // 2]) # Truncated JSON
+        if fenced: text = f"```json\n{text}\n```"
+        self.outcomes["fenced" if fenced else "ok"] += 1
+        return MockResponse(text)
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "latency": self.latency_spec, "outcomes": dict(self.outcomes)}
+
+
+# --- AI Model Initialization (background) ---
+# Importing google.generativeai / vertexai and creating the model takes seconds, so it runs on a background
+# thread started at import: pages, video and the signal controller are served at once, and every analysis path
+# already treats `gemini_model is None` as "AI not available" (503, fixed-cycle signal) until it is ready.
+AI_BACKEND_MODE = os.getenv("AI_BACKEND", "STUDIO").upper() # Requested backend; set to "NONE" if initialization fails
 gemini_model = None
 model_name_info = "N/A"
-effective_ai_backend_mode = "NONE" # Start assuming failure
-
-if AI_BACKEND_MODE == "STUDIO" and genai_imported:
-    API_KEY = os.getenv("GOOGLE_API_KEY")
-    if not API_KEY:
-        logging.error("GOOGLE_API_KEY is not set for AI Studio mode.")
-    else:
+Part = None # vertexai.generative_models.Part, bound once the Vertex SDK is imported
+
+def init_studio_model():
+    """ AI Studio (google-generativeai). Returns (model, description). """
+    try: import google.generativeai as genai
+    except ImportError: raise RuntimeError("AI Studio library (google-generativeai) not installed. Set AI_BACKEND to VERTEX or install the library.")
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key: raise RuntimeError("GOOGLE_API_KEY is not set for AI Studio mode.")
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel('gemini-1.5-flash-latest') # Use a known stable model name for AI Studio
+    return model, f"AI Studio: {model.model_name}"
+
+def init_vertex_model():
+    """ Vertex AI (google-cloud-aiplatform). Returns (model, description). """
+    global Part
+    try:
+        import vertexai
+        from vertexai.generative_models import GenerativeModel, Part as VertexPart
+    except ImportError: raise RuntimeError("Vertex AI library (google-cloud-aiplatform) not installed. Set AI_BACKEND to STUDIO or install the library.")
+    project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
+    location = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
+    if not project_id: raise RuntimeError("GOOGLE_CLOUD_PROJECT environment variable is not set for Vertex AI mode.")
+    vertexai.init(project=project_id, location=location)
+    Part = VertexPart
+    # Check Vertex AI documentation for current recommended models
+    model = GenerativeModel("gemini-1.5-flash-001")
+    return model, f"Vertex AI: {model._model_name} (Project: {project_id}, Location: {location})" # Use _model_name for Vertex
+
+def init_mock_model():
+    try:
+        model = MockGeminiModel(
+            latency=os.getenv("MOCK_LATENCY", "lognormal:800,0.5"),
+            malformed_rate=float(os.getenv("MOCK_MALFORMED_RATE", "0")),
+            fenced_rate=float(os.getenv("MOCK_FENCED_RATE", "0.2")),
+            quota_rate=float(os.getenv("MOCK_QUOTA_RATE", "0")),
+            occupancy=float(os.getenv("MOCK_OCCUPANCY", "0.6")),
+            seed=os.getenv("MOCK_SEED"))
+    except (AssertionError, ValueError, IndexError) as e:
+        raise RuntimeError(f"Invalid MOCK backend configuration: {e}")
+    logging.warning("Using the MOCK AI backend. Results are synthetic.")
+    return model, f"Mock: {model.latency_spec} (seed {os.getenv('MOCK_SEED') or 'random'})"
+
+AI_INITIALIZERS = {"STUDIO": init_studio_model, "VERTEX": init_vertex_model, "MOCK": init_mock_model}
+
+class AIBackendInitializer:
+    """
+    Runs the initializer for AI_BACKEND_MODE once on a background thread and publishes the model
+    (gemini_model is assigned last, so a reader that sees it also sees model_name_info).
+    state: pending | initializing | ready | failed | disabled (AI_BACKEND=NONE, e.g. capture processes).
+    Listeners are called when it finishes either way.
+    """
+    def __init__(self):
+        self.state = "pending"; self.error = None; self.duration_ms = None
+        self._done = threading.Event(); self._listeners = []
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None: return
+        self._thread = threading.Thread(target=self._run, name="AIBackendInit", daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None):
+        """ True once initialization has finished (ready or failed). """
+        return self._done.wait(timeout)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+        if self._done.is_set(): callback()
+
+    def status(self):
+        return {"state": self.state, "mode": AI_BACKEND_MODE, "model": model_name_info, "initMs": self.duration_ms, "error": self.error}
+
+    def _run(self):
+        global AI_BACKEND_MODE, gemini_model, model_name_info
+        requested = AI_BACKEND_MODE; began = time.monotonic(); self.state = "initializing"
         try:
-            print(f"[{time.monotonic() - start_time:.3f}s] Configuring genai...")
-            genai.configure(api_key=API_KEY)
-            print(f"[{time.monotonic() - start_time:.3f}s] Instantiating AI Studio model...")
-            # Use a known stable model name for AI Studio
-            gemini_model = genai.GenerativeModel('gemini-1.5-flash-latest')
-            model_name_info = f"AI Studio: {gemini_model.model_name}"
-            effective_ai_backend_mode = "STUDIO" # Success!
-            logging.info(f"Google AI Studio API configured: {model_name_info}")
-            print(f"[{time.monotonic() - start_time:.3f}s] AI Studio configured and model instantiated.")
+            if requested == "NONE":
+                self.state = "disabled"; logging.info("AI backend disabled (AI_BACKEND=NONE).")
+            else:
+                logging.info(f"Initializing AI Backend ({requested}) in the background...")
+                if requested not in AI_INITIALIZERS: raise RuntimeError(f"Invalid AI_BACKEND value '{requested}'.")
+                model, model_name_info = AI_INITIALIZERS[requested]()
+                gemini_model = model
+                self.state = "ready"
+                logging.info(f"AI backend ready: {model_name_info}")
         except Exception as e:
-            logging.error(f"Error configuring Google AI Studio API: {e}", exc_info=True)
-            print(f"[{time.monotonic() - start_time:.3f}s] AI Studio configuration FAILED.")
+            logging.error(f"AI backend initialization failed: {e}", exc_info=not isinstance(e, RuntimeError))
+            # This message logs regardless of the reason (invalid setting, missing lib, init failure)
+            logging.warning("AI Backend could not be initialized. Analysis endpoint will be disabled.")
+            self.error = str(e); self.state = "failed"; AI_BACKEND_MODE = "NONE"
+        self.duration_ms = round((time.monotonic() - began) * 1000, 1)
+        startup.record(f"AI backend ({requested})", began, background=True)
+        self._done.set()
+        for callback in list(self._listeners):
+            try: callback()
+            except Exception as e: logging.error(f"AI backend listener failed: {e}", exc_info=True)
+
+ai_backend = AIBackendInitializer()
+ai_backend.start()
+
+# --- Frame Ring Buffer ---
+FRAME_RING_SLOTS = max(2, int(os.getenv("FRAME_RING_SLOTS", "4"))) # Preallocated capture slots
+
+class FrameRef:
+    """
+    Read-only handle to one ring slot. `frame` is a non-writeable view; no copy is made.
+    A frame captured in MJPEG passthrough mode carries the camera's JPEG bytes in `jpeg` and no slot, and
+    `frame` decodes them on first access only (once per frame, shared by every reader). A frame read from
+    a capture process (see "Shared-Memory Frames" in frame_capture.py) has both, but its pixels stay in the
+    process's shared-memory slot; `valid` tells when that slot is reused.
+    """
+    __slots__ = ("ring", "slot", "seq", "timestamp", "jpeg", "_frame", "_valid")
 
-elif AI_BACKEND_MODE == "VERTEX" and vertex_imported:
-    try:
-        PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
-        LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
-
-        if not PROJECT_ID:
-            raise ValueError("GOOGLE_CLOUD_PROJECT environment variable is not set for Vertex AI mode.")
-
-        print(f"[{time.monotonic() - start_time:.3f}s] Initializing vertexai (Project: {PROJECT_ID}, Location: {LOCATION})...")
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        print(f"[{time.monotonic() - start_time:.3f}s] vertexai.init() successful. Instantiating Vertex AI model...")
-        # Use a known stable model name for Vertex AI
-        # Check Vertex AI documentation for current recommended models
-        gemini_model = GenerativeModel("gemini-1.5-flash-001")
-        model_name_info = f"Vertex AI: {gemini_model._model_name} (Project: {PROJECT_ID}, Location: {LOCATION})" # Use _model_name for Vertex
-        effective_ai_backend_mode = "VERTEX" # Success!
-        logging.info(f"Vertex AI configured: {model_name_info}")
-        print(f"[{time.monotonic() - start_time:.3f}s] Vertex AI configured and model instantiated.")
+    def __init__(self, ring, slot, seq, timestamp, frame, jpeg=None, valid=None):
+        self.ring = ring; self.slot = slot; self.seq = seq; self.timestamp = timestamp; self.jpeg = jpeg; self._frame = frame
+        self._valid = valid
 
-    except Exception as e:
-        logging.error(f"Error configuring Vertex AI: {e}", exc_info=True)
-        print(f"[{time.monotonic() - start_time:.3f}s] Vertex AI configuration FAILED.")
+    @property
+    def frame(self):
+        if self._frame is None and self.jpeg is not None: self.ring.decode(self)
+        return self._frame
+
+    def still_valid(self):
+        """ True while the capture thread (or capture process) has not started overwriting this slot (passthrough frames own their data). """
+        if self._valid is not None: return self._valid()
+        return self.slot is None or self.ring.slot_seq(self.slot) == self.seq
+
+class FrameRing:
+    """
+    Fixed-size ring of preallocated frame buffers written by the capture thread.
+    The writer fills the slot after the newest one and then publishes it by swapping a single
+    reference, so readers never take a lock or copy: latest() returns a read-only view of the
+    newest slot. A reader that holds a view for longer than (slots - 1) frame intervals may
+    see it overwritten; FrameRef.still_valid() lets it detect that after use.
+    """
+    def __init__(self, num_slots=FRAME_RING_SLOTS, name="ring"):
+        self.num_slots = num_slots
+        self._buffers = None # ndarray (slots, h, w, c)
+        self._views = [] # Read-only view per slot
+        self._slot_seqs = [0] * num_slots # 0 = empty, -1 = being written
+        self._slot_stamps = [0.0] * num_slots
+        self._latest = None # FrameRef of the newest published slot (swapped atomically)
+        self._next_seq = 1
+        self._cond = threading.Condition() # Only used by waiters (stream encoders), never by latest()
+        self._decode_lock = threading.Lock() # Passthrough mode: one lazy decode per frame
+        self._lock_wait = FRAME_LOCK_WAIT.labels(lock=f"{name}/ring")
+        self._decodes = CAPTURE_JPEG_DECODES.labels(camera=name)
+
+    @property
+    def shape(self):
+        return None if self._buffers is None else self._buffers.shape[1:]
+
+    def allocate(self, shape, dtype=np.uint8):
+        """ (Re)allocates all slots for a frame shape and logs the memory budget. """
+        self._latest = None
+        self._buffers = np.zeros((self.num_slots,) + tuple(shape), dtype=dtype)
+        self._views = []
+        for i in range(self.num_slots):
+            view = self._buffers[i].view(); view.flags.writeable = False
+            self._views.append(view)
+        self._slot_seqs = [0] * self.num_slots; self._slot_stamps = [0.0] * self.num_slots
+        h, w = shape[:2]
+        logging.info(f"Frame ring allocated: {self.num_slots} slots x {w}x{h} = {self._buffers.nbytes / (1024 * 1024):.1f} MB")
+
+    def release(self):
+        """ Drops the published frame and the slot memory. """
+        with self._cond:
+            self._latest = None; self._buffers = None; self._views = []
+            self._slot_seqs = [0] * self.num_slots
+            self._cond.notify_all()
+
+    def begin_write(self):
+        """ Returns (slot_index, writable buffer) for the next frame. The slot is marked in-progress. """
+        slot = self._next_seq % self.num_slots
+        self._slot_seqs[slot] = -1
+        return slot, self._buffers[slot]
+
+    def publish(self, slot, timestamp):
+        """ Makes the slot filled after begin_write() the newest frame. `timestamp` is the time.monotonic() capture time. """
+        seq = self._next_seq; self._next_seq += 1
+        self._slot_stamps[slot] = timestamp; self._slot_seqs[slot] = seq
+        self._latest = FrameRef(self, slot, seq, timestamp, self._views[slot])
+        wait_start = time.perf_counter()
+        with self._cond:
+            self._lock_wait.observe(time.perf_counter() - wait_start)
+            self._cond.notify_all() # Wake stream encoders
+        return seq
+
+    def publish_jpeg(self, jpeg, timestamp):
+        """ MJPEG passthrough: publishes the camera's compressed frame as-is. Pixels are decoded on demand by FrameRef.frame. """
+        seq = self._next_seq; self._next_seq += 1
+        slot = seq % self.num_slots
+        self._slot_stamps[slot] = timestamp; self._slot_seqs[slot] = seq
+        self._latest = FrameRef(self, None, seq, timestamp, None, jpeg)
+        wait_start = time.perf_counter()
+        with self._cond:
+            self._lock_wait.observe(time.perf_counter() - wait_start)
+            self._cond.notify_all()
+        return seq
+
+    def publish_view(self, frame, timestamp, jpeg, valid):
+        """
+        Publishes a read-only frame held outside the ring (a capture process's shared-memory slot) without copying it.
+        `jpeg` is the process's encoding of it, sent as-is by the full stream; `valid()` turns False once the slot is reused.
+        """
+        seq = self._next_seq; self._next_seq += 1
+        self._latest = FrameRef(self, None, seq, timestamp, frame, jpeg, valid)
+        wait_start = time.perf_counter()
+        with self._cond:
+            self._lock_wait.observe(time.perf_counter() - wait_start)
+            self._cond.notify_all()
+        return seq
+
+    def decode(self, ref):
+        """ Decodes a passthrough frame's JPEG once; concurrent readers wait for the first decode. Leaves None if corrupt. """
+        with self._decode_lock:
+            if ref._frame is not None: return
+            frame = cv2.imdecode(np.frombuffer(ref.jpeg, np.uint8), cv2.IMREAD_COLOR)
+            if frame is None: logging.warning(f"Frame ring: camera JPEG {ref.seq} could not be decoded."); return
+            frame.flags.writeable = False
+            ref._frame = frame; self._decodes.inc()
+
+    def latest(self):
+        """ Lock-free: newest FrameRef or None. """
+        return self._latest
+
+    def slot_seq(self, slot):
+        return self._slot_seqs[slot]
+
+    def wait_newer(self, seq, timeout):
+        """ Blocks until a frame with sequence != seq is published. Returns the FrameRef or None. """
+        ref = self._latest
+        if ref is not None and ref.seq != seq: return ref
+        with self._cond:
+            self._cond.wait_for(lambda: self._latest is not None and self._latest.seq != seq, timeout=timeout)
+            return self._latest if self._latest is not None and self._latest.seq != seq else None
 
-# Update the global mode based on success/failure
-AI_BACKEND_MODE = effective_ai_backend_mode
-if AI_BACKEND_MODE == "NONE":
-    # This message logs regardless of the reason (invalid setting, missing lib, init failure)
-    logging.warning("AI Backend could not be initialized. Analysis endpoint will be disabled.")
-print(f"[{time.monotonic() - start_time:.3f}s] AI Model initialization finished. Effective Mode: {AI_BACKEND_MODE}")
 
 # --- Backend Camera State Management ---
-output_frame = None
-output_frame_lock = threading.Lock()
 placeholder_frame = None
-camera_thread = None
-camera_device = None
-is_camera_running = False
-camera_start_lock = threading.Lock()
+reconnecting_frame = None # Shown while a lost camera is being reopened
 
 # --- Placeholder Frame Creation ---
-print(f"[{time.monotonic() - start_time:.3f}s] Creating placeholder frame...")
-def create_placeholder_frame():
-    global placeholder_frame
+def create_placeholder_frame(text="Camera Stopped"):
+    """ Returns a 640x480 JPEG with `text` centered, or b'' on failure. """
     try:
         width, height = 640, 480; frame = np.zeros((height, width, 3), dtype=np.uint8)
-        text = "Camera Stopped"; font = cv2.FONT_HERSHEY_SIMPLEX; font_scale = 0.9; thickness = 2
+        font = cv2.FONT_HERSHEY_SIMPLEX; font_scale = 0.9; thickness = 2
         text_size = cv2.getTextSize(text, font, font_scale, thickness)[0]
         text_x = (width - text_size[0]) // 2; text_y = (height + text_size[1]) // 2
         cv2.putText(frame, text, (text_x, text_y), font, font_scale, (255, 255, 255), thickness)
         (flag, encoded_image) = cv2.imencode(".jpg", frame)
-        if flag: placeholder_frame = encoded_image.tobytes(); logging.info("Placeholder frame created.")
-        else: logging.error("Could not encode placeholder!"); placeholder_frame = b''
-    except Exception as e: logging.error(f"Error creating placeholder: {e}"); placeholder_frame = b''
-create_placeholder_frame()
-print(f"[{time.monotonic() - start_time:.3f}s] Placeholder frame created.")
-
-
-# --- Camera Capture Thread ---
-def capture_frames_loop():
-    global output_frame, is_camera_running, camera_device
-    logging.info("Camera capture thread starting.")
-    frame_count = 0; start_time_capture = time.time()
-    while is_camera_running:
-        if not camera_device or not camera_device.isOpened(): logging.warning("Capture: Camera lost."); is_camera_running = False; break
-        try:
-            ret, frame = camera_device.read()
-            if not ret: logging.warning("Capture: Frame read fail."); is_camera_running = False; break
-            with output_frame_lock: output_frame = frame.copy()
-            frame_count += 1
-        except Exception as e: logging.error(f"Capture error: {e}"); is_camera_running = False; break
-        time.sleep(0.01) # Small delay
-    duration = time.time() - start_time_capture; fps = frame_count / duration if duration > 0 else 0
-    logging.info(f"Capture thread finished. {frame_count} frames (~{fps:.1f} FPS).")
-    with output_frame_lock: output_frame = None
-
-
-# --- Camera Start/Stop Logic ---
-def start_camera_process():
-    """ Opens camera, attempts resolution, starts thread. Requires camera_start_lock. """
-    global is_camera_running, camera_device, camera_thread, output_frame, app_settings
-    if is_camera_running: logging.warning("start_camera: already running."); return True
-    logging.info("Attempting start camera device...")
-    camera_device = None
-    # Try common indices first, then higher ones if needed
-    for index in range(2): # Try indices 0, 1
-        try:
-             # Add API preference if needed, e.g., cv2.CAP_ANY, cv2.CAP_DSHOW etc.
-             temp_cap = cv2.VideoCapture(index)
-             if temp_cap and temp_cap.isOpened():
-                 logging.info(f"Camera opened successfully at index {index}.")
-                 camera_device = temp_cap
-                 break
-             else:
-                 logging.warning(f"Failed to open camera at index {index}.")
-                 if temp_cap: temp_cap.release()
-        except Exception as e:
-             logging.error(f"Error probing camera index {index}: {e}")
+        if flag: logging.info(f"Placeholder frame '{text}' created."); return encoded_image.tobytes()
+        logging.error("Could not encode placeholder!"); return b''
+    except Exception as e: logging.error(f"Error creating placeholder: {e}"); return b''
+with startup.step("placeholder frames"):
+    placeholder_frame = create_placeholder_frame()
+    reconnecting_frame = create_placeholder_frame("Camera Reconnecting...")
+
 
-    if camera_device is None:
-        logging.error("Cannot open any camera device.")
+# --- Crop Helper ---
+FULL_FRAME_RECT = (0.0, 0.0, 1.0, 1.0)
+
+def pixel_rect(rect, img_h, img_w):
+    """
+    (y-slice, x-slice) of an (x, y, w, h) rectangle of frame fractions for an img_w x img_h frame,
+    or None for the full frame (also used when the rectangle is invalid or rounds to zero area).
+    """
+    if img_h <= 0 or img_w <= 0: # Ensure valid dimensions before cropping
+        logging.warning("Crop: Invalid frame dimensions received. Cannot crop.")
+        return None
+    cx, cy, cw, ch = (float(v) for v in rect)
+    # Validate crop values (allow slight float tolerance)
+    valid = (0.0 <= cx <= 1.0 and 0.0 <= cy <= 1.0 and
+             0.0 < cw <= 1.0 and 0.0 < ch <= 1.0 and
+             (cx + cw) <= 1.001 and (cy + ch) <= 1.001)
+    if not valid: logging.warning(f"Crop: Invalid crop values {rect}. Using full frame."); return None
+    # Check if it's effectively the full image
+    if abs(cw - 1.0) < 1e-6 and abs(ch - 1.0) < 1e-6 and abs(cx) < 1e-6 and abs(cy) < 1e-6: return None
+    # Calculate pixel coordinates safely
+    y1 = int(cy * img_h); y2 = min(int((cy + ch) * img_h), img_h)
+    x1 = int(cx * img_w); x2 = min(int((cx + cw) * img_w), img_w)
+    if y2 > y1 and x2 > x1: return slice(y1, y2), slice(x1, x2)
+    logging.warning(f"Crop: Calculated zero area ({y1}:{y2}, {x1}:{x2}). Using full frame.")
+    return None
+
+def apply_crop_area(full_frame, crop):
+    """ Returns the cropArea slice of a BGR frame (a view, not a copy), or the full frame. """
+    rect = pixel_rect([crop.get(k, d) for k, d in zip("xywh", FULL_FRAME_RECT)], *full_frame.shape[:2])
+    return full_frame if rect is None else full_frame[rect]
+
+class CameraConfig:
+    """
+    Immutable settings of one camera (source, resolution, crop area, named regions), validated and
+    converted once, plus the pixel slices of the crop area and regions for one frame size. A change
+    builds a new object that is swapped in with a single assignment, so the frame path reads one
+    attribute and sees either the whole old configuration or the whole new one.
+    """
+    __slots__ = ("version", "source", "resolution", "crop_area", "regions", "frame_size", "crop_rect", "region_rects")
+
+    def __init__(self, version=0, source="auto", resolution="default", crop_area=FULL_FRAME_RECT, regions=(), frame_size=None):
+        values = {"version": version, "source": str(source), "resolution": str(resolution),
+                  "crop_area": tuple(float(v) for v in crop_area),
+                  "regions": tuple((name, tuple(float(v) for v in rect)) for name, rect in regions),
+                  "frame_size": frame_size}
+        if frame_size is not None: # Precomputed for frames of this (height, width)
+            values["crop_rect"] = pixel_rect(values["crop_area"], *frame_size)
+            values["region_rects"] = tuple(pixel_rect(rect, *frame_size) or (slice(None), slice(None)) for _, rect in values["regions"])
+        else: values["crop_rect"] = None; values["region_rects"] = ()
+        for key, value in values.items(): object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value): raise AttributeError("CameraConfig is immutable; use replace().")
+
+    @classmethod
+    def from_settings(cls, version, settings, base=None):
+        """ New config from JSON-style settings ('source', 'resolution', 'cropArea', 'regions'); missing keys keep `base`'s values. """
+        base = base or cls()
+        crop = settings.get("cropArea")
+        regions = settings.get("regions")
+        return cls(version, settings.get("source", base.source), settings.get("resolution", base.resolution),
+                   [crop[k] for k in "xywh"] if crop is not None else base.crop_area,
+                   [(r["name"], [r[k] for k in "xywh"]) for r in regions] if regions is not None else base.regions, base.frame_size)
+
+    def for_frame_size(self, frame_size):
+        """ Same settings with the pixel slices computed for frames of (height, width). """
+        return CameraConfig(self.version, self.source, self.resolution, self.crop_area, self.regions, tuple(frame_size))
+
+    @property
+    def region_names(self): return [name for name, _ in self.regions]
+
+    def crop(self, frame):
+        """ The crop area of a frame of the bound size (a view, not a copy). """
+        return frame if self.crop_rect is None else frame[self.crop_rect]
+
+    def as_settings(self):
+        """ JSON form, as accepted by from_settings(). """
+        return {"source": self.source, "resolution": self.resolution, "cropArea": dict(zip("xywh", self.crop_area)),
+                "regions": [{"name": name, **dict(zip("xywh", rect))} for name, rect in self.regions]}
+
+
+# --- MJPEG Stream Broadcasting ---
+STREAM_JPEG_QUALITY = 80 # Default stream quality
+STREAM_TARGET_FPS = 20 # Default frames per second sent to each client
+STREAM_MAX_FPS = 30 # Upper bound a client may request with ?fps=
+STREAM_MIN_FPS = 2 # Back-off floor for stalled clients
+STREAM_MIN_QUALITY = 40 # Back-off floor for JPEG quality
+STREAM_WIDTH_TIERS = (320, 480, 640, 960, 1280, 1920) # ?max_width= snaps down to one of these (0 = full size)
+
+def stream_variant(quality, max_width):
+    """ Quantized (quality, width) encode key, so clients with similar requests share one encode. """
+    quality = min(95, max(20, int(round(quality / 5.0)) * 5))
+    if max_width and max_width > 0:
+        max_width = max([w for w in STREAM_WIDTH_TIERS if w <= max_width] or [STREAM_WIDTH_TIERS[0]])
+    else: max_width = 0
+    return quality, max_width
+
+class StreamClient:
+    """ Per-connection bookkeeping for one MJPEG subscriber. """
+    _ids = 0
+    _ids_lock = threading.Lock()
+
+    def __init__(self, variant):
+        with StreamClient._ids_lock:
+            StreamClient._ids += 1; self.client_id = StreamClient._ids
+        self.connected_at = time.time()
+        self.variant = variant # (quality, max_width) this client receives
+        self.fps = STREAM_TARGET_FPS
+        self.frames_sent = 0
+        self.frames_dropped = 0 # Encoded frames this client skipped because it was too slow
+
+class StreamVariant:
+    """ Latest encoded frame of one (quality, max_width) variant, with its monotonic capture and encode times. """
+    __slots__ = ("encoded_seq", "frame_seq", "frame_bytes", "captured_at", "encoded_at")
+    def __init__(self): self.encoded_seq = 0; self.frame_seq = 0; self.frame_bytes = None; self.captured_at = 0.0; self.encoded_at = 0.0
+
+class AdaptiveStreamRate:
+    """
+    Per-client send rate and encode variant. Starts at what the client asked for and, when socket
+    writes stall (the yield back from the server takes a large share of the frame interval), steps
+    down: first FPS (halving to STREAM_MIN_FPS), then JPEG quality, then width. After a quiet period
+    it steps back up in reverse order, never above the request.
+    """
+    STALL_RATIO = 0.5 # EWMA of write time / frame interval above this = stalled
+    RECOVER_RATIO = 0.1
+    DEGRADE_HOLD_SEC = 1.0; RECOVER_HOLD_SEC = 5.0
+
+    def __init__(self, fps=STREAM_TARGET_FPS, quality=STREAM_JPEG_QUALITY, max_width=0):
+        self.requested = (float(fps), *stream_variant(quality, max_width))
+        self.fps, self.quality, self.max_width = self.requested
+        self.stall_ewma = 0.0
+        self._last_change = time.monotonic()
+
+    @property
+    def frame_interval(self): return 1.0 / self.fps
+
+    def variant(self): return self.quality, self.max_width
+
+    def record_write(self, write_sec):
+        """ Feeds one write duration. Returns True when the encode variant changed. """
+        self.stall_ewma = 0.7 * self.stall_ewma + 0.3 * (write_sec / self.frame_interval)
+        since_change = time.monotonic() - self._last_change
+        before = self.variant(); changed = False
+        if self.stall_ewma > self.STALL_RATIO and since_change > self.DEGRADE_HOLD_SEC:
+            # A write that blocked for many frame intervals means the link is far too slow: take several steps at once
+            steps = min(4, max(1, int(math.log2(self.stall_ewma / self.STALL_RATIO))))
+            changed = any([self._degrade() for _ in range(steps)])
+        elif self.stall_ewma < self.RECOVER_RATIO and since_change > self.RECOVER_HOLD_SEC:
+            changed = self._recover()
+        if changed:
+            self._last_change = time.monotonic(); self.stall_ewma = 0.0
+            logging.info(f"MJPEG back-off: now {self.fps:g} fps, quality {self.quality}, max width {self.max_width or 'full'} (requested {self.requested}).")
+        return self.variant() != before
+
+    def _degrade(self):
+        if self.fps > STREAM_MIN_FPS: self.fps = max(float(STREAM_MIN_FPS), self.fps / 2); return True
+        if self.quality > STREAM_MIN_QUALITY: self.quality = max(STREAM_MIN_QUALITY, self.quality - 15); return True
+        lower = [w for w in STREAM_WIDTH_TIERS if w < (self.max_width or STREAM_WIDTH_TIERS[-1] + 1)]
+        if lower: self.max_width = lower[-1]; return True
         return False
 
-    target_resolution=app_settings.get('resolution','default'); target_width,target_height=0,0
-    if target_resolution!='default' and 'x' in target_resolution:
-        try: parts=target_resolution.split('x'); target_width=int(parts[0]); target_height=int(parts[1])
-        except ValueError: logging.warning(f"Invalid resolution format: {target_resolution}. Using default."); target_width,target_height = 0,0
-        except Exception as e: logging.warning(f"Error parsing resolution: {e}. Using default."); target_width,target_height = 0,0
+    def _recover(self):
+        req_fps, req_quality, req_width = self.requested
+        if self.max_width != req_width:
+            higher = [w for w in STREAM_WIDTH_TIERS if w > self.max_width and (not req_width or w <= req_width)]
+            self.max_width = higher[0] if higher else req_width; return True
+        if self.quality < req_quality: self.quality = min(req_quality, self.quality + 15); return True
+        if self.fps < req_fps: self.fps = min(req_fps, self.fps * 2); return True
+        return False
 
-    if target_width > 0 and target_height > 0:
+class StreamBroadcaster:
+    """
+    Encodes each new capture frame ONCE per stream variant and hands the same JPEG bytes
+    to every subscribed client. A variant is a quantized (quality, max_width) pair; only variants
+    with at least one subscriber are encoded, and the crop/transform runs once per frame for all.
+    The encoder thread only runs while there are subscribers.
+    Each encoded frame is tagged with an encode sequence number; a client that falls behind
+    simply jumps to the newest frame and counts the skipped ones as dropped (nothing queues).
+    """
+    def __init__(self, name, ring, transform=None):
+        self.name = name
+        self.ring = ring # FrameRing to encode from
+        self.transform = transform # Optional frame -> frame function (e.g. crop) applied before encoding
+        self._cond = threading.Condition()
+        self._variants = {} # (quality, max_width) -> StreamVariant
+        self._clients = {}
+        self._thread = None
+        self._encode_time = STREAM_ENCODE_SECONDS.labels(stream=name)
+        self._lock_wait = FRAME_LOCK_WAIT.labels(lock=f"{name}/stream")
+        self._capture_to_encode = STREAM_CAPTURE_TO_ENCODE_SECONDS.labels(stream=name)
+
+    def client_rates(self):
+        """ [(client_id, delivered_fps)] for the metrics endpoint. """
+        now = time.time()
+        with self._cond:
+            return [(c.client_id, c.frames_sent / max(now - c.connected_at, 1e-3)) for c in self._clients.values()]
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+    def subscribe(self, variant=(STREAM_JPEG_QUALITY, 0)):
+        client = StreamClient(variant)
+        with self._cond:
+            self._clients[client.client_id] = client
+            self._variants.setdefault(variant, StreamVariant())
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._encode_loop, name=f"StreamEncoder-{self.name}", daemon=True)
+                self._thread.start()
+        logging.debug(f"MJPEG {self.name}: client {client.client_id} subscribed to {variant} ({len(self._clients)} active).")
+        return client
+
+    def set_variant(self, client, variant):
+        with self._cond:
+            client.variant = variant
+            self._variants.setdefault(variant, StreamVariant())
+
+    def unsubscribe(self, client):
+        with self._cond:
+            self._clients.pop(client.client_id, None)
+            remaining = len(self._clients)
+        logging.info(f"MJPEG {self.name}: client {client.client_id} closed. Sent {client.frames_sent}, dropped {client.frames_dropped}. ({remaining} active)")
+
+    def wait_for_frame(self, client, last_encoded_seq, timeout):
+        """
+        Blocks until the client's variant has a frame newer than last_encoded_seq.
+        Returns (encoded_seq, bytes, (frame_seq, captured_at, encoded_at)) or (last_encoded_seq, None, None).
+        """
+        with self._cond:
+            variant = self._variants[client.variant]
+            if not self._cond.wait_for(lambda: variant.encoded_seq != last_encoded_seq and variant.frame_bytes is not None, timeout=timeout):
+                return last_encoded_seq, None, None
+            return variant.encoded_seq, variant.frame_bytes, (variant.frame_seq, variant.captured_at, variant.encoded_at)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "encodedSeq": max([v.encoded_seq for v in self._variants.values()] or [0]),
+                "frameSeq": max([v.frame_seq for v in self._variants.values()] or [0]),
+                "variants": [{"quality": q, "maxWidth": w, "encodedSeq": v.encoded_seq} for (q, w), v in self._variants.items()],
+                "clients": [{"id": c.client_id, "framesSent": c.frames_sent, "framesDropped": c.frames_dropped,
+                             "fps": c.fps, "quality": c.variant[0], "maxWidth": c.variant[1],
+                             "connectedSec": round(time.time() - c.connected_at, 1)} for c in self._clients.values()]
+            }
+
+    def _active_variants(self):
+        """ Variant keys that still have subscribers; idle ones are dropped. Caller holds _cond. """
+        active = {c.variant for c in self._clients.values()}
+        for key in [k for k in self._variants if k not in active]: del self._variants[key]
+        return active
+
+    def _encode_loop(self):
+        logging.info(f"MJPEG {self.name}: encoder thread starting.")
+        last_frame_seq = 0
+        while True:
+            with self._cond:
+                if not self._clients:
+                    self._thread = None; self._variants.clear()
+                    break
+                variants = self._active_variants()
+            # Wait for a frame we have not encoded yet; encode straight from the ring slot view
+            ref = self.ring.wait_newer(last_frame_seq, timeout=0.5)
+            if ref is None:
+                continue
+            last_frame_seq = ref.seq
+            encoded = {}
+            try:
+                encode_start = time.perf_counter()
+                frame_to_encode = None # Decoded/cropped lazily: passthrough variants never touch pixels
+                resized = {} # max_width -> frame, shared by every quality at that width
+                for quality, max_width in variants:
+                    if ref.jpeg is not None and self.transform is None and max_width == 0 and quality >= STREAM_JPEG_QUALITY:
+                        encoded[(quality, max_width)] = ref.jpeg; continue # Camera's own JPEG, sent as-is
+                    if frame_to_encode is None:
+                        if ref.frame is None: break # Undecodable camera JPEG: skip this frame
+                        frame_to_encode = self.transform(ref.frame) if self.transform else ref.frame
+                    frame = resized.get(max_width)
+                    if frame is None:
+                        frame = frame_to_encode
+                        if max_width and frame.shape[1] > max_width:
+                            height = max(1, int(frame.shape[0] * max_width / frame.shape[1]))
+                            frame = cv2.resize(frame, (max_width, height), interpolation=cv2.INTER_AREA)
+                        resized[max_width] = frame
+                    flag, enc = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                    if flag: encoded[(quality, max_width)] = enc.tobytes()
+                    else: logging.warning(f"MJPEG {self.name}: Encode fail.")
+                self._encode_time.observe(time.perf_counter() - encode_start)
+            except Exception as e:
+                logging.error(f"MJPEG {self.name}: error preparing frame: {e}", exc_info=True); continue
+            if not ref.still_valid():
+                logging.debug(f"MJPEG {self.name}: slot overwritten during encode, discarding frame {ref.seq}."); continue
+            encoded_at = time.monotonic()
+            self._capture_to_encode.observe(encoded_at - ref.timestamp)
+            wait_start = time.perf_counter()
+            with self._cond:
+                self._lock_wait.observe(time.perf_counter() - wait_start)
+                for key, frame_bytes in encoded.items():
+                    variant = self._variants.get(key)
+                    if variant is None: continue # Its last client left during the encode
+                    variant.frame_bytes = frame_bytes; variant.frame_seq = ref.seq; variant.encoded_seq += 1
+                    variant.captured_at = ref.timestamp; variant.encoded_at = encoded_at
+                self._cond.notify_all()
+        logging.info(f"MJPEG {self.name}: encoder thread stopped (no subscribers).")
+
+
+# --- Analysis Change Detection ---
+ANALYSIS_CHANGE_THRESHOLD = float(os.getenv("ANALYSIS_CHANGE_THRESHOLD", "0.02")) # Mean abs grey-level change (0-1) treated as "same scene"
+ANALYSIS_CACHE_MAX_AGE_SEC = float(os.getenv("ANALYSIS_CACHE_MAX_AGE_SEC", "30")) # Force a fresh AI call after this long
+CHANGE_SIGNATURE_SIZE = 32 # Signature is a CHANGE_SIGNATURE_SIZE^2 downscaled greyscale image
+
+def compute_change_signature(bgr_region):
+    """ Cheap scene signature: the region downscaled to a tiny greyscale image (float32, 0-1). """
+    step = max(1, min(bgr_region.shape[:2]) // (CHANGE_SIGNATURE_SIZE * 8)) # Subsample large regions before the area resize
+    small = cv2.resize(bgr_region[::step, ::step], (CHANGE_SIGNATURE_SIZE, CHANGE_SIGNATURE_SIZE), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255.0
+
+class ChangeDetectionCache:
+    """
+    Remembers the last successful analysis of a camera's crop region with its signature.
+    lookup() returns that result again while the region has changed less than the threshold
+    and the result is younger than the maximum age.
+    """
+    def __init__(self, threshold=ANALYSIS_CHANGE_THRESHOLD, max_age_sec=ANALYSIS_CACHE_MAX_AGE_SEC):
+        self.threshold = threshold; self.max_age_sec = max_age_sec
+        self._lock = threading.Lock()
+        self._signature = None; self._result = None; self._stored_at = 0.0
+        self.hits = 0; self.misses = 0; self.expired = 0 # expired = misses forced by max age
+
+    def lookup(self, signature):
+        """ Returns (cached_result_copy_or_None, change_score). """
+        with self._lock:
+            if self._signature is None or self._signature.shape != signature.shape:
+                self.misses += 1; return None, None
+            change = float(np.mean(np.abs(signature - self._signature)))
+            age = time.monotonic() - self._stored_at
+            if change >= self.threshold:
+                self.misses += 1; return None, change
+            if age >= self.max_age_sec:
+                self.misses += 1; self.expired += 1; return None, change
+            self.hits += 1
+            return {**self._result, "source": "cache", "cached": True, "cache_age_sec": round(age, 2), "change_score": round(change, 4)}, change
+
+    def store(self, signature, result):
+        with self._lock:
+            self._signature = signature; self._result = dict(result); self._stored_at = time.monotonic()
+
+    def clear(self):
+        with self._lock: self._signature = None; self._result = None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "expired": self.expired,
+                    "hitRate": round(self.hits / total, 3) if total else 0.0,
+                    "threshold": self.threshold, "maxAgeSec": self.max_age_sec}
+
+
+# --- Local Motion/Occupancy Pre-filter ---
+LOCAL_PREFILTER_ENABLED = os.getenv("LOCAL_PREFILTER", "0").lower() in ("1", "true", "yes")
+PREFILTER_FPS = float(os.getenv("PREFILTER_FPS", "5")) # Max background-subtraction updates per second
+PREFILTER_EMPTY_RATIO = float(os.getenv("PREFILTER_EMPTY_RATIO", "0.005")) # Foreground fraction below which the approach is "empty"
+PREFILTER_EMPTY_HOLD_SEC = float(os.getenv("PREFILTER_EMPTY_HOLD_SEC", "3")) # Must stay empty this long
+PREFILTER_WIDTH = 160 # Crop is downscaled to this width before subtraction
+
+class MotionPrefilter:
+    """
+    Background subtraction (MOG2) on the camera's downscaled crop region, updated from the capture
+    thread a few times per second. is_clearly_empty() is True only when the foreground stayed below
+    PREFILTER_EMPTY_RATIO for PREFILTER_EMPTY_HOLD_SEC AND the last AI result also saw no vehicles:
+    a vehicle that parks long enough to fade into the background model was then seen by the AI,
+    so the local shortcut stays off until the AI reports the approach clear again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._interval = 1.0 / PREFILTER_FPS if PREFILTER_FPS > 0 else 0.0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # Long history so stopped vehicles stay foreground for minutes rather than seconds
+            self._subtractor = cv2.createBackgroundSubtractorMOG2(history=int(max(PREFILTER_FPS, 1) * 600), varThreshold=25, detectShadows=True)
+            self._last_update = 0.0; self._samples = 0
+            self.foreground_ratio = 1.0 # Unknown until warmed up: treat as "something there"
+            self._non_empty_at = time.monotonic()
+            self.ai_saw_vehicles = True # Until the AI confirms an empty approach
+            self.local_answers = 0
+
+    def due(self):
+        """ True when process() would take a sample now, so callers can skip preparing the region. """
+        return time.monotonic() - self._last_update >= self._interval
+
+    def process(self, region):
+        """ Called from the capture thread with the crop view; rate-limited internally. """
+        now = time.monotonic()
+        if now - self._last_update < self._interval: return
+        self._last_update = now
+        h, w = region.shape[:2]
+        if w <= 0 or h <= 0: return
+        small = cv2.resize(region, (PREFILTER_WIDTH, max(1, int(h * PREFILTER_WIDTH / w))), interpolation=cv2.INTER_AREA)
+        with self._lock:
+            mask = self._subtractor.apply(small)
+            self._samples += 1
+            ratio = cv2.countNonZero(cv2.threshold(mask, 200, 255, cv2.THRESH_BINARY)[1]) / mask.size # Ignore shadows (127)
+            self.foreground_ratio = ratio if self._samples > PREFILTER_FPS * 2 else 1.0 # ~2s warm-up
+            if self.foreground_ratio >= PREFILTER_EMPTY_RATIO: self._non_empty_at = now
+
+    def note_ai_result(self, vehicles_present):
+        with self._lock: self.ai_saw_vehicles = vehicles_present
+
+    def is_clearly_empty(self):
+        with self._lock:
+            return (not self.ai_saw_vehicles and self.foreground_ratio < PREFILTER_EMPTY_RATIO
+                    and time.monotonic() - self._non_empty_at >= PREFILTER_EMPTY_HOLD_SEC)
+
+    def empty_result(self):
+        with self._lock:
+            self.local_answers += 1
+            return {"Vehicles_Present": "False", "Cars": 0, "Bikes": 0, "Trucks": 0, "Buses": 0, "Unknown": 0,
+                    "source": "local", "foreground_ratio": round(self.foreground_ratio, 5),
+                    "raw_response": f"Local pre-filter: approach empty (foreground {self.foreground_ratio:.4f})."}
+
+    def stats(self):
+        with self._lock:
+            return {"foregroundRatio": round(self.foreground_ratio, 5), "samples": self._samples,
+                    "aiSawVehicles": self.ai_saw_vehicles, "localAnswers": self.local_answers,
+                    "emptyRatio": PREFILTER_EMPTY_RATIO, "emptyHoldSec": PREFILTER_EMPTY_HOLD_SEC}
+
+
+# --- Clip Buffer (memory-mapped pre/post-event recording) ---
+CLIP_BUFFER_MB = float(os.getenv("CLIP_BUFFER_MB", "64")) # Per-camera segment file size (0 = disabled)
+CLIP_BUFFER_SECONDS = float(os.getenv("CLIP_BUFFER_SECONDS", "60")) # Frames older than this are not exported
+CLIP_BUFFER_DIR = os.getenv("CLIP_BUFFER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "clips"))
+CLIP_FPS = float(os.getenv("CLIP_FPS", "10")) # Recorded frames per second (at most the capture rate)
+CLIP_JPEG_QUALITY = int(os.getenv("CLIP_JPEG_QUALITY", str(STREAM_JPEG_QUALITY))) # Same as the default stream, so the encode is shared
+CLIP_MAX_WIDTH = int(os.getenv("CLIP_MAX_WIDTH", "0")) # 0 = full size
+CLIP_MAX_POST_SEC = 30.0 # Longest an export waits for post-event frames
+
+def jpeg_size(data):
+    """ (width, height) from a JPEG's SOF header, or (0, 0). Scans marker segments only, never decodes. """
+    i, end = 2, min(len(data), 65536)
+    while i + 9 <= end and data[i] == 0xFF:
+        marker = data[i + 1]
+        if marker == 0xFF: i += 1; continue # Fill byte
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[i + 7] << 8) | data[i + 8], (data[i + 5] << 8) | data[i + 6]
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return 0, 0
+
+class ClipBuffer:
+    """
+    Rolling recording of one camera's full stream as JPEG frames in a memory-mapped segment file:
+    a header page, a fixed array of index entries (seq, wall time, position, length, size) and a
+    circular data region. A recorder thread subscribes to the camera's full StreamBroadcaster like
+    any client, so the bytes it stores are the ones already encoded for viewers (or the camera's own
+    JPEG in passthrough mode); nothing is encoded again. Each frame is one memcpy into the map.
+
+    Data positions are logical byte offsets that only grow (physical = position % data size; a frame
+    that would straddle the end starts again at 0), so an entry is still intact while its position is
+    within one data size of the write head. The file is MAP_SHARED, so a restart reopens the same
+    buffer and exports keep working; size changes in the configuration start a fresh file.
+    """
+    MAGIC = b"TSCLIP01"
+    HEADER = struct.Struct("<8sIIQQQ") # magic, version, index slots, data size, next seq, head position
+    HEADER_SIZE = mmap.PAGESIZE
+    INDEX_DTYPE = np.dtype([("seq", "<u8"), ("ts", "<f8"), ("pos", "<u8"), ("length", "<u4"), ("width", "<u2"), ("height", "<u2")])
+
+    def __init__(self, cam_id, size_mb=CLIP_BUFFER_MB, seconds=CLIP_BUFFER_SECONDS, fps=CLIP_FPS, directory=CLIP_BUFFER_DIR):
+        self.cam_id = cam_id
+        self.path = os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", cam_id) + ".clipring")
+        self.seconds = seconds; self.fps = fps
+        self.data_size = int(size_mb * 1024 * 1024)
+        self.slots = max(1024, int(seconds * fps * 2)) # Room for the retention window even with tiny frames
+        index_bytes = self.slots * self.INDEX_DTYPE.itemsize
+        self.data_offset = self.HEADER_SIZE + -(-index_bytes // mmap.PAGESIZE) * mmap.PAGESIZE
+        self._mm = None; self._index = None
+        self._next_seq = 0; self._head = 0
+        self._reserved = 0 # End of the bytes being written; readers treat anything it laps as overwritten
+        self._cond = threading.Condition() # Notified on every append (post-event exports wait on it)
+        self._thread = None; self._stop = threading.Event()
+        self._stream = None
+        self._metric_frames = CLIP_FRAMES.labels(camera=cam_id)
+
+    # --- Segment file ---
+    def _open(self):
+        """ Maps the segment file, reusing its contents when the layout matches. Caller holds _cond. """
+        if self._mm is not None: return True
+        total = self.data_offset + self.data_size
         try:
-            logging.info(f"Attempting to set resolution: {target_width}x{target_height}...");
-            # Attempt to set resolution
-            res_set_w = camera_device.set(cv2.CAP_PROP_FRAME_WIDTH, target_width)
-            res_set_h = camera_device.set(cv2.CAP_PROP_FRAME_HEIGHT, target_height)
-            if not res_set_w or not res_set_h:
-                logging.warning("Setting resolution properties returned false. Camera might not support it.")
-            # Give camera time to potentially adjust
-            time.sleep(0.5)
-            # Verify actual resolution
-            actual_width=int(camera_device.get(cv2.CAP_PROP_FRAME_WIDTH))
-            actual_height=int(camera_device.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            logging.info(f"Actual resolution after attempting set: {actual_width}x{actual_height}")
-            if actual_width != target_width or actual_height != target_height:
-                 logging.warning(f"Camera did not accept target resolution. Using {actual_width}x{actual_height}.")
-        except Exception as e:
-            logging.error(f"Error setting resolution: {e}")
-    else:
-        logging.info(f"Using camera's default resolution: {int(camera_device.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(camera_device.get(cv2.CAP_PROP_FRAME_HEIGHT))}")
-
-    is_camera_running = True
-    with output_frame_lock:
-        output_frame = None # Clear any stale frame
-    camera_thread = threading.Thread(target=capture_frames_loop, name="CameraCaptureThread");
-    camera_thread.daemon = True; # Allows app to exit even if thread is running
-    camera_thread.start()
-    logging.info("Camera process started (capture thread running).")
-    return True
-
-def stop_camera_process():
-    """ Signals thread, waits, releases device. Requires camera_start_lock. """
-    global is_camera_running, camera_device, camera_thread, output_frame
-    if not is_camera_running and camera_device is None and (camera_thread is None or not camera_thread.is_alive()):
-        logging.info("stop_camera_process: Camera already stopped or not running.")
-        return # Nothing to do
-
-    logging.info("--- Executing stop_camera_process ---")
-    # Signal the thread to stop
-    is_camera_running = False
-
-    thread_to_join = camera_thread
-    if thread_to_join is not None and thread_to_join.is_alive():
-        logging.info("Waiting for camera capture thread to join...")
-        thread_to_join.join(timeout=2.0) # Wait for up to 2 seconds
-        if thread_to_join.is_alive():
-            logging.warning("Camera capture thread did not join within timeout.")
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                reuse = os.fstat(fd).st_size == total
+                if not reuse: os.ftruncate(fd, 0); os.ftruncate(fd, total) # Sparse: disk fills as frames arrive
+                self._mm = mmap.mmap(fd, total)
+            finally: os.close(fd)
+        except OSError as e:
+            logging.error(f"Clip buffer {self.cam_id}: cannot map {self.path}: {e}"); return False
+        self._index = np.ndarray((self.slots,), dtype=self.INDEX_DTYPE, buffer=self._mm, offset=self.HEADER_SIZE)
+        magic, version, slots, data_size, next_seq, head = self.HEADER.unpack_from(self._mm, 0)
+        if reuse and magic == self.MAGIC and version == 1 and slots == self.slots and data_size == self.data_size:
+            self._next_seq, self._head = next_seq, head
+            logging.info(f"Clip buffer {self.cam_id}: reopened {self.path} ({self.frame_count()} frames kept).")
         else:
-            logging.info("Camera capture thread joined successfully.")
-        camera_thread = None
-    elif thread_to_join is not None:
-         logging.info("Camera capture thread was already finished.")
-         camera_thread = None
-    else:
-         logging.info("No camera capture thread object existed.")
+            self._index[:] = np.zeros(1, dtype=self.INDEX_DTYPE); self._next_seq = 1; self._head = 0
+            self._write_header()
+            logging.info(f"Clip buffer {self.cam_id}: created {self.path} ({self.data_size // (1024 * 1024)} MB).")
+        self._reserved = self._head
+        return True
+
+    def _write_header(self):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, 1, self.slots, self.data_size, self._next_seq, self._head)
+
+    def append(self, jpeg, timestamp):
+        """ Stores one JPEG captured at `timestamp` (epoch seconds). Data first, then index, then header. """
+        length = len(jpeg)
+        with self._cond:
+            if not self._open() or not length or length > self.data_size: return False
+            pos = self._head; phys = pos % self.data_size
+            if phys + length > self.data_size: pos += self.data_size - phys; phys = 0
+            self._reserved = pos + length
+            start = self.data_offset + phys
+            self._mm[start:start + length] = jpeg
+            width, height = jpeg_size(jpeg)
+            seq = self._next_seq
+            self._index[seq % self.slots] = (seq, timestamp, pos, length, min(width, 65535), min(height, 65535))
+            self._next_seq = seq + 1; self._head = pos + length
+            self._write_header()
+            self._cond.notify_all()
+        self._metric_frames.inc()
+        return True
+
+    def flush(self):
+        with self._cond:
+            if self._mm is not None: self._mm.flush()
+
+    # --- Reading ---
+    def _valid(self, entries):
+        """ Mask of entries whose bytes have not been (or are not being) overwritten. """
+        return (entries["seq"] > 0) & (entries["pos"] + self.data_size >= self._reserved)
+
+    def entries(self, start, end):
+        """ Intact frames captured in [start, end] and within the retention window, oldest first (a NumPy copy of the index). """
+        with self._cond:
+            if self._mm is None and not (os.path.exists(self.path) and self._open()): return np.zeros(0, dtype=self.INDEX_DTYPE)
+            entries = self._index.copy()
+        newest = entries["ts"].max() if len(entries) else 0
+        entries = entries[self._valid(entries) & (entries["ts"] >= max(start, newest - self.seconds)) & (entries["ts"] <= end)]
+        return entries[np.argsort(entries["seq"])]
+
+    def read(self, entry):
+        """ The frame's bytes, or None if the writer has overwritten them meanwhile. """
+        phys = self.data_offset + int(entry["pos"]) % self.data_size
+        data = self._mm[phys:phys + int(entry["length"])]
+        return data if self._valid(entry) else None # Checked after the copy: a lapped copy is discarded
+
+    def wait_until(self, timestamp, timeout):
+        """ Blocks until a frame captured at or after `timestamp` is stored (post-event exports). """
+        def reached():
+            if self._mm is None or self._next_seq <= 1: return False
+            return self._index[(self._next_seq - 1) % self.slots]["ts"] >= timestamp
+        with self._cond: return self._cond.wait_for(reached, timeout=timeout)
+
+    def frame_count(self):
+        return int(np.count_nonzero(self._valid(self._index))) if self._index is not None else 0
+
+    def stats(self):
+        entries = self.entries(0, float("inf"))
+        return {"recording": self._thread is not None and self._thread.is_alive(), "path": self.path,
+                "budgetBytes": self.data_size, "fps": self.fps, "retentionSec": self.seconds, "frames": len(entries),
+                "bytes": int(entries["length"].sum()) if len(entries) else 0,
+                "oldest": float(entries["ts"][0]) if len(entries) else None, "newest": float(entries["ts"][-1]) if len(entries) else None}
+
+    # --- Recorder ---
+    def start(self, stream):
+        """ Starts recording from a StreamBroadcaster (the camera's full stream). """
+        if self._thread is not None and self._thread.is_alive(): return
+        self._stream = stream; self._stop.clear()
+        self._thread = threading.Thread(target=self._record_loop, name=f"ClipRecorder-{self.cam_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join(timeout=2.0); self._thread = None
+        self.flush()
+
+    def _record_loop(self):
+        client = self._stream.subscribe(stream_variant(CLIP_JPEG_QUALITY, CLIP_MAX_WIDTH))
+        logging.info(f"Clip buffer {self.cam_id}: recording at up to {self.fps:g} fps.")
+        interval = 1.0 / self.fps if self.fps > 0 else 0.0
+        encoded_seq = 0; last_captured = None
+        try:
+            while not self._stop.is_set():
+                encoded_seq, frame_bytes, info = self._stream.wait_for_frame(client, encoded_seq, timeout=0.5)
+                if frame_bytes is None: continue
+                captured_at = info[1]
+                if last_captured is not None and captured_at - last_captured < interval * 0.9: continue
+                last_captured = captured_at
+                if self.append(frame_bytes, time.time() - (time.monotonic() - captured_at)): client.frames_sent += 1
+        except Exception as e:
+            logging.error(f"Clip buffer {self.cam_id}: recorder failed: {e}", exc_info=True)
+        finally:
+            self._stream.unsubscribe(client)
 
-    # Release the camera device
-    device_to_release = camera_device
-    if device_to_release is not None:
-        if device_to_release.isOpened():
+def avi_mjpeg_chunks(clips, entries):
+    """
+    Streams `entries` of a ClipBuffer as an MJPEG AVI (RIFF header, one '00dc' chunk per frame, idx1).
+    All sizes are known from the index, so the total length is returned up front for Content-Length.
+    A frame overwritten while the export is running is replaced by a black frame of the same size.
+    """
+    count = len(entries)
+    lengths = entries["length"].astype(np.int64); padded = lengths + (lengths & 1)
+    width, height = int(entries["width"][0]), int(entries["height"][0])
+    span = float(entries["ts"][-1] - entries["ts"][0])
+    fps = (count - 1) / span if count > 1 and span > 0 else clips.fps or 1.0
+    movi_size = 4 + int((8 + padded).sum())
+    strl = (b"strh" + struct.pack("<I4s4sIHHIIIIIIIIhhhh", 56, b"vids", b"MJPG", 0, 0, 0, 0, 1000, int(round(fps * 1000)), 0, count,
+                                   int(lengths.max()), 0xFFFFFFFF, 0, 0, 0, width, height)
+            + b"strf" + struct.pack("<IIiiHH4sIiiII", 40, 40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0))
+    hdrl = (b"avih" + struct.pack("<I10I4I", 56, int(1e6 / fps), int(lengths.mean() * fps), 0, 0x10, count, 0, 1, int(lengths.max()), width, height, 0, 0, 0, 0)
+            + b"LIST" + struct.pack("<I", 4 + len(strl)) + b"strl" + strl)
+    riff_size = 4 + (8 + 4 + len(hdrl)) + (8 + movi_size) + (8 + 16 * count)
+    def generate():
+        yield (b"RIFF" + struct.pack("<I", riff_size) + b"AVI " + b"LIST" + struct.pack("<I", 4 + len(hdrl)) + b"hdrl" + hdrl
+               + b"LIST" + struct.pack("<I", movi_size) + b"movi")
+        lost = 0; black = None
+        for entry, length in zip(entries, lengths):
+            data = clips.read(entry)
+            if data is None:
+                lost += 1
+                if black is None: black = cv2.imencode(".jpg", np.zeros((max(height, 8), max(width, 8), 3), np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 10])[1].tobytes()
+                data = black[:length] + bytes(max(0, int(length) - len(black))) # Trailing zeros after EOI are ignored by decoders
+            yield b"00dc" + struct.pack("<I", int(length)) + data + (b"\0" if length & 1 else b"")
+        offsets = np.concatenate(([4], 4 + np.cumsum(8 + padded)[:-1])).astype("<u4")
+        index = np.zeros(count, dtype=[("id", "S4"), ("flags", "<u4"), ("offset", "<u4"), ("size", "<u4")])
+        index["id"] = b"00dc"; index["flags"] = 0x10; index["offset"] = offsets; index["size"] = lengths # AVIIF_KEYFRAME
+        yield b"idx1" + struct.pack("<I", 16 * count) + index.tobytes()
+        if lost: logging.warning(f"Clip export {clips.cam_id}: {lost} frames were overwritten during the export.")
+    return riff_size + 8, generate()
+
+
+# --- Camera Pipeline ---
+CAPTURE_RECONNECT = os.getenv("CAPTURE_RECONNECT", "1").lower() not in ("0", "false", "no") # Reopen lost devices
+CAPTURE_MJPEG_PASSTHROUGH = os.getenv("CAPTURE_MJPEG_PASSTHROUGH", "0").lower() in ("1", "true", "yes") # Keep the camera's JPEG bytes
+
+def camera_jpeg_bytes(frame):
+    """ The JPEG bytes of a raw (CAP_PROP_CONVERT_RGB=0) MJPEG read, or None if the backend decoded the frame anyway. """
+    if frame is None or frame.dtype != np.uint8 or frame.ndim > 2 or (frame.ndim == 2 and frame.shape[0] != 1): return None
+    data = frame.reshape(-1)
+    if data.size < 4 or data[0] != 0xFF or data[1] != 0xD8: return None # JPEG SOI marker
+    return data.tobytes()
+
+class Camera:
+    """
+    One capture pipeline: device, capture thread, frame ring and its two stream broadcasters.
+    Every camera has its own locks and ring, so N cameras run on N independent threads
+    (OpenCV releases the GIL while reading and encoding) and never contend with each other.
+    """
+    def __init__(self, cam_id, source="auto", resolution="default", crop_area=None):
+        self.cam_id = cam_id
+        # Source spec (see "Frame Sources"), resolution, crop area and named analysis regions (see "Multi-Region Composite").
+        # Replaced as a whole by on_settings_changed(); build_camera_registry() swaps in the saved settings.
+        self.config = CameraConfig.from_settings(0, {"source": source, "resolution": resolution, **({"cropArea": crop_area} if crop_area else {})})
+        self._config_lock = threading.Lock() # Serializes swapping in a new config with binding it to the frame size
+        self.device = None
+        self.thread = None
+        self.is_running = False
+        self.state = "stopped" # stopped | running | reconnecting
+        self.reconnect_attempts = 0
+        self.passthrough = False # Device delivers raw MJPEG bytes (CAPTURE_MJPEG_PASSTHROUGH)
+        self.capture_segment = None # Set by CaptureProcesses: read frames from this shared-memory segment instead of the source
+        self._stop_event = threading.Event() # Interrupts reconnect back-off waits
+        self.start_lock = threading.Lock() # Serializes start/stop for THIS camera only
+        self.ring = FrameRing(name=cam_id)
+        self.stream_full = StreamBroadcaster(f"{cam_id}/full", self.ring)
+        self.stream_cropped = StreamBroadcaster(f"{cam_id}/cropped", self.ring, transform=self.crop_frame)
+        self.analysis_cache = ChangeDetectionCache()
+        self.prefilter = MotionPrefilter() if LOCAL_PREFILTER_ENABLED else None
+        self.clips = ClipBuffer(cam_id) if CLIP_BUFFER_MB > 0 else None
+        self.metric_frames = CAPTURE_FRAMES.labels(camera=cam_id)
+        self.metric_interval = CAPTURE_FRAME_INTERVAL.labels(camera=cam_id)
+        self.metric_read_failures = CAPTURE_READ_FAILURES.labels(camera=cam_id)
+        self.metric_reconnects = CAPTURE_RECONNECTS.labels(camera=cam_id)
+
+    def config_for(self, frame):
+        """ The current config with its pixel slices bound to this frame's size (rebound once after a resolution change). """
+        config = self.config
+        if config.frame_size != frame.shape[:2]:
+            with self._config_lock:
+                if self.config.frame_size != frame.shape[:2]: self.config = self.config.for_frame_size(frame.shape[:2])
+                config = self.config
+        return config
+
+    def crop_frame(self, frame):
+        return self.config_for(frame).crop(frame)
+
+    def on_settings_changed(self, old, new):
+        """ SettingsStore subscriber: swaps in this camera's new config and drops state tied to the old crop area. """
+        config = new.cameras.get(self.cam_id); previous = old.cameras.get(self.cam_id)
+        if config is None or config is previous: return
+        with self._config_lock:
+            self.config = config.for_frame_size(self.config.frame_size) if self.config.frame_size else config
+        if previous is None or (config.crop_area, config.regions) != (previous.crop_area, previous.regions):
+            self.analysis_cache.clear() # The crop region may have moved
+            if self.prefilter is not None: self.prefilter.reset()
+
+    def _set_state(self, state):
+        """ Changes `state` and announces it on the event bus. """
+        if state == self.state: return
+        self.state = state
+        event_bus.publish("camera", self.status())
+
+    def status(self):
+        return {"id": self.cam_id, "isRunning": self.is_running, "state": self.state, "reconnectAttempts": self.reconnect_attempts,
+                "passthrough": self.passthrough, "captureSegment": self.capture_segment, "settingsVersion": self.config.version, **self.config.as_settings()}
+
+    # --- Camera Capture Thread ---
+    def capture_frames_loop(self):
+        logging.info(f"Camera {self.cam_id}: capture thread starting.")
+        frame_count = 0; start_time_capture = time.time()
+        ring = self.ring; last_publish = None
+        while self.is_running:
+            device = self.device
+            if not device or not device.isOpened():
+                logging.warning(f"Capture {self.cam_id}: Camera lost.")
+                if self.reconnect(): continue
+                break
             try:
-                logging.info("Releasing camera device...")
-                device_to_release.release()
-                logging.info("Camera device released.")
+                jpeg = None; shared = isinstance(device, SharedMemorySource)
+                if shared:
+                    # A capture process's slot, read in place: the ring only references it
+                    slot = buffer = None
+                    ret, frame = device.read_view()
+                elif self.passthrough:
+                    # Keep the camera's compressed frame; nothing is decoded here
+                    slot = buffer = None
+                    ret, frame = grab_frame(device)
+                    if ret: jpeg = camera_jpeg_bytes(frame)
+                    if ret and jpeg is None:
+                        logging.warning(f"Camera {self.cam_id}: backend returned decoded frames, MJPEG passthrough disabled.")
+                        self.passthrough = False
+                else:
+                    # Decode straight into the next preallocated slot (no per-frame allocation or copy)
+                    slot, buffer = ring.begin_write() if ring.shape is not None else (None, None)
+                    ret, frame = grab_frame(device, buffer)
+                if not ret:
+                    self.metric_read_failures.inc(); logging.warning(f"Capture {self.cam_id}: Frame read fail.")
+                    if self.reconnect(): continue
+                    break
+                if jpeg is not None:
+                    ring.publish_jpeg(jpeg, time.monotonic())
+                elif shared:
+                    ring.publish_view(frame, device.captured_at, device.jpeg, device.validity_check()) # Capture process's time and JPEG
+                else:
+                    if frame is not buffer:
+                        # First frame, or the backend returned its own array (e.g. resolution changed): size the ring for it
+                        if ring.shape != frame.shape: ring.allocate(frame.shape, frame.dtype)
+                        slot, buffer = ring.begin_write(); np.copyto(buffer, frame)
+                    ring.publish(slot, time.monotonic())
+                frame_count += 1
+                now = time.perf_counter()
+                if last_publish is not None: self.metric_interval.observe(now - last_publish)
+                last_publish = now; self.metric_frames.inc()
+                # In passthrough mode this decodes only when the pre-filter is due for a sample
+                if self.prefilter is not None and self.prefilter.due():
+                    frame = ring.latest().frame
+                    if frame is not None: self.prefilter.process(self.crop_frame(frame))
             except Exception as e:
-                logging.error(f"Exception occurred while releasing camera device: {e}", exc_info=True)
+                logging.error(f"Capture {self.cam_id} error: {e}")
+                if self.reconnect(): continue
+                break
+        duration = time.time() - start_time_capture; fps = frame_count / duration if duration > 0 else 0
+        logging.info(f"Camera {self.cam_id}: capture thread finished. {frame_count} frames (~{fps:.1f} FPS).")
+        self._set_state("stopped")
+        ring.release()
+
+    def reconnect(self):
+        """
+        Runs on the capture thread after a failed read: releases the device and reopens it with exponential
+        back-off until it works (True) or the camera is stopped (False). Streams show the "reconnecting"
+        placeholder meanwhile. With CAPTURE_RECONNECT=0 the camera just stops, as before.
+        """
+        if not CAPTURE_RECONNECT or not self.is_running:
+            self.is_running = False; return False
+        self._set_state("reconnecting"); self.metric_reconnects.inc()
+        self.release_device()
+        delay = CAPTURE_RECONNECT_INITIAL_SEC; self.reconnect_attempts = 0
+        while self.is_running:
+            self.reconnect_attempts += 1
+            logging.warning(f"Camera {self.cam_id}: reconnecting in {delay:.1f}s (attempt {self.reconnect_attempts}).")
+            if self._stop_event.wait(delay): break
+            device = self.open_configured_device()
+            if device is not None:
+                if not self.is_running: device.release(); break # Stopped while opening
+                self.device = device; self._set_state("running")
+                logging.info(f"Camera {self.cam_id}: reconnected after {self.reconnect_attempts} attempt(s).")
+                return True
+            delay = min(delay * 2, CAPTURE_RECONNECT_MAX_SEC)
+        return False
+
+    # --- Camera Start/Stop Logic ---
+    def open_configured_device(self):
+        """ Opens the configured source (or its capture process's segment) with the resolution setting. Returns the device or None. """
+        source = f"shm:{self.capture_segment}" if self.capture_segment else self.config.source
+        passthrough = CAPTURE_MJPEG_PASSTHROUGH and not self.capture_segment # Segments hold decoded pixels
+        device, self.passthrough = open_configured_device(source, self.config.resolution, f"Camera {self.cam_id}", passthrough)
+        return device
+
+    def release_device(self):
+        device, self.device = self.device, None
+        if device is not None:
+            try: device.release()
+            except Exception as e: logging.error(f"Camera {self.cam_id}: error releasing device: {e}")
+
+    def start(self):
+        """ Opens camera, attempts resolution, starts thread. Requires self.start_lock. """
+        if self.is_running: logging.warning(f"start_camera {self.cam_id}: already running."); return True
+        logging.info(f"Attempting start camera device {self.cam_id}...")
+        self.device = self.open_configured_device()
+        if self.device is None:
+            logging.error(f"Camera {self.cam_id}: cannot open any camera device.")
+            return False
+
+        self.is_running = True; self.reconnect_attempts = 0; self._set_state("running")
+        self._stop_event.clear()
+        self.ring.release() # Clear any stale frame
+        if self.prefilter is not None: self.prefilter.reset() # New scene / resolution
+        self.thread = threading.Thread(target=self.capture_frames_loop, name=f"CameraCaptureThread-{self.cam_id}")
+        self.thread.daemon = True # Allows app to exit even if thread is running
+        self.thread.start()
+        if self.clips is not None: self.clips.start(self.stream_full)
+        logging.info(f"Camera {self.cam_id}: process started (capture thread running).")
+        return True
+
+    def stop(self):
+        """ Signals thread, waits, releases device. Requires self.start_lock. """
+        if not self.is_running and self.device is None and (self.thread is None or not self.thread.is_alive()):
+            logging.info(f"stop_camera {self.cam_id}: Camera already stopped or not running.")
+            return # Nothing to do
+
+        logging.info(f"--- Executing stop for camera {self.cam_id} ---")
+        # Signal the thread to stop (and wake it from a reconnect back-off)
+        self.is_running = False; self._set_state("stopped")
+        self._stop_event.set()
+
+        thread_to_join = self.thread
+        if thread_to_join is not None and thread_to_join.is_alive():
+            logging.info("Waiting for camera capture thread to join...")
+            thread_to_join.join(timeout=2.0) # Wait for up to 2 seconds
+            if thread_to_join.is_alive():
+                logging.warning("Camera capture thread did not join within timeout.")
+            else:
+                logging.info("Camera capture thread joined successfully.")
+        self.thread = None
+
+        # Release the camera device
+        device_to_release = self.device
+        if device_to_release is not None:
+            if device_to_release.isOpened():
+                try:
+                    logging.info("Releasing camera device...")
+                    device_to_release.release()
+                    logging.info("Camera device released.")
+                except Exception as e:
+                    logging.error(f"Exception occurred while releasing camera device: {e}", exc_info=True)
+            else:
+                logging.info("Camera device object existed but was already closed.")
+            self.device = None
         else:
-            logging.info("Camera device object existed but was already closed.")
-        camera_device = None
-    else:
-        logging.info("No camera device object existed to release.")
+            logging.info("No camera device object existed to release.")
+
+        if self.clips is not None: self.clips.stop() # Flushes the segment file
 
-    # Clear the output frame
-    with output_frame_lock:
-        output_frame = None
-    logging.info("--- Finished stop_camera_process ---")
+        # Clear the published frame
+        self.ring.release()
+        logging.info(f"--- Finished stop for camera {self.cam_id} ---")
 
 
 # --- MJPEG Stream Generators ---
-def generate_mjpeg_stream_full():
+STREAM_PLACEHOLDER_INTERVAL_SEC = 2.0 # While stopped, re-send the placeholder this often (detects closed sockets)
+
+def generate_mjpeg_stream(camera, broadcaster, rate=None):
+    """
+    Generator function yielding MJPEG stream frames from a shared broadcaster, or the placeholder.
+    Only frames the client has not seen are sent (by encode sequence), paced at the client's FPS.
+    The time each yield takes is fed to `rate` (AdaptiveStreamRate) to back off stalled clients.
+    """
+    global placeholder_frame, reconnecting_frame
+    rate = rate or AdaptiveStreamRate()
+    client = broadcaster.subscribe(rate.variant())
+    last_seq = 0; last_yield = 0.0; last_placeholder = 0.0
+    try:
+        while True:
+            client.fps = rate.fps
+            delay = rate.frame_interval - (time.monotonic() - last_yield)
+            if delay > 0: time.sleep(delay)
+            content_type = 'image/jpeg'; timing_headers = b''
+            live = camera.is_running and camera.state == "running"
+            if live:
+                seq, frame_bytes, meta = broadcaster.wait_for_frame(client, last_seq, timeout=1.0)
+                if frame_bytes is None: continue # No new frame since the last one sent: never re-send duplicates
+                if last_seq and seq > last_seq + 1: client.frames_dropped += seq - last_seq - 1
+                last_seq = seq
+                frame_seq, captured_at, encoded_at = meta
+                # Per-frame latency: capture -> encode done, and capture -> handed to this client's socket
+                timing_headers = (f"X-Frame-Seq: {frame_seq}\r\nX-Capture-To-Encode-Ms: {(encoded_at - captured_at) * 1000:.1f}\r\n"
+                                  f"X-Capture-To-Send-Ms: {(time.monotonic() - captured_at) * 1000:.1f}\r\n").encode()
+            else:
+                if time.monotonic() - last_placeholder < STREAM_PLACEHOLDER_INTERVAL_SEC:
+                    time.sleep(0.2); continue
+                last_placeholder = time.monotonic(); last_seq = 0
+                image = reconnecting_frame if camera.is_running else placeholder_frame # Running but not live = reconnecting
+                frame_bytes = image if image else b''
+                # Use GIF for empty bytes to avoid browser issues, else JPEG
+                content_type = 'image/gif' if not image else 'image/jpeg'
+            write_start = time.monotonic()
+            yield (b'--frame\r\nContent-Type: '+content_type.encode()+b'\r\nContent-Length: '+f"{len(frame_bytes)}".encode()+b'\r\n'+timing_headers+b'\r\n'+frame_bytes+b'\r\n')
+            last_yield = time.monotonic()
+            client.frames_sent += 1
+            if live and rate.record_write(last_yield - write_start):
+                broadcaster.set_variant(client, rate.variant()); last_seq = 0
+    except GeneratorExit:
+        logging.debug(f"MJPEG {broadcaster.name} stream generator closed by client.")
+    except Exception as e:
+        logging.warning(f"MJPEG {broadcaster.name} yield error: {e}")
+    finally:
+        broadcaster.unsubscribe(client)
+
+def generate_mjpeg_stream_full(camera, rate=None):
     """ Generator function yielding FULL MJPEG stream frames or placeholder. """
-    global output_frame, is_camera_running, placeholder_frame
-    last_yield = 0; target_delay = 1.0 / 20 # Target ~20 FPS stream
-    while True:
-        now = time.time(); delay = target_delay - (now - last_yield)
-        if delay > 0: time.sleep(delay)
-        last_yield = time.time()
-        frame_bytes = None; content_type = 'image/jpeg'
-        if is_camera_running:
-            frame = None # Initialize frame variable for this iteration
-            with output_frame_lock: # 'with' starts on a new line
-                 if output_frame is not None:
-                    frame = output_frame.copy() # Work on a copy
-                 else:
-                     frame = None
-            if frame is not None:
-                flag, enc = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 80]) # Stream quality
-                if flag: frame_bytes = enc.tobytes()
-                else: logging.warning("MJPEG Full: Encode fail.")
-        if frame_bytes is None:
-            frame_bytes = placeholder_frame if placeholder_frame else b''
-            # Use GIF for empty bytes to avoid browser issues, else JPEG
-            content_type = 'image/gif' if not placeholder_frame else 'image/jpeg'
-        try:
-            yield (b'--frame\r\nContent-Type: '+content_type.encode()+b'\r\nContent-Length: '+f"{len(frame_bytes)}".encode()+b'\r\n\r\n'+frame_bytes+b'\r\n')
-        except GeneratorExit:
-            logging.debug("MJPEG Full stream generator closed by client.")
-            break # Exit loop cleanly if client disconnects
-        except Exception as e:
-            logging.warning(f"MJPEG Full yield error: {e}");
-            break # Exit on other errors
+    return generate_mjpeg_stream(camera, camera.stream_full, rate)
 
-def generate_mjpeg_stream_cropped():
+def generate_mjpeg_stream_cropped(camera, rate=None):
     """ Generator function yielding CROPPED MJPEG stream frames or placeholder. """
-    global output_frame, is_camera_running, placeholder_frame, app_settings
-    last_yield = 0; target_delay = 1.0 / 20
-    while True:
-        now = time.time(); delay = target_delay - (now - last_yield)
-        if delay > 0: time.sleep(delay)
-        last_yield = time.time()
-        frame_bytes = None; content_type = 'image/jpeg'
-        if is_camera_running:
-            full_frame = None # Initialize variable for this iteration
-            with output_frame_lock: # 'with' starts on a new line
-                if output_frame is not None:
-                     full_frame = output_frame.copy() # Work on a copy
-                else:
-                     full_frame = None
-            if full_frame is not None:
-                frame_to_encode = full_frame
-                try: # Apply crop using OpenCV Slicing
-                    crop = app_settings.get("cropArea", {}); img_h, img_w = full_frame.shape[:2]
-                    if img_h > 0 and img_w > 0: # Ensure valid dimensions before cropping
-                        # Use get with defaults and ensure float conversion
-                        cx = float(crop.get("x", 0.0)); cy = float(crop.get("y", 0.0));
-                        cw = float(crop.get("w", 1.0)); ch = float(crop.get("h", 1.0));
-                        # Validate crop values (allow slight float tolerance)
-                        valid = (0.0 <= cx <= 1.0 and 0.0 <= cy <= 1.0 and
-                                 0.0 < cw <= 1.0 and 0.0 < ch <= 1.0 and
-                                 (cx + cw) <= 1.001 and (cy + ch) <= 1.001)
-                        # Check if it's effectively the full image
-                        not_full = not (abs(cw - 1.0) < 1e-6 and abs(ch - 1.0) < 1e-6 and
-                                        abs(cx - 0.0) < 1e-6 and abs(cy - 0.0) < 1e-6)
-
-                        if valid and not_full:
-                            # Calculate pixel coordinates safely
-                            y1 = int(cy * img_h); y2 = min(int((cy + ch) * img_h), img_h)
-                            x1 = int(cx * img_w); x2 = min(int((cx + cw) * img_w), img_w)
-                            # Ensure calculated area is valid
-                            if y2 > y1 and x2 > x1:
-                                logging.debug(f"MJPEG Crop applied: y={y1}:{y2}, x={x1}:{x2}")
-                                frame_to_encode = full_frame[y1:y2, x1:x2]
-                            else:
-                                logging.warning(f"MJPEG Crop: Calculated zero area ({y1}:{y2}, {x1}:{x2}). Using full frame.")
-                        elif not valid:
-                             logging.warning(f"MJPEG Crop: Invalid crop values {crop}. Using full frame.")
-                    else:
-                         logging.warning("MJPEG Crop: Invalid frame dimensions received. Cannot crop.")
+    return generate_mjpeg_stream(camera, camera.stream_cropped, rate)
 
-                except Exception as e:
-                     logging.error(f"MJPEG Crop error processing frame: {e}", exc_info=True)
-                     frame_to_encode = full_frame # Fallback to full frame on error
-
-                # Encode the potentially cropped frame
-                flag, enc = cv2.imencode(".jpg", frame_to_encode, [cv2.IMWRITE_JPEG_QUALITY, 80])
-                if flag: frame_bytes = enc.tobytes()
-                else: logging.warning("MJPEG Crop: Encode fail.")
-        if frame_bytes is None:
-            frame_bytes = placeholder_frame if placeholder_frame else b''
-            content_type = 'image/gif' if not placeholder_frame else 'image/jpeg'
-        try:
-             yield (b'--frame\r\nContent-Type: '+content_type.encode()+b'\r\nContent-Length: '+f"{len(frame_bytes)}".encode()+b'\r\n\r\n'+frame_bytes+b'\r\n')
-        except GeneratorExit:
-            logging.debug("MJPEG Cropped stream generator closed by client.")
-            break # Exit loop cleanly if client disconnects
-        except Exception as e:
-             logging.warning(f"MJPEG Crop yield error: {e}");
-             break # Exit on other errors
+def stream_rate_from_args(args):
+    """ Builds the client's AdaptiveStreamRate from ?fps=&quality=&max_width=. Raises ValueError on bad values. """
+    fps = args.get("fps", default=STREAM_TARGET_FPS, type=float)
+    quality = args.get("quality", default=STREAM_JPEG_QUALITY, type=int)
+    max_width = args.get("max_width", default=0, type=int)
+    if fps is None or not 0.5 <= fps <= STREAM_MAX_FPS: raise ValueError(f"'fps' must be between 0.5 and {STREAM_MAX_FPS}.")
+    if quality is None or not 10 <= quality <= 100: raise ValueError("'quality' must be between 10 and 100.")
+    if max_width is None or max_width < 0: raise ValueError("'max_width' must be 0 (full size) or a positive width.")
+    return AdaptiveStreamRate(fps, quality, max_width)
 
 
 # --- Application Settings ---
-# *** START: Added new setting with default ***
-app_settings = {
+SETTINGS_PATH = os.getenv("SETTINGS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json")) # "" = not persisted
+DEFAULT_SETTINGS = {
     "mode": "Image",
     "apiCallsPerMinute": 6, # MODIFIED Default rate limit
-    "resolution": "default",
-    "cropArea": {"x": 0.0, "y": 0.0, "w": 1.0, "h": 1.0},
     "greenLightDurationMs": 3000,
     "yellowLightDurationMs": 1000,
-    "maxTimeSmartA_Ms": 10000 # New setting: Default 10 seconds (10000ms)
+    "maxTimeSmartA_Ms": 10000, # New setting: Default 10 seconds (10000ms)
 }
-# *** END: Added new setting with default ***
+PERSISTED_CAMERA_KEYS = ("resolution", "cropArea", "regions") # Sources come from CAMERAS / FRAME_SOURCE on every start
+
+class SettingsVersionConflict(Exception):
+    """ An update named a settings version that is no longer current. """
+    def __init__(self, current_version):
+        super().__init__(f"Settings changed meanwhile (now version {current_version}).")
+        self.current_version = current_version
+
+class SettingsSnapshot:
+    """ One immutable version of all settings: the global values and a CameraConfig per camera. """
+    __slots__ = ("version", "values", "cameras")
+    def __init__(self, version, values, cameras):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "values", types.MappingProxyType(dict(values)))
+        object.__setattr__(self, "cameras", types.MappingProxyType(dict(cameras)))
+    def __setattr__(self, key, value): raise AttributeError("SettingsSnapshot is immutable.")
+
+class SettingsStore:
+    """
+    Owns the current SettingsSnapshot. update() builds the next version from the old one plus the
+    (already validated) changes, swaps it in with one assignment, writes it to SETTINGS_PATH and then
+    calls every subscriber with (old, new) outside the lock, one version after the other in order (a
+    subscriber never applies an older snapshot after a newer one). Readers take `settings_store.current`
+    once and use that snapshot throughout, so they never see a half-applied change; get() reads one
+    global value (the SignalController reads its durations through it on every tick).
+    """
+    def __init__(self, defaults=DEFAULT_SETTINGS, path=SETTINGS_PATH):
+        self.path = path
+        self.current = SettingsSnapshot(0, defaults, {})
+        self._lock = threading.Lock()
+        self._notify_lock = threading.Lock() # Held while subscribers run; taken before _lock is released
+        self._subscribers = []
+
+    def get(self, key, default=None): return self.current.values.get(key, default)
+
+    def subscribe(self, callback):
+        """ callback(old_snapshot, new_snapshot) after every change, on the updating thread. It must not call update(). """
+        self._subscribers.append(callback)
+
+    def load(self, cameras):
+        """ Initial snapshot from the registry's cameras and, when present and valid, the persisted file. """
+        values = dict(self.current.values); configs = {cam_id: camera.config for cam_id, camera in cameras.items()}; version = 0
+        try:
+            if self.path and os.path.exists(self.path):
+                with open(self.path) as f: saved = json.load(f)
+                version = int(saved.get("version", 0))
+                values.update({k: v for k, v in saved.get("settings", {}).items() if k in DEFAULT_SETTINGS})
+                for cam_id, camera_settings in saved.get("cameras", {}).items():
+                    if cam_id not in configs: logging.info(f"Settings: ignoring saved camera '{cam_id}' (not configured)."); continue
+                    camera_settings = {k: v for k, v in camera_settings.items() if k in PERSISTED_CAMERA_KEYS} # Written by _save(), so only converted here
+                    configs[cam_id] = CameraConfig.from_settings(version, camera_settings, configs[cam_id])
+                logging.info(f"Settings: loaded version {version} from {self.path}.")
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logging.error(f"Settings: ignoring unreadable {self.path}: {e}")
+            values = dict(self.current.values); configs = {cam_id: camera.config for cam_id, camera in cameras.items()}; version = 0
+        self.current = SettingsSnapshot(version, values, {cam_id: CameraConfig.from_settings(version, {}, config) for cam_id, config in configs.items()})
+        return self.current
+
+    def update(self, values=None, cameras=None, expected_version=None):
+        """
+        Applies global `values` and per-camera settings changes ({cam_id: {'resolution': ..., 'cropArea': ...}})
+        as one new version. Raises SettingsVersionConflict when expected_version is given and stale.
+        """
+        with self._lock:
+            old = self.current
+            if expected_version is not None and int(expected_version) != old.version: raise SettingsVersionConflict(old.version)
+            version = old.version + 1
+            configs = dict(old.cameras)
+            for cam_id, changes in (cameras or {}).items(): configs[cam_id] = CameraConfig.from_settings(version, changes, configs[cam_id])
+            new = SettingsSnapshot(version, {**old.values, **(values or {})}, configs)
+            self.current = new
+            self._save(new)
+            self._notify_lock.acquire() # The next update waits for these callbacks before notifying its own version
+        try:
+            for callback in list(self._subscribers):
+                try: callback(old, new)
+                except Exception as e: logging.error(f"Settings subscriber {callback} failed: {e}", exc_info=True)
+        finally: self._notify_lock.release()
+        return new
+
+    def _save(self, snapshot):
+        """ Atomic write (temp file + rename), so a crash never leaves a truncated settings file. Caller holds _lock. """
+        if not self.path: return
+        data = {"version": snapshot.version, "settings": dict(snapshot.values),
+                "cameras": {cam_id: {k: v for k, v in config.as_settings().items() if k in PERSISTED_CAMERA_KEYS} for cam_id, config in snapshot.cameras.items()}}
+        try:
+            with open(self.path + ".tmp", "w") as f: json.dump(data, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.error(f"Settings: could not save {self.path}: {e}")
+
+settings_store = SettingsStore()
+
+# --- Camera Registry ---
+def build_camera_registry(spec):
+    """
+    Builds the ordered {cam_id: Camera} registry from the CAMERAS spec, e.g. "north=0,south=1,east=2,west=3"
+    (a bare "0,1" uses the index as the id). The first camera is the default one served by the legacy
+    routes and configured by the main settings page. Empty spec = one "auto" camera probing 0 and 1.
+    """
+    registry = {}
+    for entry in [e.strip() for e in (spec or "").split(",") if e.strip()]:
+        if ":" in entry.partition("=")[0]: entry = f"{len(registry)}={entry}" # Bare source spec without an id
+        cam_id, _, source = entry.partition("=")
+        cam_id = cam_id.strip(); source = (source or cam_id).strip()
+        if cam_id in registry: logging.warning(f"Duplicate camera id '{cam_id}' in CAMERAS. Ignoring."); continue
+        registry[cam_id] = Camera(cam_id, source=source)
+    if not registry:
+        registry["0"] = Camera("0", source=os.getenv("FRAME_SOURCE", "auto"))
+    snapshot = settings_store.load(registry) # Saved resolutions, crop areas and regions
+    for cam_id, camera in registry.items():
+        camera.config = snapshot.cameras[cam_id]
+        settings_store.subscribe(camera.on_settings_changed)
+    logging.info(f"Camera registry: {[c.cam_id + '=' + c.config.source for c in registry.values()]}")
+    return registry
+
+with startup.step("camera registry & settings"): camera_registry = build_camera_registry(os.getenv("CAMERAS", ""))
+DEFAULT_CAMERA_ID = next(iter(camera_registry))
+
+def get_camera(cam_id=None):
+    """ Returns the Camera for cam_id (default camera when None), or None if unknown. """
+    return camera_registry.get(DEFAULT_CAMERA_ID if cam_id is None else cam_id)
 
 # --- Gemini Analysis Prompt ---
 GEMINI_PROMPT = """Analyze the provided image, which shows a view of a road intersection, potentially containing vehicles like cars, bikes (bicycles or motorcycles), trucks, and buses. Your goal is to identify the presence and count of each vehicle type within the specified crop area ONLY.
@@ -406,8 +1677,77 @@ IMPORTANT RULES:
 - Only count vehicles clearly visible within the image bounds or specified crop area. Do not infer vehicles outside the frame.
 - If the image quality is too poor or the view is obstructed, making analysis impossible, respond with "Vehicles_Present": "False" and all counts as 0."""
 
+# Used instead of GEMINI_PROMPT when named regions are configured; <REGION_...> markers are filled in by build_analysis_prompt()
+GEMINI_REGIONS_PROMPT = """Analyze the provided image. It is a grid of <REGION_COUNT> cells, each showing one region (a lane or approach) of a road intersection camera view. Every cell has a label bar at its top with the region name: <REGION_NAMES>. Identify the presence and count of vehicles like cars, bikes (bicycles or motorcycles), trucks, and buses separately for EACH cell.
+
+Respond ONLY with a JSON object adhering strictly to the following format:
+{
+  "Regions": {
+<REGION_EXAMPLE>
+  }
+}
+where each region object has exactly these fields:
+  "Vehicles_Present": "True" or "False" (string, based on whether ANY vehicles are visible in that cell),
+  "Cars": count (integer), "Bikes": count (integer, bikes/motorcycles), "Trucks": count (integer), "Buses": count (integer),
+  "Unknown": count (integer, objects that might be vehicles but cannot be confidently classified)
+
+IMPORTANT RULES:
+- Output ONLY the JSON object. No introductory text, explanations, markdown formatting (like ```json), or concluding remarks.
+- Include EVERY region name listed above exactly once, spelled exactly as labelled, even if it is empty.
+- Count a vehicle only in the cell where it is visible. Cells are independent views; ignore the label bars and borders.
+- If no vehicles are visible in a cell, its "Vehicles_Present" MUST be "False" and all its counts MUST be 0.
+- If a cell is too poor or obstructed to analyze, report it as "Vehicles_Present": "False" with all counts 0."""
+
+def build_analysis_prompt(region_names=None):
+    """ GEMINI_PROMPT for a single crop area, or the per-region prompt listing the given region names. """
+    if not region_names: return GEMINI_PROMPT
+    example = ",\n".join(f'    "{name}": {{"Vehicles_Present": "True" or "False", "Cars": 0, "Bikes": 0, "Trucks": 0, "Buses": 0, "Unknown": 0}}' for name in region_names)
+    return (GEMINI_REGIONS_PROMPT.replace("<REGION_COUNT>", str(len(region_names)))
+            .replace("<REGION_NAMES>", ", ".join(f'"{name}"' for name in region_names))
+            .replace("<REGION_EXAMPLE>", example))
+
 
 # --- Helper Functions ---
+def assert_valid_source(source):
+    """ Asserts a camera 'source' is a non-empty frame source spec. """
+    assert isinstance(source, str) and source.strip(), "'source' must be a non-empty string."
+
+def assert_valid_resolution(res):
+    """ Asserts 'resolution' is "default" or "<width>x<height>". """
+    assert res == "default" or (isinstance(res, str) and 'x' in res and res.split('x')[0].isdigit() and res.split('x')[1].isdigit()), "Invalid 'resolution'."
+
+def assert_valid_rect(rect, label):
+    """ Asserts `rect` is an {x, y, w, h} object of frame fractions that stays inside the frame. """
+    assert isinstance(rect, dict), f"'{label}' must be an object."
+    crop_keys = ["x", "y", "w", "h"]; assert all(key in rect for key in crop_keys), f"Missing keys in '{label}'. Required: {crop_keys}"
+    cx=float(rect['x']); cy=float(rect['y']); cw=float(rect['w']); ch=float(rect['h'])
+    assert 0.0<=cx<=1.0 and 0.0<=cy<=1.0 and 0.0<cw<=1.0 and 0.0<ch<=1.0 and (cx+cw)<=1.001 and (cy+ch)<=1.001, f"Invalid {label} range (0-1 for x/y, >0-1 for w/h, must stay within bounds)."
+
+def assert_valid_regions(regions):
+    """ Asserts 'regions' is a list of at most ANALYSIS_MAX_REGIONS uniquely named rectangles. """
+    assert isinstance(regions, list), "'regions' must be a list."
+    assert len(regions) <= ANALYSIS_MAX_REGIONS, f"At most {ANALYSIS_MAX_REGIONS} regions are supported."
+    names = set()
+    for region in regions:
+        assert isinstance(region, dict), "Each region must be an object."
+        name = region.get("name")
+        assert isinstance(name, str) and REGION_NAME_PATTERN.fullmatch(name), f"Invalid region name {name!r} (1-24 letters, digits, '_' or '-')."
+        assert name not in names, f"Duplicate region name '{name}'."
+        names.add(name); assert_valid_rect(region, f"regions.{name}")
+
+# Per-field checks for camera settings, so partial updates validate only the keys they carry
+CAPTURE_SETTING_CHECKS = {
+    "source": assert_valid_source,
+    "resolution": assert_valid_resolution,
+    "cropArea": lambda rect: assert_valid_rect(rect, "cropArea"),
+    "regions": assert_valid_regions,
+}
+
+def assert_valid_capture_settings(settings):
+    """ Asserts every per-camera key present in `settings` ('source', 'resolution', 'cropArea', 'regions') is well-formed. """
+    for key, check in CAPTURE_SETTING_CHECKS.items():
+        if key in settings: check(settings[key])
+
 def validate_settings(new_settings):
     """ Validates incoming settings dictionary from the frontend """
     try:
@@ -429,12 +1769,7 @@ def validate_settings(new_settings):
         rate_limit = int(new_settings.get("apiCallsPerMinute", 0))
         assert 1 <= rate_limit <= 60, "'API Calls per Minute' must be between 1 and 60."
 
-        res = new_settings.get("resolution", ""); assert res == "default" or (isinstance(res, str) and 'x' in res and res.split('x')[0].isdigit() and res.split('x')[1].isdigit()), "Invalid 'resolution'."
-
-        crop = new_settings.get("cropArea"); assert isinstance(crop, dict), "'cropArea' must be an object."
-        crop_keys = ["x", "y", "w", "h"]; assert all(key in crop for key in crop_keys), f"Missing keys in 'cropArea'. Required: {crop_keys}"
-        cx=float(crop['x']); cy=float(crop['y']); cw=float(crop['w']); ch=float(crop['h'])
-        assert 0.0<=cx<=1.0 and 0.0<=cy<=1.0 and 0.0<cw<=1.0 and 0.0<ch<=1.0 and (cx+cw)<=1.001 and (cy+ch)<=1.001, "Invalid crop range (0-1 for x/y, >0-1 for w/h, must stay within bounds)."
+        assert_valid_capture_settings(new_settings)
 
         green_sec = float(new_settings.get("greenLightDurationSec", 0))
         yellow_sec = float(new_settings.get("yellowLightDurationSec", 0))
@@ -455,10 +1790,36 @@ def validate_settings(new_settings):
         return False, "Unexpected validation error."
 
 # *** MODIFICATION START: Enhanced Markdown Stripping ***
-def parse_gemini_response(response_text):
+VEHICLE_COUNT_KEYS = ["Cars", "Bikes", "Trucks", "Buses", "Unknown"]
+
+def validate_vehicle_counts(data, label=""):
+    """ Validates and normalizes one {Vehicles_Present, Cars, ...} object in place. `label` prefixes error messages. """
+    if not isinstance(data, dict): raise TypeError(f"{label}Result is not a JSON object.")
+    expected_keys = {"Vehicles_Present", *VEHICLE_COUNT_KEYS}
+    if not expected_keys.issubset(data.keys()):
+        raise ValueError(f"{label}Missing keys. Expected: {expected_keys}, Found: {list(data.keys())}")
+
+    # Validate 'Vehicles_Present' (Case-insensitive check, store as string "True"/"False")
+    vp_value = data.get("Vehicles_Present")
+    if not isinstance(vp_value, str) or vp_value.upper() not in ["TRUE", "FALSE"]:
+         raise ValueError(f"{label}Invalid 'Vehicles_Present' value '{vp_value}' (must be string 'True' or 'False').")
+    data["Vehicles_Present"] = str(vp_value.upper() == "TRUE") # Standardize to "True" / "False"
+
+    # Validate counts (must be non-negative integers)
+    for key in VEHICLE_COUNT_KEYS:
+        value = data.get(key)
+        if not isinstance(value, int):
+            try: data[key] = int(value) # Attempt conversion if not int
+            except (ValueError, TypeError): raise ValueError(f"{label}Invalid non-integer value for '{key}'.")
+        if data[key] < 0: raise ValueError(f"{label}Value for '{key}' cannot be negative.")
+    return data
+
+def parse_gemini_response(response_text, region_names=None):
     """
     Parses the text response from Gemini, attempting to extract a JSON object.
     Handles potential Markdown code fences and validates the structure.
+    With `region_names`, expects a "Regions" object holding one result per name; the top-level
+    Vehicles_Present and counts are then the aggregate over all regions.
     """
     try:
         # Start by stripping leading/trailing whitespace
@@ -497,33 +1858,32 @@ def parse_gemini_response(response_text):
         if not isinstance(data, dict): raise TypeError("Parsed response is not a JSON object.")
 
         # --- Validate JSON Structure and Content ---
-        expected_keys = {"Vehicles_Present", "Cars", "Bikes", "Trucks", "Buses", "Unknown"}
-        if not expected_keys.issubset(data.keys()):
-            raise ValueError(f"Missing keys. Expected: {expected_keys}, Found: {list(data.keys())}")
-
-        # Validate 'Vehicles_Present' (Case-insensitive check, store as string "True"/"False")
-        vp_value = data.get("Vehicles_Present")
-        if not isinstance(vp_value, str) or vp_value.upper() not in ["TRUE", "FALSE"]:
-             raise ValueError(f"Invalid 'Vehicles_Present' value '{vp_value}' (must be string 'True' or 'False').")
-        data["Vehicles_Present"] = str(vp_value.upper() == "TRUE") # Standardize to "True" / "False"
-
-        # Validate counts (must be non-negative integers)
-        for key in ["Cars", "Bikes", "Trucks", "Buses", "Unknown"]:
-            value = data.get(key)
-            if not isinstance(value, int):
-                try: data[key] = int(value) # Attempt conversion if not int
-                except (ValueError, TypeError): raise ValueError(f"Invalid non-integer value for '{key}'.")
-            if data[key] < 0: raise ValueError(f"Value for '{key}' cannot be negative.")
+        if not region_names:
+            return validate_vehicle_counts(data), None # Return parsed data and no error
+
+        regions = data.get("Regions")
+        if not isinstance(regions, dict): raise ValueError(f"Missing 'Regions' object. Found: {list(data.keys())}")
+        missing = [name for name in region_names if name not in regions]
+        if missing: raise ValueError(f"Missing regions: {missing}. Found: {list(regions.keys())}")
+        extra = [name for name in regions if name not in region_names]
+        if extra: logging.warning(f"Ignoring unexpected regions in AI response: {extra}")
+        data = {"Regions": {name: validate_vehicle_counts(regions[name], f"Region '{name}': ") for name in region_names}}
+        per_region = data["Regions"].values()
+        data["Vehicles_Present"] = str(any(r["Vehicles_Present"] == "True" for r in per_region))
+        for key in VEHICLE_COUNT_KEYS: data[key] = sum(r[key] for r in per_region)
 
         return data, None # Return parsed data and no error
 
     except json.JSONDecodeError as e:
+        ANALYSIS_PARSE_FAILURES.inc(kind="json")
         logging.error(f"Gemini response JSON parse error: {e}\nAttempted to parse: {text[:200]}...\nOriginal response: {response_text[:200]}...")
         return None, f"AI response is not valid JSON: {e}"
     except (ValueError, TypeError) as e:
+         ANALYSIS_PARSE_FAILURES.inc(kind="format")
          logging.error(f"Gemini response validation error: {e}\nAttempted to parse: {text[:200]}...\nOriginal response: {response_text[:200]}...")
          return None, f"AI response format error: {e}"
     except Exception as e:
+        ANALYSIS_PARSE_FAILURES.inc(kind="unexpected")
         logging.error(f"Unexpected Gemini parse error: {e}\nOriginal Response: {response_text[:200]}...", exc_info=True)
         return None, f"Unexpected error parsing AI response: {e}"
 # *** MODIFICATION END ***
@@ -534,18 +1894,25 @@ def parse_gemini_response(response_text):
 def index(): return render_template('index.html', title="Live Analysis")
 
 @app.route('/settings')
-def settings_page(): return render_template('settings.html', title="Settings", is_camera_running=is_camera_running)
+def settings_page(): return render_template('settings.html', title="Settings", is_camera_running=get_camera().is_running)
 
 @app.route('/api/settings', methods=['GET', 'POST'])
 def handle_settings():
-    global app_settings
     if request.method == 'GET':
         try:
+            snapshot = settings_store.current
+            camera_settings = snapshot.cameras[DEFAULT_CAMERA_ID].as_settings(); camera_settings.pop("source")
             settings_with_status = {
-                **app_settings,
-                "isCameraRunning": is_camera_running,
+                **snapshot.values,
+                **camera_settings, # The main settings page configures the default camera
+                "version": snapshot.version,
+                "isCameraRunning": get_camera().is_running,
+                "defaultCameraId": DEFAULT_CAMERA_ID,
                 "aiBackendMode": AI_BACKEND_MODE,
-                "aiModelName": model_name_info
+                "aiBackendState": ai_backend.state,
+                "aiModelName": model_name_info,
+                "rateGovernor": rate_governor.status(), # Effective call rate and circuit breaker state
+                "cameras": [camera.status() for camera in camera_registry.values()]
             }
             settings_with_status.pop('frameRate', None) # Ensure old frameRate is not sent
             return jsonify(settings_with_status)
@@ -562,20 +1929,22 @@ def handle_settings():
                 logging.warning(f"Invalid settings received: {error_msg}. Data: {new_settings}")
                 return jsonify({"error": f"Invalid settings data: {error_msg}"}), 400
 
-            # Update settings, converting seconds to milliseconds where needed
-            app_settings["mode"] = new_settings["mode"]
-            app_settings["apiCallsPerMinute"] = int(new_settings["apiCallsPerMinute"])
-            app_settings["resolution"] = new_settings["resolution"]
-            app_settings["cropArea"] = {k: float(v) for k, v in new_settings["cropArea"].items()}
-            app_settings["greenLightDurationMs"] = int(float(new_settings["greenLightDurationSec"]) * 1000)
-            app_settings["yellowLightDurationMs"] = int(float(new_settings["yellowLightDurationSec"]) * 1000)
-            # *** START: Store new setting in ms ***
-            app_settings["maxTimeSmartA_Ms"] = int(float(new_settings["maxTimeSmartA_Sec"]) * 1000)
-            # *** END: Store new setting in ms ***
-
-
-            logging.info(f"Settings updated via API: {app_settings}")
-            return jsonify({"message": "Settings updated successfully."}), 200
+            # One new settings version, converting seconds to milliseconds where needed
+            values = {
+                "mode": new_settings["mode"],
+                "apiCallsPerMinute": int(new_settings["apiCallsPerMinute"]),
+                "greenLightDurationMs": int(float(new_settings["greenLightDurationSec"]) * 1000),
+                "yellowLightDurationMs": int(float(new_settings["yellowLightDurationSec"]) * 1000),
+                "maxTimeSmartA_Ms": int(float(new_settings["maxTimeSmartA_Sec"]) * 1000),
+            }
+            # The main settings page configures the default camera; regions are optional and kept when omitted
+            camera_changes = {key: new_settings[key] for key in ("resolution", "cropArea", "regions") if key in new_settings}
+            snapshot = settings_store.update(values, {DEFAULT_CAMERA_ID: camera_changes}, expected_version=new_settings.get("version"))
+
+            logging.info(f"Settings updated via API (version {snapshot.version}): {dict(snapshot.values)}")
+            return jsonify({"message": "Settings updated successfully.", "version": snapshot.version}), 200
+        except SettingsVersionConflict as e:
+            return jsonify({"error": str(e), "version": e.current_version}), 409
         except (AssertionError, ValueError, TypeError) as e:
             logging.warning(f"Invalid settings received: {e}. Data: {request.data[:200]}")
             return jsonify({"error": f"Invalid settings data: {e}"}), 400
@@ -584,34 +1953,116 @@ def handle_settings():
             return jsonify({"error": "Internal server error updating settings."}), 500
 
 # --- Other Routes ---
-@app.route('/video_feed')
-def video_feed():
-    logging.debug("Client connection request: CROPPED video stream.")
+STREAM_HEADERS = { 'Cache-Control': 'no-store, no-cache, must-revalidate, pre-check=0, post-check=0, max-age=0', 'Pragma': 'no-cache', 'Expires': '-1' }
+
+@app.route('/video_feed', defaults={'cam_id': None})
+@app.route('/video_feed/<cam_id>')
+def video_feed(cam_id):
+    logging.debug(f"Client connection request: CROPPED video stream (camera {cam_id or DEFAULT_CAMERA_ID}).")
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    try: rate = stream_rate_from_args(request.args)
+    except ValueError as e: return jsonify({"error": str(e)}), 400
     try:
-        headers = { 'Cache-Control': 'no-store, no-cache, must-revalidate, pre-check=0, post-check=0, max-age=0', 'Pragma': 'no-cache', 'Expires': '-1' }
-        return Response(generate_mjpeg_stream_cropped(), mimetype='multipart/x-mixed-replace; boundary=frame', headers=headers)
+        return Response(generate_mjpeg_stream_cropped(camera, rate), mimetype='multipart/x-mixed-replace; boundary=frame', headers=STREAM_HEADERS)
     except Exception as e:
          logging.error(f"Error creating /video_feed (cropped) response: {e}", exc_info=True)
          return "Error generating cropped video stream.", 500, {'Content-Type': 'text/plain'}
 
-@app.route('/video_feed_full')
-def video_feed_full():
-    logging.debug("Client connection request: FULL video stream.")
+@app.route('/video_feed_full', defaults={'cam_id': None})
+@app.route('/video_feed_full/<cam_id>')
+def video_feed_full(cam_id):
+    logging.debug(f"Client connection request: FULL video stream (camera {cam_id or DEFAULT_CAMERA_ID}).")
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    try: rate = stream_rate_from_args(request.args)
+    except ValueError as e: return jsonify({"error": str(e)}), 400
     try:
-        headers = { 'Cache-Control': 'no-store, no-cache, must-revalidate, pre-check=0, post-check=0, max-age=0', 'Pragma': 'no-cache', 'Expires': '-1' }
-        return Response(generate_mjpeg_stream_full(), mimetype='multipart/x-mixed-replace; boundary=frame', headers=headers)
+        return Response(generate_mjpeg_stream_full(camera, rate), mimetype='multipart/x-mixed-replace; boundary=frame', headers=STREAM_HEADERS)
     except Exception as e:
          logging.error(f"Error creating /video_feed_full response: {e}", exc_info=True)
          return "Error generating full video stream.", 500, {'Content-Type': 'text/plain'}
 
-@app.route('/api/camera/start', methods=['POST'])
-def api_start_camera():
+@app.route('/api/streams')
+def stream_stats():
+    """ Reports encoder sequence and per-client sent/dropped counters for each camera's stream variants. """
+    return jsonify({cam_id: {"full": camera.stream_full.stats(), "cropped": camera.stream_cropped.stats()}
+                    for cam_id, camera in camera_registry.items()})
+
+@app.route('/api/clips')
+def clip_stats():
+    return jsonify({cam_id: camera.clips.stats() if camera.clips is not None else None for cam_id, camera in camera_registry.items()})
+
+@app.route('/api/clip', defaults={'cam_id': None})
+@app.route('/api/clip/<cam_id>')
+def export_clip(cam_id):
+    """
+    Exports buffered frames as `?format=avi` (default, MJPEG AVI) or `mjpeg` (concatenated JPEGs).
+    Range: `?from=&to=` (epoch seconds), or `?at=` (default now) with `?before=` (default 10) and `?after=` (default 0)
+    seconds; post-event frames are waited for, up to CLIP_MAX_POST_SEC.
+    """
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    if camera.clips is None: return jsonify({"error": "Clip buffer is disabled (CLIP_BUFFER_MB=0)."}), 404
+    at = request.args.get("at", default=time.time(), type=float)
+    start = request.args.get("from", default=at - request.args.get("before", default=10.0, type=float), type=float)
+    end = request.args.get("to", default=at + request.args.get("after", default=0.0, type=float), type=float)
+    export_format = request.args.get("format", "avi")
+    if export_format not in ("avi", "mjpeg"): return jsonify({"error": "format must be 'avi' or 'mjpeg'."}), 400
+    if start >= end: return jsonify({"error": "'from' must be before 'to'."}), 400
+    if end > time.time() and camera.is_running:
+        camera.clips.wait_until(end, timeout=min(end - time.time(), CLIP_MAX_POST_SEC) + 1.0)
+    entries = camera.clips.entries(start, end)
+    if not len(entries): return jsonify({"error": "No buffered frames in that range."}), 404
+    filename = f"clip-{camera.cam_id}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(entries['ts'][0]))}.{export_format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "X-Clip-Frames": str(len(entries))}
+    if export_format == "avi":
+        length, chunks = avi_mjpeg_chunks(camera.clips, entries)
+        return Response(chunks, mimetype="video/x-msvideo", headers={**headers, "Content-Length": str(length)})
+    frames = (data for data in map(camera.clips.read, entries) if data is not None) # Overwritten frames are skipped
+    return Response(frames, mimetype="video/x-motion-jpeg", headers=headers)
+
+@app.route('/api/cameras')
+def list_cameras():
+    return jsonify([camera.status() for camera in camera_registry.values()])
+
+@app.route('/api/camera/<cam_id>/settings', methods=['GET', 'POST'])
+def handle_camera_settings(cam_id):
+    """
+    Per-camera 'source', 'resolution', 'cropArea' and 'regions'. A POST may carry any subset: the keys present
+    are merged over the camera's current config and validated there. Source and resolution changes apply on the next start.
+    """
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    if request.method == 'GET': return jsonify(camera.status())
     try:
-        logging.info("Attempting to acquire camera_start_lock for START...")
-        with camera_start_lock:
-            logging.info("Acquired camera_start_lock for START.")
-            success = start_camera_process()
-        logging.info("Released camera_start_lock after START.")
+        new_settings = request.get_json()
+        if not new_settings: return jsonify({"error": "No JSON data received."}), 400
+        changes = {key: new_settings[key] for key in CAPTURE_SETTING_CHECKS if key in new_settings}
+        if not changes: return jsonify({"error": f"No camera settings received. Expected any of: {list(CAPTURE_SETTING_CHECKS)}"}), 400
+        if isinstance(changes.get("source"), str): changes["source"] = changes["source"].strip()
+        assert_valid_capture_settings({**settings_store.current.cameras[camera.cam_id].as_settings(), **changes})
+        snapshot = settings_store.update(cameras={camera.cam_id: changes}, expected_version=new_settings.get("version"))
+        logging.info(f"Camera {cam_id} settings updated via API (version {snapshot.version}): {camera.config.as_settings()}")
+        return jsonify({"message": "Camera settings updated successfully.", "version": snapshot.version}), 200
+    except SettingsVersionConflict as e:
+        return jsonify({"error": str(e), "version": e.current_version}), 409
+    except (AssertionError, ValueError, TypeError, KeyError) as e:
+        logging.warning(f"Invalid camera settings received: {e}. Data: {request.data[:200]}")
+        return jsonify({"error": f"Invalid settings data: {e}"}), 400
+
+@app.route('/api/camera/start', methods=['POST'], defaults={'cam_id': None})
+@app.route('/api/camera/<cam_id>/start', methods=['POST'])
+def api_start_camera(cam_id):
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    try:
+        logging.info(f"Attempting to acquire start lock for START (camera {camera.cam_id})...")
+        with camera.start_lock:
+            logging.info("Acquired start lock for START.")
+            success = camera.start()
+        logging.info("Released start lock after START.")
+        signal_controller.wake() # Smart mode follows the camera
         if success:
             return jsonify({"message": "Camera process started successfully."}), 200
         else:
@@ -620,160 +2071,1418 @@ def api_start_camera():
          logging.exception("Unexpected error during /api/camera/start:")
          return jsonify({"error": "An unexpected error occurred while starting the camera."}), 500
 
-@app.route('/api/camera/stop', methods=['POST'])
-def api_stop_camera():
+@app.route('/api/camera/stop', methods=['POST'], defaults={'cam_id': None})
+@app.route('/api/camera/<cam_id>/stop', methods=['POST'])
+def api_stop_camera(cam_id):
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
     try:
-        logging.info("Attempting to acquire camera_start_lock for STOP...")
-        with camera_start_lock:
-            logging.info("Acquired camera_start_lock for STOP.")
-            stop_camera_process()
-        logging.info("Released camera_start_lock after STOP.")
+        logging.info(f"Attempting to acquire start lock for STOP (camera {camera.cam_id})...")
+        with camera.start_lock:
+            logging.info("Acquired start lock for STOP.")
+            camera.stop()
+        logging.info("Released start lock after STOP.")
+        signal_controller.wake()
         return jsonify({"message": "Camera process stopped successfully."}), 200
     except Exception as e:
         logging.exception("Unexpected error during /api/camera/stop:")
         return jsonify({"error": "An unexpected error occurred while stopping the camera."}), 500
 
-@app.route('/api/analyze', methods=['POST'])
-def analyze_image():
-    global output_frame, is_camera_running, AI_BACKEND_MODE, gemini_model
+# --- Analysis Image Payload ---
+ANALYSIS_MAX_SIDE = int(os.getenv("ANALYSIS_MAX_SIDE", "1024")) # Longest side sent to the AI (0 = no downscale)
+ANALYSIS_IMAGE_FORMAT = os.getenv("ANALYSIS_IMAGE_FORMAT", "jpeg").lower() # jpeg or webp
+ANALYSIS_IMAGE_QUALITY = int(os.getenv("ANALYSIS_IMAGE_QUALITY", "85")) # 1-100
+
+def encode_analysis_image(bgr_region):
+    """ Downscales a BGR region to ANALYSIS_MAX_SIDE and encodes it once. Returns (bytes, mime_type, (width, height)). """
+    h, w = bgr_region.shape[:2]
+    scale = ANALYSIS_MAX_SIDE / max(h, w) if ANALYSIS_MAX_SIDE > 0 else 1.0
+    if scale < 1.0:
+        w, h = max(1, int(w * scale)), max(1, int(h * scale))
+        bgr_region = cv2.resize(bgr_region, (w, h), interpolation=cv2.INTER_AREA)
+    if ANALYSIS_IMAGE_FORMAT == "webp":
+        ext, mime, params = ".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, ANALYSIS_IMAGE_QUALITY]
+    else:
+        ext, mime, params = ".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, ANALYSIS_IMAGE_QUALITY]
+    flag, enc = cv2.imencode(ext, bgr_region, params)
+    if not flag: raise ValueError(f"Encoding analysis image as {mime} failed.")
+    return enc.tobytes(), mime, (w, h)
+
+# --- Multi-Region Composite ---
+ANALYSIS_MAX_REGIONS = int(os.getenv("ANALYSIS_MAX_REGIONS", "9")) # Cells per composite; more shrinks each cell
+REGION_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,24}")
+REGION_LABEL_HEIGHT = 28 # Pixels of the name bar above each cell
+
+def build_region_composite(frame, config):
+    """
+    Tiles the named regions of `frame` (slices of a CameraConfig bound to its size) into one grid image (about square, row-major in settings order) so a
+    single AI call covers all of them. Each cell keeps its region's aspect ratio, is never upscaled, and
+    carries a label bar with the region name. The composite fits within ANALYSIS_MAX_SIDE (1024 if 0).
+    """
+    crops = [frame[rect] for rect in config.region_rects] # CameraConfig bound to this frame size
+    cols = math.ceil(math.sqrt(len(crops))); rows = math.ceil(len(crops) / cols)
+    side = ANALYSIS_MAX_SIDE if ANALYSIS_MAX_SIDE > 0 else 1024
+    cell_w = max(crop.shape[1] for crop in crops); cell_h = max(crop.shape[0] for crop in crops)
+    scale = min(1.0, side / (cols * cell_w), max(1, side - rows * REGION_LABEL_HEIGHT) / (rows * cell_h))
+    cell_w = max(1, int(cell_w * scale)); cell_h = max(1, int(cell_h * scale))
+    canvas = np.zeros((rows * (cell_h + REGION_LABEL_HEIGHT), cols * cell_w, 3), dtype=np.uint8)
+    for i, (crop, name) in enumerate(zip(crops, config.region_names)):
+        x0 = (i % cols) * cell_w; y0 = (i // cols) * (cell_h + REGION_LABEL_HEIGHT)
+        fit = min(cell_w / crop.shape[1], cell_h / crop.shape[0])
+        w = max(1, int(crop.shape[1] * fit)); h = max(1, int(crop.shape[0] * fit))
+        if (w, h) != (crop.shape[1], crop.shape[0]): crop = cv2.resize(crop, (w, h), interpolation=cv2.INTER_AREA)
+        top = y0 + REGION_LABEL_HEIGHT + (cell_h - h) // 2; left = x0 + (cell_w - w) // 2
+        canvas[top:top + h, left:left + w] = crop
+        cv2.rectangle(canvas, (x0, y0), (x0 + cell_w - 1, y0 + REGION_LABEL_HEIGHT - 1), (255, 255, 255), -1)
+        cv2.putText(canvas, name, (x0 + 6, y0 + REGION_LABEL_HEIGHT - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2, cv2.LINE_AA)
+        cv2.rectangle(canvas, (x0, y0), (x0 + cell_w - 1, y0 + cell_h + REGION_LABEL_HEIGHT - 1), (0, 255, 255), 2)
+    return canvas
+
+# --- Analysis Pipeline ---
+ANALYSIS_FRAME_ATTEMPTS = 3 # Newest frames tried when the capture side reuses the slot while the region is copied out
+def generate_with_timeout(payload, timeout):
+    """ Calls the model with a per-call timeout where the SDK supports one (AI Studio request_options). """
+    if timeout and AI_BACKEND_MODE in ("STUDIO", "MOCK"):
+        return gemini_model.generate_content(payload, request_options={"timeout": timeout})
+    # Vertex: generate_content() takes no per-call timeout. A call past the job deadline is reported as 504 but keeps its
+    # worker until it returns; AnalysisJobPool counts such workers as stalled and refuses new jobs while all of them are.
+    return gemini_model.generate_content(payload)
+
+def run_analysis(camera, timeout=None):
+    """
+    Runs one Gemini analysis on the camera's newest frame. Blocks on the network: call it from
+    an analysis worker (see AnalysisJobPool), never from a request thread.
+    Returns (response_body, http_status, frame_ref); frame_ref is None when no frame was used.
+    """
+    global AI_BACKEND_MODE, gemini_model
 
+    frame_ref = None
     if AI_BACKEND_MODE == "NONE" or gemini_model is None:
-        logging.warning("Analysis request ignored: AI backend is not configured or failed initialization.")
-        return jsonify({"error": "AI backend not available."}), 503
-    if not is_camera_running:
-        logging.warning("Analysis request ignored: Camera is not running.")
-        return jsonify({"error": "Analysis stopped: Camera not running."}), 409 # Use 409 Conflict
-
-    current_frame = None
-    with output_frame_lock:
-        if output_frame is not None: current_frame = output_frame.copy()
-    if current_frame is None:
-        logging.warning("Analysis request failed: Frame not available from camera thread.")
-        return jsonify({"error": "Frame not available yet. Try again shortly."}), 503
-
-    # --- Frame Processing (Cropping) ---
-    try:
-        if not isinstance(current_frame, np.ndarray): raise TypeError(f"Frame is not a NumPy array: {type(current_frame)}")
-        img_input_pil = Image.fromarray(cv2.cvtColor(current_frame, cv2.COLOR_BGR2RGB))
-        logging.debug(f"ANALYSIS: Original frame size (WxH): {img_input_pil.size}")
-        img_to_analyze = img_input_pil
+        logging.warning(f"Analysis request ignored: AI backend is {ai_backend.state}.")
+        return {"error": "AI backend is still initializing." if ai_backend.state in ("pending", "initializing") else "AI backend not available."}, 503, frame_ref
+    if not camera.is_running:
+        logging.warning(f"Analysis request ignored: Camera {camera.cam_id} is not running.")
+        return {"error": "Analysis stopped: Camera not running."}, 409, frame_ref # Use 409 Conflict
+    if camera.state == "reconnecting":
+        return {"error": "Camera is reconnecting. Try again shortly."}, 503, frame_ref
+
+    # --- Frame Processing: copy the region out of the newest slot (a view into the ring or a capture process's segment) ---
+    # The slot is reused after len(ring) frames, which a composite can outlast: the copy only counts if the slot
+    # still holds the same frame afterwards, so change detection, the cache and the AI never see a torn frame.
+    preprocess_start = time.monotonic()
+    for _ in range(ANALYSIS_FRAME_ATTEMPTS):
+        frame_ref = camera.ring.latest()
+        current_frame = frame_ref.frame if frame_ref is not None else None
+        if current_frame is None:
+            logging.warning("Analysis request failed: Frame not available from camera thread.")
+            return {"error": "Frame not available yet. Try again shortly."}, 503, frame_ref
         try:
-            crop = app_settings.get("cropArea", {}); img_width, img_height = img_input_pil.size
-            if img_width > 0 and img_height > 0:
-                crop_x = float(crop.get("x", 0.0)); crop_y = float(crop.get("y", 0.0));
-                crop_w = float(crop.get("w", 1.0)); crop_h = float(crop.get("h", 1.0));
-                is_valid_crop = (0.0 <= crop_x <= 1.0 and 0.0 <= crop_y <= 1.0 and 0.0 < crop_w <= 1.0 and 0.0 < crop_h <= 1.0 and (crop_x + crop_w) <= 1.001 and (crop_y + crop_h) <= 1.001)
-                is_full_image = (abs(crop_w - 1.0) < 1e-6 and abs(crop_h - 1.0) < 1e-6 and abs(crop_x - 0.0) < 1e-6 and abs(crop_y - 0.0) < 1e-6)
-                if is_valid_crop and not is_full_image:
-                    left = int(crop_x * img_width); top = int(crop_y * img_height);
-                    right = min(int((crop_x + crop_w) * img_width), img_width); bottom = min(int((crop_y + crop_h) * img_height), img_height);
-                    if right > left and bottom > top:
-                        logging.info(f"ANALYSIS: Applying crop - Pixels: ({left}, {top}, {right}, {bottom})")
-                        img_to_analyze = img_input_pil.crop((left, top, right, bottom))
-                        logging.info(f"ANALYSIS: Cropped image size (WxH): {img_to_analyze.size}")
-                    else:
-                        logging.warning(f"ANALYSIS: Calculated zero-area crop box: ({left}, {top}, {right}, {bottom}). Using full image.")
-                        img_to_analyze = img_input_pil
-                elif not is_valid_crop:
-                     logging.warning(f"ANALYSIS: Invalid crop values in settings: {crop}. Using full image.")
-                     img_to_analyze = img_input_pil
-            else:
-                 logging.warning("ANALYSIS: Invalid original frame dimensions received. Cannot crop.")
-                 img_to_analyze = img_input_pil
-        except Exception as crop_err:
-            logging.error(f"ANALYSIS: Error during cropping: {crop_err}. Using full image.", exc_info=True)
-            img_to_analyze = img_input_pil
-    except Exception as convert_err:
-        logging.error(f"Frame conversion/processing error before AI call: {convert_err}", exc_info=True)
-        return jsonify({"error": "Error processing frame before analysis."}), 500
-
-    # --- Payload Preparation ---
+            if not isinstance(current_frame, np.ndarray): raise TypeError(f"Frame is not a NumPy array: {type(current_frame)}")
+            config = camera.config_for(current_frame) # One snapshot for the whole analysis, crop slices precomputed
+            regions = config.regions
+            # Several named regions: one labelled composite (new pixels) for one call; otherwise a copy of the single crop area
+            region = build_region_composite(current_frame, config) if regions else config.crop(current_frame).copy()
+            logging.debug(f"ANALYSIS: Frame {current_frame.shape[1]}x{current_frame.shape[0]}, region {region.shape[1]}x{region.shape[0]}")
+        except Exception as convert_err:
+            logging.error(f"Frame conversion/processing error before AI call: {convert_err}", exc_info=True)
+            return {"error": "Error processing frame before analysis."}, 500, frame_ref
+        if frame_ref.still_valid(): break
+        logging.debug(f"ANALYSIS: Camera {camera.cam_id} slot reused while copying frame {frame_ref.seq}, retrying with the newest frame.")
+    else:
+        logging.warning(f"Analysis request failed: camera {camera.cam_id} frames were overwritten during {ANALYSIS_FRAME_ATTEMPTS} copies.")
+        return {"error": "Frame was overwritten while being read. Try again shortly."}, 503, frame_ref
+
+    # --- Local Pre-filter: answer "empty" without the AI when nothing is in the crop region ---
+    if not regions and camera.prefilter is not None and camera.prefilter.is_clearly_empty(): # It watches the crop area only
+        logging.info(f"ANALYSIS: Local pre-filter reports camera {camera.cam_id} approach empty. Skipping AI call.")
+        return camera.prefilter.empty_result(), 200, frame_ref
+
+    # --- Change Detection: reuse the previous result if the crop region looks the same ---
+    try:
+        signature = compute_change_signature(region)
+        cached_result, change = camera.analysis_cache.lookup(signature)
+        if cached_result is not None:
+            logging.info(f"ANALYSIS: Crop region unchanged (change {change:.4f} < {camera.analysis_cache.threshold}). Returning cached result ({cached_result['cache_age_sec']}s old).")
+            cached_result.update(payload_bytes=0, preprocess_ms=round((time.monotonic() - preprocess_start) * 1000, 2))
+            ANALYSIS_PREPROCESS_SECONDS.observe(time.monotonic() - preprocess_start, camera=camera.cam_id)
+            return cached_result, 200, frame_ref
+    except Exception as sig_err:
+        logging.warning(f"ANALYSIS: Change detection failed, calling AI: {sig_err}")
+        signature = None
+
+    # --- Payload Preparation: downscale + encode ONCE, same bytes for every backend ---
     analysis_payload = None
     try:
-        if AI_BACKEND_MODE == "STUDIO":
-            analysis_payload = [GEMINI_PROMPT, img_to_analyze]
-            logging.debug(f"Prepared payload for AI Studio (PIL Image size: {img_to_analyze.size})")
+        image_bytes, mime, (out_w, out_h) = encode_analysis_image(region)
+        region_names = config.region_names
+        prompt = build_analysis_prompt(region_names)
+        if AI_BACKEND_MODE in ("STUDIO", "MOCK"): # The mock takes the AI Studio payload shape
+            analysis_payload = [prompt, {"mime_type": mime, "data": image_bytes}]
         elif AI_BACKEND_MODE == "VERTEX":
-            buffer = io.BytesIO(); img_format = "JPEG"; img_to_analyze.save(buffer, format=img_format); image_bytes = buffer.getvalue()
-            if not image_bytes: raise ValueError("Image conversion to bytes resulted in empty data.")
-            mime = f"image/{img_format.lower()}"; image_part = Part.from_data(data=image_bytes, mime_type=mime)
-            analysis_payload = [GEMINI_PROMPT, image_part]
-            logging.debug(f"Prepared payload for Vertex AI ({len(image_bytes)} bytes, {mime})")
+            analysis_payload = [prompt, Part.from_data(data=image_bytes, mime_type=mime)]
         else: raise RuntimeError("AI Backend mode inconsistent state.")
+        payload_info = {"payload_bytes": len(image_bytes), "preprocess_ms": round((time.monotonic() - preprocess_start) * 1000, 2),
+                        "capture_to_request_ms": round((time.monotonic() - frame_ref.timestamp) * 1000, 1)}
+        ANALYSIS_PREPROCESS_SECONDS.observe(time.monotonic() - preprocess_start, camera=camera.cam_id)
+        logging.info(f"ANALYSIS: Prepared {out_w}x{out_h} {mime} payload for {AI_BACKEND_MODE}: {payload_info['payload_bytes']} bytes in {payload_info['preprocess_ms']} ms")
     except Exception as prep_err:
          logging.error(f"Error preparing analysis payload for {AI_BACKEND_MODE}: {prep_err}", exc_info=True)
-         return jsonify({"error": f"Internal error preparing image for {AI_BACKEND_MODE}."}), 500
+         return {"error": f"Internal error preparing image for {AI_BACKEND_MODE}."}, 500, frame_ref
 
     # --- API Call and Response Handling ---
+    analysis_start_time = time.monotonic(); duration = None
+    def observe_upstream(outcome, retry_after=None):
+        ANALYSIS_UPSTREAM_SECONDS.observe(time.monotonic() - analysis_start_time, backend=AI_BACKEND_MODE, outcome=outcome)
+        rate_governor.record(outcome, retry_after) # Backs off (or recovers) the call rate for every caller
     try:
         logging.info(f"Sending request to {AI_BACKEND_MODE} backend...")
-        analysis_start_time = time.monotonic()
-        response = gemini_model.generate_content(analysis_payload)
+        response = generate_with_timeout(analysis_payload, timeout)
         duration = time.monotonic() - analysis_start_time
+        observe_upstream("ok")
         logging.info(f"{AI_BACKEND_MODE} analysis completed in {duration:.3f} seconds.")
 
         # *** Use the modified parse_gemini_response function ***
-        analysis_result, parse_error = parse_gemini_response(response.text)
+        analysis_result, parse_error = parse_gemini_response(response.text, region_names)
 
         if parse_error:
             # Return the error and include the raw text for frontend logging
             # Use 502 Bad Gateway, as we failed to process a response from the upstream AI server
-            return jsonify({"error": parse_error, "raw_response": response.text}), 502
+            return {"error": parse_error, "raw_response": response.text, **payload_info}, 502, frame_ref
         else:
             # Return successful analysis and include raw text (response.text) for logging
             analysis_result["raw_response"] = response.text # Add raw response to success case
-            return jsonify(analysis_result), 200
+            analysis_result["source"] = "ai"
+            analysis_result.update(payload_info)
+            if signature is not None: camera.analysis_cache.store(signature, analysis_result)
+            if camera.prefilter is not None: camera.prefilter.note_ai_result(analysis_result["Vehicles_Present"] == "True")
+            return analysis_result, 200, frame_ref
 
     except google.api_core.exceptions.ResourceExhausted as e:
+        retry_after = quota_retry_after(e)
+        observe_upstream("quota", retry_after); ANALYSIS_QUOTA_EXCEEDED.inc(camera=camera.cam_id)
         quota_error_message = "Error: You exceeded your current API Quota, please check your plan and billing details."
         logging.error(f"{AI_BACKEND_MODE} API Quota Exceeded: {e}", exc_info=True)
         # Return the specific message and 429 status code
-        return jsonify({
+        return {
             "quota_error": quota_error_message,
-            "raw_response": f"Quota Error: {e}" # Include original error details in raw_response
-        }), 429 # HTTP 429 Too Many Requests
+            "raw_response": f"Quota Error: {e}", # Include original error details in raw_response
+            **({"retry_after": round(retry_after, 2)} if retry_after else {}),
+            **payload_info
+        }, 429, frame_ref # HTTP 429 Too Many Requests
+
+    except google.api_core.exceptions.DeadlineExceeded as e:
+        observe_upstream("timeout")
+        logging.error(f"{AI_BACKEND_MODE} API call timed out after {timeout}s: {e}")
+        return {"error": f"AI analysis timed out after {timeout}s.", "raw_response": f"Timeout: {e}", **payload_info}, 504, frame_ref
 
     except Exception as ai_err:
+        if duration is None: observe_upstream("error")
         # Log first, then prepare the error response
         logging.error(f"{AI_BACKEND_MODE} API call or response processing failed: {ai_err}", exc_info=True)
         # Simply convert the exception to string for the raw response
         raw_text_on_error = f"AI Error: {str(ai_err)}"
         # Return a generic server error (503 Service Unavailable fits AI backend issues)
-        return jsonify({"error": f"AI analysis failed using {AI_BACKEND_MODE} backend.", "raw_response": raw_text_on_error}), 503
+        return {"error": f"AI analysis failed using {AI_BACKEND_MODE} backend.", "raw_response": raw_text_on_error, **payload_info}, 503, frame_ref
+
+
+# --- Analysis Rate Limiting & Scheduling ---
+class MonotonicClock:
+    """ Real time for TokenBucket, RateGovernor and SignalController. """
+    def now(self): return time.monotonic()
+
+class VirtualClock:
+    """ Manually advanced clock: drives the rate limiter or a SignalController through hours instantly in tests and simulations. """
+    def __init__(self, start=0.0): self._now = float(start)
+    def now(self): return self._now
+    def advance(self, seconds): self._now += seconds; return self._now
+
+class TokenBucket:
+    """ Thread-safe token bucket: `rate_per_sec` tokens are added continuously up to `capacity`. """
+    def __init__(self, rate_per_sec, capacity=1.0, clock=None):
+        self._lock = threading.Lock(); self.clock = clock or MonotonicClock()
+        self.rate_per_sec = rate_per_sec; self.capacity = capacity
+        self._tokens = capacity; self._updated = self.clock.now()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_sec); self._updated = now
+
+    def set_rate(self, rate_per_sec):
+        with self._lock:
+            self._refill(self.clock.now()); self.rate_per_sec = rate_per_sec
+
+    def try_acquire(self):
+        """ Takes one token if available. Returns 0.0 on success, otherwise the seconds until one is available. """
+        with self._lock:
+            now = self.clock.now(); self._refill(now)
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0; return 0.0
+            return (1.0 - self._tokens) / self.rate_per_sec if self.rate_per_sec > 0 else 60.0
+
+def configured_calls_per_minute():
+    return max(1, int(settings_store.get("apiCallsPerMinute", 6)))
+
+ANALYSIS_MIN_CALLS_PER_MINUTE = float(os.getenv("ANALYSIS_MIN_CALLS_PER_MINUTE", "0.5")) # Floor of the backed-off rate
+ANALYSIS_BACKOFF_FACTOR = float(os.getenv("ANALYSIS_BACKOFF_FACTOR", "0.5")) # Rate multiplier per quota error or failed call
+ANALYSIS_RECOVERY_STEP = float(os.getenv("ANALYSIS_RECOVERY_STEP", "1")) # Calls/min added back per successful call
+ANALYSIS_BREAKER_FAILURES = max(1, int(os.getenv("ANALYSIS_BREAKER_FAILURES", "5"))) # Failed calls in a row that open the breaker
+ANALYSIS_BREAKER_COOLDOWN_SEC = float(os.getenv("ANALYSIS_BREAKER_COOLDOWN_SEC", "30")) # Pause before the first probe call
+ANALYSIS_BREAKER_MAX_COOLDOWN_SEC = float(os.getenv("ANALYSIS_BREAKER_MAX_COOLDOWN_SEC", "600")) # Cap of the pause, doubled per failed probe
+_RETRY_HINT = re.compile(r"retry in ([\d.]+)\s*s|retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE)
+
+def quota_retry_after(error):
+    """ Seconds a quota error asks to wait (RetryInfo detail, or "Please retry in 12.3s." in the message), or None. """
+    for detail in getattr(error, "details", None) or ():
+        if isinstance(detail, dict) and detail.get("retryDelay"): return float(str(detail["retryDelay"]).rstrip("s"))
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None: return delay.seconds + delay.nanos / 1e9
+    match = _RETRY_HINT.search(str(error))
+    return float(match.group(1) or match.group(2)) if match else None
+
+class RateGovernor:
+    """
+    Sits in front of the analysis token bucket and adapts its rate to how the AI backend copes (AIMD):
+    every quota error or failed call multiplies the effective rate by ANALYSIS_BACKOFF_FACTOR and every
+    successful call adds ANALYSIS_RECOVERY_STEP calls/min back, up to apiCallsPerMinute. A retry-after
+    hint from the API holds all calls until it has passed. ANALYSIS_BREAKER_FAILURES failures in a row
+    open the circuit breaker: no calls for a cool-down, then a single probe call (half-open) that closes
+    it on success or reopens it for twice as long.
+    """
+    def __init__(self, bucket, configured=configured_calls_per_minute, clock=None):
+        self.bucket = bucket; self._configured = configured; self.clock = clock or bucket.clock
+        self._lock = threading.Lock()
+        self.configured_rpm = self.effective_rpm = float(configured())
+        self.breaker = "closed" # closed -> open -> half_open -> closed | open
+        self.failures = 0 # Failed calls in a row
+        self.cooldown = ANALYSIS_BREAKER_COOLDOWN_SEC
+        self.last_error = None
+        self._hold_until = 0.0 # Monotonic time before which no call starts (retry-after hint, open breaker)
+        self._probe_started = None
+        self._published = None
+        self._apply()
+
+    def _apply(self):
+        self.bucket.set_rate(self.effective_rpm / 60.0)
+        ANALYSIS_EFFECTIVE_CALLS_PER_MINUTE.labels().set(self.effective_rpm)
+
+    def _sync(self):
+        """ Follows apiCallsPerMinute: a fully recovered rate moves with it, a backed-off one never exceeds it. """
+        configured = float(self._configured())
+        if configured == self.configured_rpm: return
+        self.effective_rpm = configured if self.effective_rpm >= self.configured_rpm else min(self.effective_rpm, configured)
+        self.configured_rpm = configured; self._apply()
+
+    def _set_breaker(self, state):
+        self.breaker = state; ANALYSIS_BREAKER_TRANSITIONS.inc(state=state)
+        log = logging.warning if state == "open" else logging.info
+        log(f"Analysis circuit breaker {state}" + (f" for {self.cooldown:.0f}s after {self.failures} failed calls ({self.last_error})." if state == "open" else "."))
+
+    def try_acquire(self):
+        """ Returns 0.0 when a call may start now, otherwise the seconds to wait. Replaces the bucket's try_acquire. """
+        with self._lock:
+            now = self.clock.now(); self._sync()
+            if now < self._hold_until: return self._hold_until - now
+            if self.breaker == "open": self._set_breaker("half_open")
+            if self.breaker == "half_open":
+                # One probe at a time; a probe that never reached the backend is given up after a cool-down
+                if self._probe_started is not None and now - self._probe_started < self.cooldown: return 1.0
+                self._probe_started = now; return 0.0
+            return self.bucket.try_acquire()
+
+    def record(self, outcome, retry_after=None):
+        """ Feeds back one upstream call: "ok" (the backend answered) or "quota", "timeout", "error". """
+        with self._lock:
+            now = self.clock.now(); self._sync()
+            self._probe_started = None
+            if outcome == "ok":
+                self.failures = 0
+                self.effective_rpm = min(self.configured_rpm, self.effective_rpm + ANALYSIS_RECOVERY_STEP)
+                if self.breaker != "closed": self.cooldown = ANALYSIS_BREAKER_COOLDOWN_SEC; self._hold_until = 0.0; self._set_breaker("closed")
+            else:
+                self.failures += 1; self.last_error = outcome
+                self.effective_rpm = max(ANALYSIS_MIN_CALLS_PER_MINUTE, self.effective_rpm * ANALYSIS_BACKOFF_FACTOR)
+                if retry_after: self._hold_until = max(self._hold_until, now + retry_after)
+                reopen = self.breaker == "half_open"
+                if reopen: self.cooldown = min(ANALYSIS_BREAKER_MAX_COOLDOWN_SEC, self.cooldown * 2)
+                if reopen or (self.breaker == "closed" and self.failures >= ANALYSIS_BREAKER_FAILURES):
+                    self._hold_until = max(self._hold_until, now + self.cooldown); self._set_breaker("open")
+            self._apply()
+            status = self._status(now)
+            changed = (status["breaker"], status["effectiveCallsPerMinute"]) != self._published
+            self._published = (status["breaker"], status["effectiveCallsPerMinute"])
+        if changed: event_bus.publish("governor", status)
+
+    def _status(self, now):
+        return {"configuredCallsPerMinute": self.configured_rpm, "effectiveCallsPerMinute": round(self.effective_rpm, 2),
+                "breaker": self.breaker, "consecutiveFailures": self.failures, "lastError": self.last_error,
+                "retryAfterSec": round(max(0.0, self._hold_until - now), 1), "cooldownSec": self.cooldown}
+
+    def status(self):
+        with self._lock:
+            self._sync(); return self._status(self.clock.now())
+
+# One bucket for the whole process: the quota belongs to the API key, not to a browser tab or camera
+analysis_rate_limiter = TokenBucket(configured_calls_per_minute() / 60.0)
+rate_governor = RateGovernor(analysis_rate_limiter)
+
+class AnalysisScheduler:
+    """
+    Backend analysis loop shared by every browser client. It takes one token per call from
+    rate_governor (the adaptive analysis_rate_limiter), round-robins across running cameras, runs the call on the analysis job
+    pool and publishes each result with its frame sequence and timestamp. Clients read it through
+    GET /api/analysis/latest at no API cost.
+    """
+    def __init__(self, rate_limiter):
+        self.rate_limiter = rate_limiter
+        self._lock = threading.Lock()
+        self._latest = {} # cam_id -> published record
+        self._analysis_seq = 0
+        self._next_camera = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="AnalysisScheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread: self._thread.join(timeout=2.0)
+
+    def latest(self, cam_id):
+        with self._lock: return self._latest.get(cam_id)
+
+    def publish(self, camera, body, status, frame_ref, duration):
+        """ Stores a result as the newest for its camera and returns the published record. """
+        with self._lock:
+            self._analysis_seq += 1
+            record = {
+                "analysisSeq": self._analysis_seq,
+                "cameraId": camera.cam_id,
+                "frameSeq": frame_ref.seq if frame_ref is not None else None,
+                # Wall-clock capture time, derived from the frame's monotonic timestamp
+                "frameTimestamp": time.time() - (time.monotonic() - frame_ref.timestamp) if frame_ref is not None else None,
+                "captureToResultMs": round((time.monotonic() - frame_ref.timestamp) * 1000, 1) if frame_ref is not None else None,
+                "timestamp": time.time(),
+                "durationMs": round(duration * 1000, 1),
+                "status": status,
+                "result": body,
+            }
+            self._latest[camera.cam_id] = record
+        if frame_ref is not None: ANALYSIS_CAPTURE_TO_RESULT_SECONDS.observe(record["captureToResultMs"] / 1000, camera=camera.cam_id)
+        return record
+
+    def _pick_camera(self):
+        cameras = [c for c in camera_registry.values() if c.is_running and c.ring.latest() is not None and signal_controller.wants_analysis(c.cam_id)]
+        if not cameras: return None
+        camera = cameras[self._next_camera % len(cameras)]; self._next_camera += 1
+        return camera
+
+    def _run(self):
+        logging.info("Analysis scheduler started.")
+        while not self._stop.is_set():
+            camera = None
+            if AI_BACKEND_MODE != "NONE" and gemini_model is not None:
+                camera = self._pick_camera() # Only cameras with a frame ready, so no token is wasted on a 503
+            if camera is None or not analysis_jobs.has_capacity():
+                self._stop.wait(0.5); continue
+            wait = self.rate_limiter.try_acquire()
+            if wait > 0:
+                self._next_camera -= 1 # Keep the round-robin position for the next attempt
+                self._stop.wait(min(wait, 1.0)); continue # Re-check settings at least once a second
+            try:
+                job = analysis_jobs.submit(camera) # The worker publishes the result
+            except queue.Full:
+                continue
+            # One scheduled call in flight at a time; the job deadline bounds the wait
+            while not job.done.wait(0.5) and not self._stop.is_set(): job.check_deadline()
+        logging.info("Analysis scheduler stopped.")
+
+analysis_scheduler = AnalysisScheduler(rate_governor)
+
+
+# --- Analysis Jobs (bounded worker pool) ---
+ANALYSIS_MAX_CONCURRENCY = max(1, int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "2"))) # Parallel upstream calls
+ANALYSIS_QUEUE_SIZE = max(1, int(os.getenv("ANALYSIS_QUEUE_SIZE", "8"))) # Waiting jobs before load shedding (429)
+ANALYSIS_CALL_TIMEOUT_SEC = float(os.getenv("ANALYSIS_CALL_TIMEOUT_SEC", "30")) # Per-call upstream timeout
+ANALYSIS_JOB_RETENTION = 256 # Finished jobs kept for GET
+
+class AnalysisJob:
+    """ One queued analysis. `state` goes queued -> running -> done | timeout. """
+    _ids = 0
+    _ids_lock = threading.Lock()
+
+    def __init__(self, camera, timeout):
+        with AnalysisJob._ids_lock:
+            AnalysisJob._ids += 1; self.job_id = f"job-{AnalysisJob._ids}"
+        self.camera = camera; self.timeout = timeout
+        self.state = "queued"
+        self.submitted_at = time.monotonic(); self.started_at = None; self.finished_at = None
+        self.status = None; self.body = None; self.record = None
+        self.done = threading.Event()
+
+    def check_deadline(self):
+        """ Marks a running job as timed out once its call exceeded the timeout (the late result is discarded). """
+        if self.state == "running" and time.monotonic() - self.started_at > self.timeout + 1.0:
+            self.state = "timeout"; self.status = 504; self.finished_at = time.monotonic()
+            self.body = {"error": f"AI analysis timed out after {self.timeout:.0f}s."}
+            self.done.set()
+
+    def to_dict(self):
+        self.check_deadline()
+        now = time.monotonic()
+        info = {"jobId": self.job_id, "cameraId": self.camera.cam_id, "state": self.state,
+                "queueMs": round(((self.started_at or now) - self.submitted_at) * 1000, 1)}
+        if self.started_at is not None: info["runMs"] = round(((self.finished_at or now) - self.started_at) * 1000, 1)
+        if self.done.is_set(): info.update(status=self.status, result=self.body, analysisSeq=(self.record or {}).get("analysisSeq"))
+        return info
+
+class AnalysisJobPool:
+    """
+    Runs analyses on a fixed number of worker threads fed by a bounded queue, so HTTP request
+    threads only enqueue and return. submit() raises queue.Full when the queue is saturated;
+    callers turn that into a 429. Finished results are also published to the analysis scheduler.
+    """
+    def __init__(self, max_workers=ANALYSIS_MAX_CONCURRENCY, queue_size=ANALYSIS_QUEUE_SIZE, timeout=ANALYSIS_CALL_TIMEOUT_SEC):
+        self.max_workers = max_workers; self.timeout = timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._in_call = {} # Worker thread name -> job whose call it is running
+        self.shed = 0 # Jobs rejected because the queue was full
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._workers = [w for w in self._workers if w.is_alive()]
+            for i in range(len(self._workers), self.max_workers):
+                worker = threading.Thread(target=self._work, name=f"AnalysisWorker-{i}", daemon=True)
+                worker.start(); self._workers.append(worker)
+
+    def stalled_workers(self):
+        """ Workers still blocked in a call whose job already timed out (only the Vertex SDK lacks a per-call timeout). """
+        with self._lock: jobs = list(self._in_call.values())
+        for job in jobs: job.check_deadline()
+        return sum(1 for job in jobs if job.state == "timeout")
+
+    def is_stalled(self):
+        """ True while every worker is stuck in a timed-out call: queued jobs would only wait and time out too. """
+        return self.stalled_workers() >= self.max_workers
+
+    def has_capacity(self, count_shed=False):
+        if self.is_stalled(): return False
+        if not self._queue.full(): return True
+        if count_shed:
+            with self._lock: self.shed += 1
+        return False
+
+    def submit(self, camera):
+        self._ensure_workers()
+        job = AnalysisJob(camera, self.timeout)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock: self.shed += 1
+            raise
+        with self._lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > ANALYSIS_JOB_RETENTION:
+                self._jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id):
+        with self._lock: return self._jobs.get(job_id)
+
+    def stats(self):
+        stalled = self.stalled_workers() # Marks overdue jobs timed out first
+        with self._lock:
+            running = sum(1 for j in self._jobs.values() if j.state == "running")
+            return {"queued": self._queue.qsize(), "queueSize": self._queue.maxsize, "running": running, "stalled": stalled,
+                    "maxConcurrency": self.max_workers, "shed": self.shed, "timeoutSec": self.timeout}
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.state = "running"; job.started_at = time.monotonic()
+            worker = threading.current_thread().name
+            with self._lock: self._in_call[worker] = job
+            try:
+                body, status, frame_ref = run_analysis(job.camera, timeout=job.timeout)
+            except Exception as e:
+                logging.error(f"Analysis job {job.job_id} failed: {e}", exc_info=True)
+                body, status, frame_ref = {"error": "Unexpected analysis error."}, 500, None
+            finally:
+                with self._lock: self._in_call.pop(worker, None)
+            finished = time.monotonic()
+            if job.state == "timeout":
+                logging.warning(f"Analysis job {job.job_id} finished after its deadline ({finished - job.started_at:.1f}s). Result discarded.")
+                continue
+            job.record = analysis_scheduler.publish(job.camera, body, status, frame_ref, finished - job.started_at)
+            signal_controller.on_analysis(job.record)
+            analysis_history.append(job.record)
+            event_bus.publish("analysis", job.record)
+            if status == 429: event_bus.publish("quota", {"cameraId": job.camera.cam_id, "analysisSeq": job.record["analysisSeq"], "message": body.get("quota_error")})
+            job.body = body; job.status = status; job.finished_at = finished; job.state = "done"
+            job.done.set()
+
+analysis_jobs = AnalysisJobPool()
+
+
+# --- Traffic Signal Controller ---
+SIGNAL_DIRECTIONS = ("A", "B", "C", "D")
+SIGNAL_CYCLE = [state for d, nxt in zip(SIGNAL_DIRECTIONS, SIGNAL_DIRECTIONS[1:] + SIGNAL_DIRECTIONS[:1])
+                for state in (f"{d}_GREEN", f"{d}_YELLOW", f"ALL_RED_BEFORE_{nxt}")]
+SIGNAL_ALL_RED_MS = 1000 # Clearance interval between directions
+SIGNAL_NO_ANALYSIS_STATES = ("A_YELLOW", "ALL_RED_BEFORE_B") # Direction A was just released: analyzing it is wasted quota
+SIGNAL_EVENT_RETENTION = 50
+
+def signal_smart_mode(camera_id=None):
+    """ Smart (AI) mode = the Direction A camera is running and an AI backend is available, as in the UI toggle. """
+    camera = get_camera(camera_id)
+    return AI_BACKEND_MODE != "NONE" and gemini_model is not None and camera is not None and camera.is_running
+
+class SignalController:
+    """
+    Server-side traffic signal state machine: ONE instance drives the intersection for every browser,
+    which only renders GET /api/signal. Directions A -> B -> C -> D each go GREEN -> YELLOW -> ALL_RED.
+    Phase ends are absolute deadlines on the injected clock (phase start + duration, with durations read
+    from `settings` on every tick so edits apply at once), so timing never drifts with processing delays
+    and a VirtualClock can step through hours of cycles without sleeping.
+    In smart mode Direction A follows the analysis results of `camera_id` (default camera):
+      - entering A_GREEN without vehicles seen skips straight to A_YELLOW;
+      - A_GREEN holds until the vehicles clear, maxTimeSmartA_Ms expires, or an analysis error
+        arrives after the normal green time has been served.
+    """
+    def __init__(self, settings=None, clock=None, smart_mode=None, camera_id=None):
+        self.settings = settings_store if settings is None else settings
+        self.clock = clock or MonotonicClock()
+        self.camera_id = camera_id # None = default camera
+        self._smart_mode = smart_mode or (lambda: signal_smart_mode(self.camera_id))
+        self._lock = threading.Lock()
+        self.state = None; self.phase_started = None; self.seq = 0; self.reason = None
+        self.smart = False
+        self.vehicles_present = False # Latest Direction A analysis, "False" until one arrives
+        self.green_started = dict.fromkeys(SIGNAL_DIRECTIONS) # Clock time each direction's green (+ yellow) began
+        self.last_green_ms = dict.fromkeys(SIGNAL_DIRECTIONS) # Duration of each direction's last green + yellow
+        self.events = collections.deque(maxlen=SIGNAL_EVENT_RETENTION)
+        self._wake = threading.Event(); self._stop = threading.Event()
+        self._thread = None
+
+    # --- Timing ---
+    def _setting_sec(self, key, default_ms):
+        value = self.settings.get(key) or default_ms
+        return max(float(value), 1.0) / 1000
+
+    def phase_duration(self, state):
+        """ Seconds the phase lasts in the current mode. """
+        if state.startswith("ALL_RED"): return SIGNAL_ALL_RED_MS / 1000
+        if state.endswith("_YELLOW"): return self._setting_sec("yellowLightDurationMs", 1000)
+        if state == "A_GREEN" and self.smart: return self._setting_sec("maxTimeSmartA_Ms", 10000) # Upper bound; results end it sooner
+        return self._setting_sec("greenLightDurationMs", 3000)
+
+    def _enter(self, state, at, reason):
+        """ Switches phase at clock time `at` (the previous deadline, not "now"). Caller holds _lock. """
+        if state.startswith("ALL_RED_BEFORE_"):
+            finished = SIGNAL_CYCLE[SIGNAL_CYCLE.index(state) - 2][0]
+            if self.green_started[finished] is not None:
+                self.last_green_ms[finished] = round((at - self.green_started[finished]) * 1000)
+                self.green_started[finished] = None
+        elif state.endswith("_GREEN"):
+            self.green_started[state[0]] = at
+        self.state = state; self.phase_started = at; self.reason = reason; self.seq += 1
+        self.events.append({"seq": self.seq, "state": state, "reason": reason, "smart": self.smart})
+        logging.info(f"Signal: {state} ({reason}).")
+        if state == "A_GREEN" and self.smart and not self.vehicles_present:
+            self._enter("A_YELLOW", at, "no vehicles detected on A, skipping green")
+
+    def tick(self):
+        """ Applies every transition that is due on the clock. Returns the clock time of the next deadline. """
+        with self._lock:
+            now = self.clock.now()
+            smart = bool(self._smart_mode())
+            if smart != self.smart:
+                self.smart = smart
+                self.events.append({"seq": self.seq, "state": self.state, "reason": f"smart mode {'on' if smart else 'off'}", "smart": smart})
+            if self.state is None: self._enter("A_GREEN", now, "start")
+            while True:
+                deadline = self.phase_started + self.phase_duration(self.state)
+                if deadline > now: return deadline
+                reason = "max time expired for A" if self.state == "A_GREEN" and self.smart else "timer"
+                self._enter(SIGNAL_CYCLE[(SIGNAL_CYCLE.index(self.state) + 1) % len(SIGNAL_CYCLE)], deadline, reason)
+
+    # --- Inputs ---
+    def on_analysis(self, record):
+        """ Feeds one published analysis record (AnalysisScheduler.publish). Only Direction A's camera counts. """
+        camera = get_camera(self.camera_id)
+        if record is None or camera is None or record.get("cameraId") != camera.cam_id: return
+        self.tick()
+        with self._lock:
+            result = record.get("result") if isinstance(record.get("result"), dict) else {}
+            ok = 200 <= record.get("status", 500) < 300 and "Vehicles_Present" in result
+            previous = self.vehicles_present
+            if ok: self.vehicles_present = result.get("Vehicles_Present") == "True" # Failed analyses keep the last good value
+            if self.state == "A_GREEN" and self.smart:
+                now = self.clock.now()
+                if ok and previous and not self.vehicles_present:
+                    self._enter("A_YELLOW", now, "vehicles cleared on A")
+                elif not ok and now - self.phase_started >= self._setting_sec("greenLightDurationMs", 3000):
+                    self._enter("A_YELLOW", now, f"analysis error (HTTP {record.get('status')}) after the standard green time")
+        self.wake()
+
+    def wants_analysis(self, cam_id):
+        """ False for Direction A's camera while A is being released, so the scheduler skips it. """
+        camera = get_camera(self.camera_id)
+        return camera is None or cam_id != camera.cam_id or self.state not in SIGNAL_NO_ANALYSIS_STATES
+
+    # --- Outputs ---
+    def snapshot(self):
+        with self._lock:
+            now = self.clock.now()
+            if self.state is None: return {"seq": 0, "state": None, "smart": self.smart}
+            deadline = self.phase_started + self.phase_duration(self.state)
+            direction = self.state[0] if not self.state.startswith("ALL_RED") else SIGNAL_CYCLE[SIGNAL_CYCLE.index(self.state) - 2][0]
+            lights = dict.fromkeys(SIGNAL_DIRECTIONS, "red")
+            if not self.state.startswith("ALL_RED"): lights[direction] = self.state.split("_")[1].lower()
+            return {
+                "seq": self.seq, "state": self.state, "reason": self.reason, "smart": self.smart,
+                "direction": direction, "lights": lights, "vehiclesPresent": self.vehicles_present,
+                "phaseElapsedMs": round((now - self.phase_started) * 1000),
+                "phaseRemainingMs": max(0, round((deadline - now) * 1000)),
+                "greenElapsedMs": {d: round((now - t) * 1000) if t is not None else None for d, t in self.green_started.items()},
+                "lastGreenMs": dict(self.last_green_ms),
+                "events": list(self.events),
+            }
+
+    # --- Runner (real clock only; tests call tick() after advancing a VirtualClock) ---
+    def wake(self): self._wake.set()
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SignalController", daemon=True)
+        self._thread.start()
 
+    def stop(self):
+        self._stop.set(); self._wake.set()
+        if self._thread: self._thread.join(timeout=2.0)
+
+    def _run(self):
+        logging.info("Signal controller started.")
+        published = None # (seq, smart) of the last snapshot sent on the event bus
+        while not self._stop.is_set():
+            try:
+                deadline = self.tick()
+                if (self.seq, self.smart) != published:
+                    snapshot = self.snapshot(); published = (snapshot["seq"], snapshot["smart"])
+                    event_bus.publish("signal", snapshot)
+            except Exception as e: logging.error(f"Signal controller error: {e}", exc_info=True); deadline = self.clock.now() + 1.0
+            # Sleep until the next deadline; re-check mode and settings at least once a second
+            self._wake.wait(min(max(deadline - self.clock.now(), 0.0), 1.0)); self._wake.clear()
+        logging.info("Signal controller stopped.")
+
+signal_controller = SignalController()
+settings_store.subscribe(lambda old, new: signal_controller.wake()) # New durations apply to the current phase
+ai_backend.add_listener(signal_controller.wake) # Smart mode becomes possible once the model is ready
+
+
+# --- Analysis History (SQLite, WAL) ---
+ANALYSIS_HISTORY_PATH = os.getenv("ANALYSIS_HISTORY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "analysis_history.db")) # "" disables
+ANALYSIS_HISTORY_RETENTION_DAYS = float(os.getenv("ANALYSIS_HISTORY_RETENTION_DAYS", "30"))
+ANALYSIS_HISTORY_QUEUE_SIZE = 10000 # Rows waiting for the writer before new ones are dropped
+HISTORY_SOURCES = ("ai", "cache", "local") # Stored as the index
+HISTORY_BUCKETS = {"minute": 60, "hour": 3600}
+HISTORY_MAX_BUCKETS = 10080 # A week of minutes per aggregate query
+HISTORY_MAX_RECORDS = 1000
+
+class AnalysisHistory:
+    """
+    Append-only store of every published analysis result in SQLite. Rows hold integers only (time in ms,
+    camera id, frame sequence, status, Vehicles_Present and the five counts, latency, source), about 40
+    bytes each with the (camera, ts) index, so weeks of results per junction fit in a few tens of MB.
+    The WAL journal lets API reads run while the single writer thread inserts queued rows in batches;
+    append() never blocks the analysis path. Rows older than the retention are deleted hourly and their
+    pages handed back to the filesystem (incremental auto-vacuum). Aggregates are computed by SQLite
+    (GROUP BY time bucket over the index), never by loading rows into Python.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cameras (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+        CREATE TABLE IF NOT EXISTS analysis (
+            ts INTEGER NOT NULL, camera INTEGER NOT NULL, frame_seq INTEGER, status INTEGER NOT NULL,
+            vehicles INTEGER, cars INTEGER, bikes INTEGER, trucks INTEGER, buses INTEGER, unknown INTEGER,
+            latency_ms INTEGER, capture_ms INTEGER, source INTEGER);
+        CREATE INDEX IF NOT EXISTS analysis_camera_ts ON analysis (camera, ts);
+    """
+    PRUNE_INTERVAL_SEC = 3600
+    BATCH_SIZE = 500
+
+    def __init__(self, path=ANALYSIS_HISTORY_PATH, retention_days=ANALYSIS_HISTORY_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self._queue = queue.Queue(maxsize=ANALYSIS_HISTORY_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._rows_written = ANALYSIS_HISTORY_ROWS.labels(outcome="written")
+        self._rows_dropped = ANALYSIS_HISTORY_ROWS.labels(outcome="dropped")
+
+    @property
+    def enabled(self): return bool(self.path)
+
+    # --- Writing ---
+    @staticmethod
+    def to_row(record):
+        """ Published record (AnalysisScheduler.publish) -> row tuple with the camera name in place of its id. """
+        result = record.get("result") if isinstance(record.get("result"), dict) else {}
+        status = int(record.get("status") or 0)
+        ok = 200 <= status < 300 and "Vehicles_Present" in result
+        counts = [int(result.get(key, 0)) for key in ("Cars", "Bikes", "Trucks", "Buses", "Unknown")] if ok else [None] * 5
+        source = result.get("source", "ai")
+        return (int((record.get("frameTimestamp") or record["timestamp"]) * 1000), record["cameraId"], record.get("frameSeq"), status,
+                (1 if result.get("Vehicles_Present") == "True" else 0) if ok else None, *counts,
+                int(record.get("durationMs") or 0), None if record.get("captureToResultMs") is None else int(record["captureToResultMs"]),
+                HISTORY_SOURCES.index(source) if source in HISTORY_SOURCES else None)
+
+    def append(self, record):
+        """ Queues one published record for the writer thread. Never blocks; drops (and counts) when the queue is full. """
+        if not self.enabled or record is None: return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="AnalysisHistoryWriter", daemon=True)
+                self._thread.start()
+        try: self._queue.put_nowait(self.to_row(record))
+        except queue.Full: self._rows_dropped.inc()
+        except (KeyError, TypeError, ValueError) as e: logging.warning(f"Analysis history: skipping malformed record: {e}")
+
+    def stop(self):
+        """ Flushes queued rows and stops the writer. """
+        self._stop.set()
+        if self._thread: self._thread.join(timeout=5.0)
+
+    def _connect_writer(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL") # Only takes effect on a new file, before the first table
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # Safe with WAL; a power cut loses at most the last batch
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    def _camera_id(self, conn, name, cache):
+        if name not in cache:
+            conn.execute("INSERT OR IGNORE INTO cameras (name) VALUES (?)", (name,))
+            cache[name] = conn.execute("SELECT id FROM cameras WHERE name = ?", (name,)).fetchone()[0]
+        return cache[name]
+
+    def _prune(self, conn):
+        if self.retention_days <= 0: return
+        cutoff = int((time.time() - self.retention_days * 86400) * 1000)
+        with conn: deleted = conn.execute("DELETE FROM analysis WHERE ts < ?", (cutoff,)).rowcount
+        if deleted:
+            conn.execute("PRAGMA incremental_vacuum")
+            logging.info(f"Analysis history: pruned {deleted} rows older than {self.retention_days:g} days.")
+
+    def _run(self):
+        try:
+            conn = self._connect_writer()
+        except sqlite3.Error as e:
+            logging.error(f"Analysis history disabled: cannot open {self.path}: {e}"); self.path = ""; return
+        logging.info(f"Analysis history: writing to {self.path} (retention {self.retention_days:g} days).")
+        camera_ids = {}; last_prune = 0.0
+        while not (self._stop.is_set() and self._queue.empty()):
+            try: rows = [self._queue.get(timeout=1.0)]
+            except queue.Empty: rows = []
+            while rows and len(rows) < self.BATCH_SIZE:
+                try: rows.append(self._queue.get_nowait())
+                except queue.Empty: break
+            try:
+                if rows:
+                    with conn: # One transaction per batch
+                        conn.executemany("INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                         [(row[0], self._camera_id(conn, row[1], camera_ids), *row[2:]) for row in rows])
+                    self._rows_written.inc(len(rows))
+                if time.monotonic() - last_prune > self.PRUNE_INTERVAL_SEC:
+                    self._prune(conn); last_prune = time.monotonic()
+            except sqlite3.Error as e:
+                logging.error(f"Analysis history: write failed ({len(rows)} rows lost): {e}")
+        conn.close()
+
+    # --- Reading (own read-only connection per call; WAL readers never block the writer) ---
+    def _query(self, sql, params=()):
+        if not self.enabled or not os.path.exists(self.path): return []
+        conn = sqlite3.connect(f"file:{urllib.parse.quote(self.path)}?mode=ro", uri=True, timeout=5)
+        try: return conn.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e): return [] # Writer has not created the schema yet
+            raise
+        finally: conn.close()
+
+    def records(self, camera_name, start, end, limit=HISTORY_MAX_RECORDS):
+        """ Newest-first rows in [start, end) (epoch seconds). """
+        rows = self._query("""
+            SELECT ts, frame_seq, status, vehicles, cars, bikes, trucks, buses, unknown, latency_ms, capture_ms, source
+            FROM analysis WHERE camera = (SELECT id FROM cameras WHERE name = ?) AND ts >= ? AND ts < ?
+            ORDER BY ts DESC LIMIT ?""", (camera_name, int(start * 1000), int(end * 1000), limit))
+        return [{"timestamp": ts / 1000, "frameSeq": seq, "status": status,
+                 "Vehicles_Present": None if vehicles is None else ("True" if vehicles else "False"),
+                 "Cars": cars, "Bikes": bikes, "Trucks": trucks, "Buses": buses, "Unknown": unknown,
+                 "durationMs": latency, "captureToResultMs": capture, "source": HISTORY_SOURCES[source] if source is not None else None}
+                for ts, seq, status, vehicles, cars, bikes, trucks, buses, unknown, latency, capture, source in rows]
+
+    def aggregate(self, camera_name, bucket_sec, start, end):
+        """ Per-bucket statistics over [start, end), computed in SQLite. Counts average successful results only. """
+        bucket_ms = int(bucket_sec * 1000)
+        rows = self._query("""
+            SELECT ts / ? * ? AS bucket, COUNT(*), COUNT(vehicles), SUM(vehicles),
+                   AVG(cars), AVG(bikes), AVG(trucks), AVG(buses), AVG(unknown), MAX(cars + bikes + trucks + buses + unknown),
+                   AVG(latency_ms), SUM(source = 0)
+            FROM analysis WHERE camera = (SELECT id FROM cameras WHERE name = ?) AND ts >= ? AND ts < ?
+            GROUP BY bucket ORDER BY bucket""", (bucket_ms, bucket_ms, camera_name, int(start * 1000), int(end * 1000)))
+        rounded = lambda v, digits=2: None if v is None else round(v, digits)
+        return [{"start": bucket / 1000, "results": total, "ok": ok, "errors": total - ok, "aiCalls": ai_calls,
+                 "vehiclesPresentShare": rounded(present / ok, 3) if ok else None,
+                 "avg": {"Cars": rounded(cars), "Bikes": rounded(bikes), "Trucks": rounded(trucks), "Buses": rounded(buses), "Unknown": rounded(unknown)},
+                 "maxVehicles": max_vehicles, "avgLatencyMs": rounded(latency, 1)}
+                for bucket, total, ok, present, cars, bikes, trucks, buses, unknown, max_vehicles, latency, ai_calls in rows]
+
+    def stats(self):
+        info = {"enabled": self.enabled, "path": self.path or None, "retentionDays": self.retention_days,
+                "queued": self._queue.qsize(), "written": int(self._rows_written.value), "dropped": int(self._rows_dropped.value)}
+        if self.enabled and os.path.exists(self.path):
+            info["bytes"] = sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+            rows = self._query("SELECT COUNT(*), MIN(ts), MAX(ts) FROM analysis")
+            if rows:
+                count, oldest, newest = rows[0]
+                info.update(rows=count, oldest=oldest / 1000 if oldest else None, newest=newest / 1000 if newest else None)
+        return info
+
+analysis_history = AnalysisHistory()
+
+
+# --- Event Bus (Server-Sent Events) ---
+# State changes are pushed to browsers as Server-Sent Events, so every tab sees what any tab (or the server)
+# changed without polling. Event types and data:
+#   analysis  an analysis record (see AnalysisScheduler.publish)     camera  a camera's status()
+#   settings  {version, values, cameras}                              quota   {cameraId, analysisSeq, message}
+#   signal    the /api/signal snapshot, on every phase change          ai      the AI backend status, once ready
+#   resync    sent instead of a replay the server no longer has (or from an earlier run): reload state over REST
+# The server's port is served by one asyncio thread, the front: it answers GET /api/events itself and passes
+# every other connection byte for byte to Waitress on a loopback port. An event stream client is a socket
+# and the sequence number it has been sent up to, not a Waitress thread, so hundreds of them cost one thread
+# and WAITRESS_THREADS only has to cover the API and the video streams. Proxied requests are sent on with
+# "Connection: close": the client's next request arrives on a new connection, whose request line is routed again.
+EVENTS_REPLAY_SIZE = int(os.getenv("EVENTS_REPLAY_SIZE", "500")) # Events kept for clients resuming with Last-Event-ID
+EVENTS_MAX_CLIENTS = int(os.getenv("EVENTS_MAX_CLIENTS", "1000"))
+EVENTS_CLIENT_BUFFER_BYTES = 1024 * 1024 # A client this far behind is disconnected; it resumes from its Last-Event-ID
+EVENTS_HEARTBEAT_SEC = 15 # Comment line keeping idle connections (and proxies) open
+EVENTS_RETRY_MS = 2000 # Browser reconnect delay
+EVENTS_HEADERS = (b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n"
+                  b"X-Accel-Buffering: no\r\n\r\n")
+FRONT_HEAD_TIMEOUT_SEC = 10 # Time a new connection has to send its request line and headers
+FRONT_MAX_LINE_BYTES = 64 * 1024 # Longest request line or header line
+FRONT_COPY_CHUNK_BYTES = 256 * 1024 # Read size when passing bytes between a client and Waitress
+
+class _EventClient:
+    __slots__ = ("writer", "last_seq")
+    def __init__(self, writer, last_seq): self.writer = writer; self.last_seq = last_seq
+
+def _retrieve_exception(task):
+    """ Done callback: a copy task's error is expected (the peer left), don't log it as unretrieved. """
+    if not task.cancelled(): task.exception()
+
+class EventBus:
+    """
+    In-process publish/subscribe served as Server-Sent Events by the front (see above). publish() may be called
+    from any thread: it numbers the event, formats it once, keeps it in a bounded replay buffer and schedules
+    one fan-out on the event loop, which writes the same bytes to every client's transport. One thread and one
+    event loop serve all clients, and also pass the other requests through to Waitress.
+    Event ids are "<epoch>-<seq>", so an id from an earlier server run is recognized and answered with resync.
+    """
+    def __init__(self, replay_size=EVENTS_REPLAY_SIZE):
+        self.epoch = format(int(time.time() * 1000), "x")
+        self._seq = 0; self._replay = collections.deque(maxlen=replay_size)
+        self._lock = threading.Lock() # Orders seq assignment, the replay buffer and fan-out scheduling
+        self._loop = None; self._clients = set(); self._stopped = None
+        self._thread = None; self._listening = threading.Event(); self.port = None; self.upstream_port = None
+        self._clients_gauge = EVENTS_CLIENTS.labels()
+        self._dropped_slow = EVENTS_CLIENTS_DROPPED.labels(reason="slow"); self._dropped_full = EVENTS_CLIENTS_DROPPED.labels(reason="full")
+
+    def publish(self, event_type, data):
+        """ Queues one event for every client. Never blocks on the network; harmless while the front is not running. """
+        body = json.dumps(data, default=str, separators=(",", ":"))
+        with self._lock:
+            self._seq += 1
+            payload = f"id: {self.epoch}-{self._seq}\nevent: {event_type}\ndata: {body}\n\n".encode()
+            self._replay.append((self._seq, payload))
+            if self._loop is not None: self._loop.call_soon_threadsafe(self._fan_out, self._seq, payload)
+        EVENTS_PUBLISHED.inc(type=event_type)
+
+    def replay_since(self, last_event_id):
+        """ (payloads after last_event_id, newest seq, resync needed). No id: nothing to replay. """
+        with self._lock:
+            newest = self._seq
+            if not last_event_id: return [], newest, False
+            epoch, _, seq = last_event_id.partition("-")
+            try: seq = int(seq)
+            except ValueError: return [], newest, True
+            oldest = self._replay[0][0] if self._replay else newest + 1
+            if epoch != self.epoch or seq > newest or seq < oldest - 1: return [], newest, True
+            return [payload for s, payload in self._replay if s > seq], newest, False
+
+    def _fan_out(self, seq, payload):
+        """ Event loop: writes one event to every client that has not had it yet (it may have come with a replay). """
+        for client in list(self._clients):
+            if seq <= client.last_seq: continue
+            transport = client.writer.transport
+            if transport.get_write_buffer_size() > EVENTS_CLIENT_BUFFER_BYTES:
+                self._dropped_slow.inc(); self._drop(client); transport.abort(); continue
+            client.writer.write(payload); client.last_seq = seq
+
+    def _drop(self, client):
+        if client in self._clients: self._clients.discard(client); self._clients_gauge.dec()
+
+    async def _handle(self, reader, writer):
+        """ One connection to the front: an event stream, or a request passed through to Waitress. """
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), FRONT_HEAD_TIMEOUT_SEC)
+            if not request_line: return
+            header_lines = []; headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), FRONT_HEAD_TIMEOUT_SEC)
+                if line in (b"\r\n", b"\n", b""): break
+                header_lines.append(line)
+                name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+            method, target = (request_line.decode("latin-1").split(" ") + ["", ""])[:2]
+            path, _, query = target.partition("?")
+            if method == "GET" and path == "/api/events": await self._stream(reader, writer, headers, query)
+            else: await self._proxy(request_line, header_lines, reader, writer)
+        except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionError, UnicodeDecodeError, ValueError): pass # Cancelled: server shutting down
+        finally: writer.close()
+
+    async def _stream(self, reader, writer, headers, query):
+        if len(self._clients) >= EVENTS_MAX_CLIENTS:
+            self._dropped_full.inc()
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 10\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"); return
+        # EventSource resends the id of the last event it received; ?lastEventId= covers clients that cannot set headers
+        last_event_id = headers.get("last-event-id") or urllib.parse.parse_qs(query).get("lastEventId", [""])[0]
+        replay, newest, resync = self.replay_since(last_event_id)
+        writer.write(EVENTS_HEADERS + f"retry: {EVENTS_RETRY_MS}\n\n".encode())
+        if resync: writer.write(b'event: resync\ndata: {"reason":"events since Last-Event-ID are no longer available"}\n\n')
+        for payload in replay: writer.write(payload)
+        # Registered in the same loop step as the replay, so a fan-out already scheduled for <= newest is skipped
+        client = _EventClient(writer, newest); self._clients.add(client); self._clients_gauge.inc()
+        try:
+            while await reader.read(1024): pass # Clients send nothing more; EOF means they left
+        finally: self._drop(client)
+
+    async def _proxy(self, request_line, header_lines, reader, writer):
+        """ Passes one request and its response between the client and Waitress, then closes the connection. """
+        try: upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", self.upstream_port)
+        except OSError as e:
+            logging.error(f"Front: web server not reachable: {e}")
+            writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"); return
+        kept = [line for line in header_lines if not line.lower().startswith((b"connection:", b"keep-alive:"))]
+        upstream_writer.write(request_line + b"".join(kept) + b"Connection: close\r\n\r\n")
+        upload = asyncio.ensure_future(self._copy(reader, upstream_writer)); upload.add_done_callback(_retrieve_exception)
+        try: await self._copy(upstream_reader, writer) # Waitress closes after the response
+        finally: upload.cancel(); upstream_writer.close()
+
+    @staticmethod
+    async def _copy(reader, writer):
+        while data := await reader.read(FRONT_COPY_CHUNK_BYTES):
+            writer.write(data); await writer.drain() # Waits while the receiver is slow: back-pressure reaches Waitress
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(EVENTS_HEARTBEAT_SEC)
+            for client in list(self._clients): client.writer.write(b": ping\n\n")
+
+    async def _serve(self, host, port):
+        self._stopped = asyncio.Event()
+        try: server = await asyncio.start_server(self._handle, host, port, reuse_address=True, limit=FRONT_MAX_LINE_BYTES)
+        except OSError as e: logging.error(f"Front: cannot listen on port {port}: {e}"); self._listening.set(); return
+        with self._lock: self._loop = asyncio.get_running_loop()
+        self.port = server.sockets[0].getsockname()[1]; self._listening.set()
+        heartbeat = asyncio.create_task(self._heartbeat())
+        async with server:
+            await self._stopped.wait()
+            heartbeat.cancel()
+            with self._lock: self._loop = None
+            for client in list(self._clients): self._drop(client); client.writer.transport.abort()
+
+    def start(self, upstream_port, host="0.0.0.0", port=PORT):
+        """ Starts the front on `port`, passing requests other than /api/events to Waitress on `upstream_port`. False if it cannot listen. """
+        if self._thread and self._thread.is_alive(): return True
+        self.upstream_port = upstream_port; self._listening.clear()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(host, port),), name="EventBus", daemon=True)
+        self._thread.start(); self._listening.wait(5.0)
+        return self.port is not None
+
+    def stop(self):
+        loop = self._loop
+        if loop is not None: loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread: self._thread.join(timeout=2.0)
+
+    def stats(self):
+        with self._lock: return {"port": self.port, "clients": len(self._clients), "maxClients": EVENTS_MAX_CLIENTS,
+                                 "lastEventId": f"{self.epoch}-{self._seq}", "replayed": len(self._replay), "replaySize": self._replay.maxlen}
+
+event_bus = EventBus()
+settings_store.subscribe(lambda old, new: event_bus.publish("settings", {
+    "version": new.version, "values": dict(new.values), "cameras": {cam_id: config.as_settings() for cam_id, config in new.cameras.items()}}))
+ai_backend.add_listener(lambda: event_bus.publish("ai", ai_backend.status()))
+
+@app.route('/api/events')
+def events():
+    """ Only reached when the front is not running (Flask development server, benchmark): it serves the stream itself. """
+    return jsonify({"error": "Event stream is not running."}), 503
+
+@app.route('/api/events/stats')
+def events_stats():
+    return jsonify(event_bus.stats())
+
+
+# --- Analysis Routes ---
+@app.route('/api/analyze', methods=['POST'], defaults={'cam_id': None})
+@app.route('/api/analyze/<cam_id>', methods=['POST'])
+def analyze_image(cam_id):
+    """
+    Enqueues an on-demand analysis job and returns 202 with its id right away; fetch the result from
+    GET /api/analysis/jobs/<job_id>. Shares the scheduler's rate governor (429 when its tokens are spent,
+    503 while the circuit breaker is open) and sheds load with 429 when the job queue is full or 503 when
+    the AI backend is unavailable.
+    """
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    if AI_BACKEND_MODE == "NONE" or gemini_model is None:
+        if ai_backend.state in ("pending", "initializing"): return jsonify({"error": "AI backend is still initializing.", "retry_after": 2}), 503, {"Retry-After": "2"}
+        return jsonify({"error": "AI backend not available."}), 503
+    if not camera.is_running:
+        return jsonify({"error": "Analysis stopped: Camera not running."}), 409
+    if analysis_jobs.is_stalled():
+        ANALYSIS_REJECTED.inc(reason="stalled")
+        return jsonify({"error": "All analysis workers are stuck in calls past their timeout. Try again later.", "retry_after": 5}), 503, {"Retry-After": "5"}
+    if not analysis_jobs.has_capacity(count_shed=True):
+        ANALYSIS_REJECTED.inc(reason="queue_full")
+        return jsonify({"error": "Analysis queue is full. Try again shortly.", "retry_after": 1}), 429, {"Retry-After": "1"}
+    wait = rate_governor.try_acquire()
+    if wait > 0 and rate_governor.breaker != "closed":
+        ANALYSIS_REJECTED.inc(reason="circuit_open")
+        return jsonify({"error": "AI calls are paused after repeated failures (circuit breaker open).", "retry_after": round(wait, 2)}), 503, {"Retry-After": str(int(wait) + 1)}
+    if wait > 0:
+        ANALYSIS_REJECTED.inc(reason="rate_limit")
+        return jsonify({"error": f"Analysis rate limit reached ({round(rate_governor.effective_rpm, 2):g} of {rate_governor.configured_rpm:g} calls/min{', backed off after errors' if rate_governor.effective_rpm < rate_governor.configured_rpm else ''}).", "retry_after": round(wait, 2)}), 429, {"Retry-After": str(int(wait) + 1)}
+    try:
+        job = analysis_jobs.submit(camera)
+    except queue.Full:
+        ANALYSIS_REJECTED.inc(reason="queue_full")
+        return jsonify({"error": "Analysis queue is full. Try again shortly.", "retry_after": 1}), 429, {"Retry-After": "1"}
+    status_url = f"/api/analysis/jobs/{job.job_id}"
+    return jsonify({**job.to_dict(), "statusUrl": status_url}), 202, {"Location": status_url}
+
+@app.route('/api/analysis/jobs/<job_id>')
+def analysis_job_status(job_id):
+    """ Job state and, once done, its result. `?wait=<sec>` long-polls (max 30s) until the job finishes. """
+    job = analysis_jobs.get(job_id)
+    if job is None: return jsonify({"error": f"Unknown or expired job '{job_id}'."}), 404
+    wait = min(max(request.args.get("wait", default=0.0, type=float), 0.0), 30.0)
+    deadline = time.monotonic() + wait
+    while not job.done.is_set() and time.monotonic() < deadline:
+        job.done.wait(min(0.5, deadline - time.monotonic())); job.check_deadline()
+    return jsonify(job.to_dict())
+
+@app.route('/api/analysis/jobs')
+def analysis_job_stats():
+    return jsonify(analysis_jobs.stats())
+
+@app.route('/api/analysis/cache')
+def analysis_cache_stats():
+    """ Change-detection cache hit/miss counters per camera. """
+    return jsonify({cam_id: camera.analysis_cache.stats() for cam_id, camera in camera_registry.items()})
+
+@app.route('/api/analysis/prefilter')
+def analysis_prefilter_stats():
+    """ Local pre-filter state per camera (null when LOCAL_PREFILTER is off). """
+    return jsonify({cam_id: camera.prefilter.stats() if camera.prefilter else None for cam_id, camera in camera_registry.items()})
+
+@app.route('/api/analysis/mock')
+def analysis_mock_stats():
+    """ Call and outcome counters of the MOCK backend (404 for real backends). """
+    if AI_BACKEND_MODE != "MOCK": return jsonify({"error": "AI_BACKEND is not MOCK."}), 404
+    return jsonify(gemini_model.stats())
+
+@app.route('/api/analysis/latest', defaults={'cam_id': None})
+@app.route('/api/analysis/latest/<cam_id>')
+def latest_analysis(cam_id):
+    """ Newest published analysis for a camera. `?since=<analysisSeq>` returns 204 when nothing newer exists. """
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    record = analysis_scheduler.latest(camera.cam_id)
+    since = request.args.get("since", type=int)
+    if record is None or (since is not None and record["analysisSeq"] <= since):
+        return "", 204
+    return jsonify(record)
+
+def history_time_range(default_span_sec):
+    """ [from, to) in epoch seconds from the query string; defaults to the last default_span_sec. """
+    end = request.args.get("to", default=time.time(), type=float)
+    start = request.args.get("from", default=end - default_span_sec, type=float)
+    if start >= end: raise ValueError("'from' must be before 'to'.")
+    return start, end
+
+@app.route('/api/history', defaults={'cam_id': None})
+@app.route('/api/history/<cam_id>')
+def analysis_history_records(cam_id):
+    """ Stored analysis results, newest first. `?from=&to=` (epoch seconds, default last hour), `?limit=` (max 1000). """
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    try: start, end = history_time_range(3600)
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    limit = min(max(request.args.get("limit", default=100, type=int), 1), HISTORY_MAX_RECORDS)
+    return jsonify({"cameraId": camera.cam_id, "from": start, "to": end, "records": analysis_history.records(camera.cam_id, start, end, limit)})
+
+@app.route('/api/history/aggregate', defaults={'cam_id': None})
+@app.route('/api/history/aggregate/<cam_id>')
+def analysis_history_aggregate(cam_id):
+    """ Per-minute or per-hour aggregates: `?bucket=minute|hour&from=&to=` (default last hour / last day). """
+    camera = get_camera(cam_id)
+    if camera is None: return jsonify({"error": f"Unknown camera '{cam_id}'."}), 404
+    bucket = request.args.get("bucket", "minute")
+    if bucket not in HISTORY_BUCKETS: return jsonify({"error": f"bucket must be one of {list(HISTORY_BUCKETS)}."}), 400
+    bucket_sec = HISTORY_BUCKETS[bucket]
+    try: start, end = history_time_range(3600 if bucket == "minute" else 86400)
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    if (end - start) / bucket_sec > HISTORY_MAX_BUCKETS:
+        return jsonify({"error": f"Range too long for {bucket} buckets (max {HISTORY_MAX_BUCKETS})."}), 400
+    return jsonify({"cameraId": camera.cam_id, "bucket": bucket, "from": start, "to": end,
+                    "buckets": analysis_history.aggregate(camera.cam_id, bucket_sec, start, end)})
+
+@app.route('/api/history/stats')
+def analysis_history_stats():
+    return jsonify(analysis_history.stats())
+
+@app.route('/api/signal')
+def signal_state():
+    """ Current traffic signal phase from the server-side controller; the browser only renders it. """
+    return jsonify(signal_controller.snapshot())
+
+
+# --- Health & Readiness ---
+READYZ_MAX_FRAME_AGE_SEC = 5.0 # A running camera whose newest frame is older than this is not live
+
+def subsystem_status():
+    """ (subsystems, problems): per-subsystem state and the reasons the instance is not ready. """
+    problems = []; now = time.monotonic()
+    cameras = {}
+    for cam_id, camera in camera_registry.items():
+        ref = camera.ring.latest()
+        frame_age = round(now - ref.timestamp, 3) if ref is not None else None
+        cameras[cam_id] = {"state": camera.state, "frameAgeSec": frame_age}
+        if camera.is_running and (camera.state != "running" or frame_age is None or frame_age > READYZ_MAX_FRAME_AGE_SEC):
+            problems.append(f"camera {cam_id} is {camera.state}, newest frame {'missing' if frame_age is None else f'{frame_age:.1f}s old'}")
+    streams = {cam_id: {"fullClients": camera.stream_full.client_count, "croppedClients": camera.stream_cropped.client_count}
+               for cam_id, camera in camera_registry.items()}
+    threads = {"analysisScheduler": analysis_scheduler._thread, "signalController": signal_controller._thread, "eventBus": event_bus._thread}
+    workers = {name: ("stopped" if thread is None else "running" if thread.is_alive() else "dead") for name, thread in threads.items()}
+    return {"ai": ai_backend.status(), "rateGovernor": rate_governor.status(), "cameras": cameras, "streams": streams, "workers": workers,
+            "settingsVersion": settings_store.current.version}, problems
+
+@app.route('/healthz')
+def healthz():
+    """ Liveness: 200 while the process serves requests and no started worker thread has died. Includes the startup report. """
+    subsystems, _ = subsystem_status()
+    dead = [name for name, state in subsystems["workers"].items() if state == "dead"]
+    body = {"status": "unhealthy" if dead else "ok", "uptimeSec": round(time.monotonic() - start_time, 1), "subsystems": subsystems, "startup": startup.as_dict()}
+    return jsonify(body), 503 if dead else 200
+
+@app.route('/readyz')
+def readyz():
+    """
+    Readiness: 200 once every started camera is delivering live frames. The AI backend does not gate
+    readiness (video and the fixed-cycle signal work without it); it is reported as `degraded` instead.
+    """
+    subsystems, problems = subsystem_status()
+    body = {"ready": not problems, "degraded": subsystems["ai"]["state"] != "ready", "problems": problems, "subsystems": subsystems}
+    return jsonify(body), 200 if not problems else 503
+
+# --- Metrics Endpoint ---
+def _stream_broadcasters():
+    return [b for camera in camera_registry.values() for b in (camera.stream_full, camera.stream_cropped)]
+
+Gauge("stream_clients", "Active MJPEG clients per stream.", ["stream"],
+      collect=lambda: [((b.name,), b.client_count) for b in _stream_broadcasters()])
+Gauge("stream_client_delivered_fps", "Average frames per second delivered to each connected MJPEG client.", ["stream", "client"],
+      collect=lambda: [((b.name, client_id), fps) for b in _stream_broadcasters() for client_id, fps in b.client_rates()])
+Gauge("waitress_threads", "Configured Waitress worker threads.", collect=lambda: [((), WAITRESS_THREADS)])
+Gauge("analysis_jobs", "Analysis jobs by state (queued, running).", ["state"],
+      collect=lambda: [(("queued",), analysis_jobs.stats()["queued"]), (("running",), analysis_jobs.stats()["running"])])
+
+@app.route('/metrics')
+def metrics():
+    """ Prometheus text exposition of the hot-path metrics. """
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+# --- Capture Processes (CAPTURE_PROCESS=1) ---
+CAPTURE_PROCESS = os.getenv("CAPTURE_PROCESS", "0").lower() in ("1", "true", "yes") # One capture process per camera
+CAPTURE_SEGMENT_PREFIX = os.getenv("CAPTURE_SEGMENT_PREFIX", "tsig-") # Segment = prefix + camera id, shared by web processes with the same prefix
+CAPTURE_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "capture_worker.py")
+CAPTURE_WORKER_RESTART_SEC = 2.0 # Supervisor check interval; a worker that exited is started again
+CAPTURE_WORKER_CLAIM_SEC = 3.0 # After a settings change, how long this process waits to restart the worker before the others may
+# The analysis scheduler and signal controller run per web process: with several, let only one drive the signal
+SIGNAL_DRIVER = os.getenv("SIGNAL_DRIVER", "1").lower() not in ("0", "false", "no")
+
+class CaptureProcesses:
+    """
+    Feeds every camera from a capture_worker.py process through the segment named after the camera
+    (CAPTURE_SEGMENT_PREFIX + id): the camera reads "shm:<name>" instead of its source, its settings stay
+    as configured. Web processes that share a prefix share the workers: the first one to start a camera's
+    worker runs it, the others find its capture lock held and only read the segment. Any of them restarts
+    a worker that exits, and a source or resolution change restarts the worker with the new settings
+    (stopping it with SIGTERM when another process started it). A worker exits if the process that
+    started it dies, and another web process takes over.
+    """
+    def __init__(self):
+        self._workers = {} # cam_id -> {"name", "source", "resolution", "process", "attached"}
+        self._lock = threading.Lock()
+        self._stop = threading.Event(); self._wake = threading.Event(); self._thread = None
+
+    def start(self, cameras):
+        snapshot = settings_store.current
+        with self._lock:
+            for cam_id, camera in cameras.items():
+                config = snapshot.cameras[cam_id]
+                if config.source.startswith("shm:"): continue # Fed by a worker started by hand
+                name = CAPTURE_SEGMENT_PREFIX + re.sub(r'[^A-Za-z0-9_.-]', '_', cam_id)
+                self._workers[cam_id] = {"name": name, "source": config.source, "resolution": config.resolution, "process": None, "attached": False}
+                camera.capture_segment = name
+                self._ensure(cam_id)
+        if not self._workers: return
+        settings_store.subscribe(self.on_settings_changed)
+        self._thread = threading.Thread(target=self._supervise, name="CaptureProcesses", daemon=True)
+        self._thread.start()
+
+    def _ensure(self, cam_id):
+        """ Caller holds _lock. Starts the camera's worker unless this or another process runs one. """
+        worker = self._workers[cam_id]; process = worker["process"]
+        if process is not None:
+            code = process.poll()
+            if code is None: return
+            worker["process"] = None; restart = worker.pop("restart", False)
+            # 0: stopped (by us or another process, for new settings); CAPTURE_WORKER_BUSY: another process's worker got the lock first
+            if code not in (0, CAPTURE_WORKER_BUSY) and not restart: logging.warning(f"Camera {cam_id}: capture process exited with code {code}, restarting it.")
+        if capture_running(worker["name"]):
+            if worker.get("claim", 0) > time.monotonic(): return # The stopped worker has not let go yet
+            if not worker["attached"]: logging.info(f"Camera {cam_id}: reading shared memory '{worker['name']}' from another server process's capture process.")
+            worker["attached"] = True; worker.pop("claim", None); return
+        worker["attached"] = False; worker.pop("claim", None)
+        command = [sys.executable, CAPTURE_WORKER_SCRIPT, "--name", worker["name"], "--source", worker["source"], "--resolution", worker["resolution"],
+                   "--quality", str(STREAM_JPEG_QUALITY), "--parent-pid", str(os.getpid())]
+        worker["process"] = subprocess.Popen(command)
+        logging.info(f"Camera {cam_id}: capture process {worker['process'].pid} writing to shared memory '{worker['name']}'.")
+
+    def wait_ready(self, timeout=10.0):
+        """ Waits until every worker has created its segment (its first frame). Returns False on timeout. """
+        deadline = time.monotonic() + timeout
+        with self._lock: names = [w["name"] for w in self._workers.values()]
+        for name in names:
+            while True:
+                try: SharedFrameBuffer.attach(name).close(); break
+                except (FileNotFoundError, ValueError):
+                    if time.monotonic() > deadline: logging.warning(f"Capture process for '{name}' has no frames after {timeout:.0f}s."); return False
+                    time.sleep(0.05)
+        return True
+
+    def on_settings_changed(self, old, new):
+        """ SettingsStore subscriber: a new source or resolution takes a worker restart (the size is fixed per segment). """
+        with self._lock:
+            for cam_id, worker in self._workers.items():
+                config = new.cameras[cam_id]
+                if (config.source, config.resolution) == (worker["source"], worker["resolution"]): continue
+                logging.info(f"Camera {cam_id}: restarting its capture process for source {config.source}, resolution {config.resolution}.")
+                worker["source"], worker["resolution"] = config.source, config.resolution
+                worker["claim"] = time.monotonic() + CAPTURE_WORKER_CLAIM_SEC
+                if worker["process"] is not None: worker["restart"] = True; worker["process"].terminate(); continue
+                try:
+                    buffer = SharedFrameBuffer.attach(worker["name"]); pid = buffer.writer_pid; buffer.close()
+                    os.kill(pid, signal.SIGTERM)
+                except (FileNotFoundError, ValueError, ProcessLookupError) as e:
+                    logging.warning(f"Camera {cam_id}: cannot stop the capture process of another server process: {e}")
+        self._wake.set()
+
+    def _supervise(self):
+        while not self._stop.is_set():
+            with self._lock: claiming = any("claim" in w for w in self._workers.values())
+            self._wake.wait(0.05 if claiming else CAPTURE_WORKER_RESTART_SEC); self._wake.clear()
+            with self._lock:
+                if self._stop.is_set(): break
+                for cam_id in self._workers: self._ensure(cam_id)
+
+    def stop(self):
+        """ Stops the workers this process started; another web process's supervisor takes them over. """
+        self._stop.set(); self._wake.set()
+        with self._lock: processes = [w["process"] for w in self._workers.values() if w["process"] is not None]
+        for process in processes:
+            if process.poll() is None: process.terminate()
+        for process in processes:
+            try: process.wait(timeout=3)
+            except subprocess.TimeoutExpired: logging.warning(f"Capture process {process.pid} did not exit, killing it."); process.kill()
+
+capture_processes = CaptureProcesses()
+
+# --- Camera Autostart ---
+CAMERA_AUTOSTART = os.getenv("CAMERA_AUTOSTART", "0").lower() in ("1", "true", "yes") # Start every camera when the server starts
+
+def autostart_cameras():
+    """ Starts every registered camera, as if /api/camera/<cam_id>/start had been posted. """
+    if CAPTURE_PROCESS:
+        with startup.step("capture processes ready"): capture_processes.wait_ready()
+    for camera in camera_registry.values():
+        began = time.monotonic()
+        with camera.start_lock: started = camera.start()
+        startup.record(f"camera {camera.cam_id} start", began, background=True)
+        if not started: logging.error(f"Autostart: camera {camera.cam_id} could not be started.")
+    signal_controller.wake()
 
 # --- Cleanup Hook ---
 @atexit.register
 def cleanup_on_exit():
     logging.info("Application exit detected. Running cleanup...")
-    acquired = camera_start_lock.acquire(timeout=1.0)
-    if acquired:
-        try: stop_camera_process()
-        finally: camera_start_lock.release(); logging.info("Cleanup lock released.")
-    else: logging.warning("Could not acquire lock during exit cleanup. Camera might not be released cleanly.")
+    analysis_scheduler.stop()
+    signal_controller.stop()
+    analysis_history.stop() # Flush queued rows
+    event_bus.stop()
+    for camera in camera_registry.values():
+        acquired = camera.start_lock.acquire(timeout=1.0)
+        if acquired:
+            try: camera.stop()
+            finally: camera.start_lock.release(); logging.info(f"Cleanup lock released (camera {camera.cam_id}).")
+        else: logging.warning(f"Could not acquire lock during exit cleanup. Camera {camera.cam_id} might not be released cleanly.")
+    capture_processes.stop() # After the cameras have detached from their segments
     logging.info("Cleanup finished.")
 
 
 # --- Run Application ---
 if __name__ == '__main__':
-    print(f"[{time.monotonic() - start_time:.3f}s] Entering main execution block (__name__ == '__main__').")
     logging.info(f"Starting Flask application...")
-    logging.info(f"AI Backend Mode: {AI_BACKEND_MODE}") # Log the effective mode
-    if AI_BACKEND_MODE != "NONE":
-        logging.info(f"AI Model: {model_name_info}")
-    else:
-        logging.warning("AI Analysis features will be unavailable.")
-
-    print(f"[{time.monotonic() - start_time:.3f}s] Attempting to start web server...")
+    if CAPTURE_PROCESS:
+        with startup.step("capture processes"): capture_processes.start(camera_registry)
+    if SIGNAL_DRIVER: analysis_scheduler.start(); signal_controller.start()
+    else: logging.info("SIGNAL_DRIVER=0: analysis scheduler and signal controller not started in this process.")
+    if CAMERA_AUTOSTART: # Open devices in the background so the server is listening first
+        threading.Thread(target=autostart_cameras, name="CameraAutostart", daemon=True).start()
     # Use Waitress for a more production-ready server than Flask's default
     try:
-        from waitress import serve
-        print(f"[{time.monotonic() - start_time:.3f}s] Starting Waitress server on 0.0.0.0:5000...")
-        serve(app, host='0.0.0.0', port=5000, threads=10) # Listen on all interfaces
+        from waitress import create_server
+        with startup.step("web server bind"):
+            # Waitress listens on loopback only; the front (see "Event Bus") takes PORT on all interfaces and passes requests on
+            server = create_server(app, host='127.0.0.1', port=0, threads=WAITRESS_THREADS, outbuf_high_watermark=WAITRESS_OUTBUF_HIGH_WATERMARK)
+            if not event_bus.start(server.effective_port): raise RuntimeError(f"cannot listen on port {PORT}")
+        startup.mark_ready(); startup.log()
+        logging.info(f"Serving on http://0.0.0.0:{PORT} (AI backend {ai_backend.state}).")
+        server.run()
     except ImportError:
         logging.warning("Waitress not installed. Falling back to Flask development server (not recommended for production).")
-        print(f"[{time.monotonic() - start_time:.3f}s] Starting Flask development server on 0.0.0.0:5000...")
-        app.run(host='0.0.0.0', port=5000, debug=False) # Debug mode False
+        startup.mark_ready(); startup.log()
+        app.run(host='0.0.0.0', port=PORT, debug=False) # Debug mode False
     except Exception as run_err:
          logging.critical(f"Failed to start the web server: {run_err}", exc_info=True)
-         print(f"[{time.monotonic() - start_time:.3f}s] Web server FAILED to start.")
\ No newline at end of file
@@ -0,0 +1,277 @@
+"""
+Headless benchmark suite for the hot paths of app.py: capture, stream encode, crop + encode,
+MJPEG streaming through Waitress and Gemini response parsing.
+
+    python benchmark.py                                         # synthetic source, every benchmark
+    python benchmark.py --source file:traffic.mp4 --output bench-1.2.json
+    python benchmark.py --only encode,parse --duration 2
+    python benchmark.py --only stream --passthrough              # camera JPEG forwarded as-is (MJPG source)
+
+Each run writes one JSON document (environment info + one entry per benchmark) so results can be
+compared across releases. It goes to --output, by default the system temp directory. No camera, API key or network access is needed: the default source is
+the synthetic scene and the AI backend is forced to MOCK unless AI_BACKEND is already set.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("AI_BACKEND", "MOCK") # Never spend quota from a benchmark
+os.environ.setdefault("CAMERAS", "")
+# Leave the measured paths alone and the tree clean: no clip recorder encoding every frame into clips/,
+# no settings.json or analysis history written for the bench cameras
+os.environ["CLIP_BUFFER_MB"] = "0"
+os.environ["SETTINGS_PATH"] = ""
+os.environ["ANALYSIS_HISTORY_PATH"] = ""
+
+import cv2
+import numpy as np
+
+import app as server # The application under test
+
+BENCHMARKS = ["capture", "encode", "crop_encode", "stream", "parse"]
+SUPPORTED_RESOLUTIONS = ["640x480", "1280x720", "1920x1080"] # Settings page options (+ the optional High preset)
+
+
+# --- Helpers ---
+def summarize_ms(samples):
+    """ Latency summary in milliseconds for a list of durations in seconds. """
+    if not samples: return {"count": 0}
+    ms = sorted(s * 1000 for s in samples)
+    pick = lambda q: ms[min(len(ms) - 1, int(q * len(ms)))]
+    return {"count": len(ms), "mean": round(statistics.fmean(ms), 3), "p50": round(pick(0.50), 3),
+            "p95": round(pick(0.95), 3), "p99": round(pick(0.99), 3), "max": round(ms[-1], 3)}
+
+def source_for(source, resolution, paced=True):
+    """ The source spec to benchmark at `resolution`. Synthetic specs are re-sized (and unpaced for capture runs). """
+    if not source.startswith("synthetic:"): return source
+    path, _, query = source.partition(":")[2].partition("?")
+    fps = path.partition("@")[2] or "30"
+    return f"synthetic:{resolution}@{fps if paced else 0}" + (f"?{query}" if query else "")
+
+def start_camera(source, resolution, crop=None):
+    camera = server.Camera("bench", source=source, resolution=resolution, crop_area=crop)
+    with camera.start_lock:
+        if not camera.start(): raise RuntimeError(f"Could not open source '{source}'.")
+    return camera
+
+def stop_camera(camera):
+    with camera.start_lock: camera.stop()
+
+def wait_for_seq(camera, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        ref = camera.ring.latest()
+        if ref is not None: return ref
+        time.sleep(0.01)
+    raise RuntimeError("No frame captured within timeout.")
+
+def grab_frames(source, resolution, count=30):
+    """ Copies `count` consecutive frames out of a running capture pipeline. """
+    camera = start_camera(source_for(source, resolution, paced=False), resolution)
+    try:
+        frames = []; last_seq = 0
+        while len(frames) < count:
+            ref = camera.ring.wait_newer(last_seq, timeout=2.0)
+            if ref is None: raise RuntimeError("Capture stalled while grabbing frames.")
+            frames.append(ref.frame.copy()); last_seq = ref.seq
+        return frames
+    finally:
+        stop_camera(camera)
+
+def timed_loop(duration, fn, frames):
+    """ Calls fn(frame) round-robin over frames for `duration` seconds. Returns (durations, outputs). """
+    samples = []; outputs = []; i = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        started = time.perf_counter(); out = fn(frames[i % len(frames)]); samples.append(time.perf_counter() - started)
+        outputs.append(out); i += 1
+    return samples, outputs
+
+
+# --- Benchmarks ---
+def bench_capture(args):
+    """ Frames published per second by capture_frames_loop() at each resolution (unpaced source). """
+    results = []
+    for resolution in args.resolutions:
+        camera = start_camera(source_for(args.source, resolution, paced=False), resolution)
+        try:
+            first = wait_for_seq(camera); time.sleep(0.5) # Warm up
+            start_ref = camera.ring.latest(); started = time.monotonic()
+            time.sleep(args.duration)
+            end_ref = camera.ring.latest(); elapsed = time.monotonic() - started
+            height, width = first.frame.shape[:2]
+            results.append({"resolution": resolution, "actual": f"{width}x{height}",
+                            "fps": round((end_ref.seq - start_ref.seq) / elapsed, 2), "seconds": round(elapsed, 2)})
+        finally:
+            stop_camera(camera)
+    return results
+
+def bench_encode(args):
+    """ cv2.imencode cost of one full frame at the stream quality (STREAM_JPEG_QUALITY). """
+    results = []
+    params = [cv2.IMWRITE_JPEG_QUALITY, server.STREAM_JPEG_QUALITY]
+    for resolution in args.resolutions:
+        frames = grab_frames(args.source, resolution)
+        samples, outputs = timed_loop(args.duration, lambda f: cv2.imencode(".jpg", f, params)[1], frames)
+        results.append({"resolution": resolution, "quality": server.STREAM_JPEG_QUALITY, "latencyMs": summarize_ms(samples),
+                        "fps": round(len(samples) / sum(samples), 1), "avgBytes": int(np.mean([len(o) for o in outputs]))})
+    return results
+
+def bench_crop_encode(args):
+    """ Per-frame work of the cropped stream encoder: CameraConfig.crop() (slices precomputed per frame size) + imencode. """
+    results = []
+    crop = dict(zip("xywh", args.crop))
+    params = [cv2.IMWRITE_JPEG_QUALITY, server.STREAM_JPEG_QUALITY]
+    for resolution in args.resolutions:
+        frames = grab_frames(args.source, resolution)
+        config = server.CameraConfig(crop_area=args.crop).for_frame_size(frames[0].shape[:2])
+        encode = lambda f: cv2.imencode(".jpg", config.crop(f), params)[1]
+        samples, outputs = timed_loop(args.duration, encode, frames)
+        results.append({"resolution": resolution, "cropArea": crop, "latencyMs": summarize_ms(samples),
+                        "fps": round(len(samples) / sum(samples), 1), "avgBytes": int(np.mean([len(o) for o in outputs]))})
+    return results
+
+def read_mjpeg(port, path, duration, counters):
+    """ One MJPEG client: reads whole parts for `duration` seconds and counts frames and bytes. """
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=duration + 5)
+    started = time.monotonic(); end = started + duration; first_at = None
+    try:
+        conn.request("GET", path); response = conn.getresponse() # Blocks while every Waitress thread is busy
+        while time.monotonic() < end:
+            line = response.readline()
+            if not line: break
+            if not line.lower().startswith(b"content-length:"): continue
+            length = int(line.split(b":", 1)[1])
+            response.readline() # Blank line after the part headers
+            body = response.read(length); response.readline()
+            if first_at is None: first_at = time.monotonic(); counters["firstFrameSec"] = first_at - started
+            counters["frames"] += 1; counters["bytes"] += len(body)
+    except Exception as e:
+        counters["error"] = str(e)
+    finally:
+        conn.close()
+
+def bench_stream(args):
+    """ End-to-end MJPEG throughput of /video_feed_full and /video_feed with N concurrent clients against Waitress. """
+    from waitress import create_server
+    crop = dict(zip("xywh", args.crop))
+    resolution = args.resolutions[min(1, len(args.resolutions) - 1)] # Medium by default
+    camera = start_camera(source_for(args.source, resolution, paced=True), resolution, crop)
+    saved_registry = dict(server.camera_registry); saved_default = server.DEFAULT_CAMERA_ID
+    server.camera_registry.clear(); server.camera_registry["bench"] = camera; server.DEFAULT_CAMERA_ID = "bench"
+    http_server = create_server(server.app, host="127.0.0.1", port=0, threads=args.threads,
+                                outbuf_high_watermark=server.WAITRESS_OUTBUF_HIGH_WATERMARK)
+    threading.Thread(target=http_server.run, name="BenchWaitress", daemon=True).start()
+    results = []
+    try:
+        wait_for_seq(camera)
+        for path in ("/video_feed_full", "/video_feed"):
+            for clients in args.clients:
+                counters = [{"frames": 0, "bytes": 0} for _ in range(clients)]
+                threads = [threading.Thread(target=read_mjpeg, args=(http_server.effective_port, path, args.duration, c)) for c in counters]
+                for t in threads: t.start()
+                for t in threads: t.join(args.duration + 10)
+                fps = [c["frames"] / args.duration for c in counters]
+                first_frame = [c["firstFrameSec"] for c in counters if "firstFrameSec" in c]
+                results.append({"path": path, "resolution": resolution, "clients": clients, "waitressThreads": args.threads,
+                                "passthrough": camera.passthrough,
+                                "clientFps": {"mean": round(statistics.fmean(fps), 2) if fps else 0.0, "min": round(min(fps), 2) if fps else 0.0},
+                                "totalMBps": round(sum(c["bytes"] for c in counters) / args.duration / 1e6, 3),
+                                "firstFrameMs": summarize_ms(first_frame),
+                                "starvedClients": sum(1 for c in counters if c["frames"] == 0), # No frame within the window
+                                "errors": [c["error"] for c in counters if "error" in c]})
+                time.sleep(0.5) # Let generators notice the closed sockets
+    finally:
+        http_server.close(); stop_camera(camera)
+        server.camera_registry.clear(); server.camera_registry.update(saved_registry); server.DEFAULT_CAMERA_ID = saved_default
+    return results
+
+def parse_corpus():
+    """ (kind, text, region_names) replies covering clean, fenced, chatty, malformed and per-region output. """
+    clean = '{"Vehicles_Present": "True", "Cars": 3, "Bikes": 1, "Trucks": 0, "Buses": 1, "Unknown": 0}'
+    empty = '{"Vehicles_Present": "False", "Cars": 0, "Bikes": 0, "Trucks": 0, "Buses": 0, "Unknown": 0}'
+    regions = json.dumps({"Regions": {n: json.loads(clean) for n in ("north", "south", "east", "west")}})
+    return [
+        ("clean", clean, None), ("clean", empty, None),
+        ("fenced", f"```json\n{clean}\n```", None), ("fenced", f"```\n{empty}\n```", None),
+        ("chatty", f"Here is the analysis:\n{clean}\nLet me know if you need more.", None),
+        ("malformed", clean[: len(clean) // 2], None), ("malformed", "No vehicles detected.", None),
+        ("invalid", clean.replace('"True"', "true"), None), ("invalid", clean.replace("3", "-3"), None),
+        ("regions", regions, ["north", "south", "east", "west"]),
+        ("regions_fenced", f"```json\n{regions}\n```", ["north", "south", "east", "west"]),
+    ]
+
+def bench_parse(args):
+    """ parse_gemini_response() calls per second for each reply kind (logging disabled so I/O is not measured). """
+    results = []
+    logging.disable(logging.CRITICAL)
+    try:
+        corpus = parse_corpus()
+        for kind in dict.fromkeys(k for k, _, _ in corpus):
+            entries = [(text, names) for k, text, names in corpus if k == kind]
+            calls = 0; ok = 0; started = time.perf_counter(); end = started + args.duration / 2
+            while time.perf_counter() < end:
+                for text, names in entries:
+                    data, error = server.parse_gemini_response(text, names); calls += 1; ok += error is None
+            elapsed = time.perf_counter() - started
+            results.append({"kind": kind, "calls": calls, "callsPerSec": round(calls / elapsed), "usPerCall": round(elapsed / calls * 1e6, 2),
+                            "successRate": round(ok / calls, 3)})
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+# --- Runner ---
+def environment_info(args):
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception: commit = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "gitCommit": commit, "python": platform.python_version(),
+            "opencv": cv2.__version__, "numpy": np.__version__, "platform": platform.platform(), "cpuCount": os.cpu_count(),
+            "source": args.source, "durationSec": args.duration, "resolutions": args.resolutions, "clients": args.clients,
+            "passthrough": args.passthrough}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark capture, encode, stream and parse hot paths.")
+    parser.add_argument("--source", default="synthetic:1280x720@30", help="Frame source spec (synthetic:..., file:..., device index).")
+    parser.add_argument("--resolutions", default=",".join(SUPPORTED_RESOLUTIONS), type=lambda s: s.split(","))
+    parser.add_argument("--clients", default="1,4,8", type=lambda s: [int(n) for n in s.split(",")], help="Concurrent MJPEG client counts.")
+    parser.add_argument("--threads", default=10, type=int, help="Waitress threads for the stream benchmark (app.py uses 10).")
+    parser.add_argument("--crop", default="0.25,0.25,0.5,0.5", type=lambda s: [float(v) for v in s.split(",")], help="x,y,w,h crop fractions.")
+    parser.add_argument("--duration", default=5.0, type=float, help="Seconds per measurement.")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), type=lambda s: s.split(","), help=f"Subset of {BENCHMARKS}.")
+    parser.add_argument("--passthrough", action="store_true", help="Capture in MJPEG passthrough mode (CAPTURE_MJPEG_PASSTHROUGH).")
+    parser.add_argument("--output", default=os.path.join(tempfile.gettempdir(), "benchmark-results.json"),
+                        help="Results JSON path (default: benchmark-results.json in the temp directory).")
+    args = parser.parse_args(argv)
+    server.CAPTURE_MJPEG_PASSTHROUGH = args.passthrough or server.CAPTURE_MJPEG_PASSTHROUGH
+    unknown = [b for b in args.only if b not in BENCHMARKS]
+    if unknown: parser.error(f"Unknown benchmark(s): {unknown}")
+
+    logging.getLogger().setLevel(logging.WARNING) # Keep per-frame INFO logs out of the measurements
+    report = {"environment": environment_info(args), "results": {}}
+    for name in BENCHMARKS:
+        if name not in args.only: continue
+        print(f"Running {name}...", flush=True)
+        started = time.monotonic()
+        try:
+            report["results"][name] = globals()[f"bench_{name}"](args)
+        except Exception as e:
+            logging.error(f"Benchmark {name} failed: {e}", exc_info=True)
+            report["results"][name] = {"error": str(e)}
+        print(f"  {name} done in {time.monotonic() - started:.1f}s: {json.dumps(report['results'][name])[:300]}", flush=True)
+
+    with open(args.output, "w") as f: json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 0 if not any(isinstance(r, dict) and "error" in r for r in report["results"].values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
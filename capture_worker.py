@@ -0,0 +1,38 @@
+"""
+Capture process for one camera: reads the source, decodes every frame into a shared-memory segment and
+JPEG-encodes it there, for web processes that use the frame source "shm:<name>" (see "Shared-Memory Frames"
+in frame_capture.py). With CAPTURE_PROCESS=1 the servers start one per camera themselves; run it by hand to
+feed web processes that read a camera under another name:
+
+    python capture_worker.py --name north --source 0 --resolution 1280x720
+    CAMERAS="north=shm:north" python app.py                             # in each web process
+
+Runs until SIGTERM/SIGINT and unlinks the segment on the way out. Exits with code 3 right away if another
+process already captures into the segment. Loads frame_capture only, not the web application.
+"""
+import argparse
+import logging
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv() # Before frame_capture reads SHM_* and CAPTURE_RECONNECT_* (already set when the server starts it)
+
+import frame_capture
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Capture one camera into shared memory for the web processes.")
+    parser.add_argument("--name", required=True, help="Shared memory segment name; web processes use source shm:<name>.")
+    parser.add_argument("--source", default="auto", help="Frame source spec, as in CAMERAS (auto, a device index, file:..., rtsp://..., synthetic:...).")
+    parser.add_argument("--resolution", default="default", help="Requested capture size, e.g. 1280x720.")
+    parser.add_argument("--quality", default=frame_capture.CAPTURE_JPEG_QUALITY, type=int, help="JPEG quality of the encoded frames.")
+    parser.add_argument("--slots", default=frame_capture.SHM_SLOTS, type=int, help="Frame slots in the segment.")
+    parser.add_argument("--parent-pid", type=int, help="Exit when this process is no longer the parent (set by the server).")
+    args = parser.parse_args(argv)
+    return frame_capture.run_capture_worker(args.name, args.source, args.resolution, args.quality, max(3, args.slots), args.parent_pid)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,538 @@
+"""
+Frame capture without the web application: frame sources, device opening, and the shared-memory frame
+segments that capture processes write and web processes read (see "Capture Processes" in the README).
+app.py imports it, and capture_worker.py runs run_capture_worker() from it. It imports neither Flask nor the
+app's state, so a capture process loads OpenCV and NumPy only. Settings are read from the environment on
+import (app.py loads .env first).
+"""
+import fcntl
+import functools
+import logging
+import os
+import signal
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import cv2
+import numpy as np
+
+CAPTURE_RECONNECT_INITIAL_SEC = float(os.getenv("CAPTURE_RECONNECT_INITIAL_SEC", "0.5")) # First retry delay, doubled per failure
+CAPTURE_RECONNECT_MAX_SEC = float(os.getenv("CAPTURE_RECONNECT_MAX_SEC", "30")) # Retry delay cap
+CAPTURE_JPEG_QUALITY = 80 # JPEG quality capture processes encode at (app.py passes its STREAM_JPEG_QUALITY)
+CAPTURE_WORKER_BUSY = 3 # run_capture_worker() result: another process already captures this camera
+
+
+# --- Frame Sources ---
+# Every source implements the subset of the cv2.VideoCapture interface the capture loop uses
+# (isOpened, read(image=None), set, get, release), so capture_frames_loop() consumes any of them unchanged;
+# they have no grab(), so grab_frame() falls back to read().
+# Source specs (CAMERAS entries, FRAME_SOURCE, or a camera's "source" setting):
+#   auto | <index>                         local device (auto probes 0 and 1)
+#   file:<video file or image dir>[?pace=realtime|fast&loop=1&fps=N]
+#   rtsp://... | http(s)://... | url:<url> network stream via OpenCV/FFmpeg
+#   synthetic:<W>x<H>[@<fps>][?seed=N]     generated frames (fps 0 = as fast as possible)
+#   shm:<name>                             frames written by a capture process (see "Shared-Memory Frames")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+MJPG_FOURCC = cv2.VideoWriter_fourcc(*"MJPG")
+
+def _fill_output(frame, image):
+    """ Copies frame into the caller's buffer when it fits (mirrors VideoCapture.read(image)). """
+    if image is not None and image.shape == frame.shape and image.dtype == frame.dtype:
+        np.copyto(image, frame); return image
+    return frame
+
+class FramePacer:
+    """ Sleeps so consecutive frames are delivered at a fixed rate (no-op when fps <= 0). """
+    def __init__(self, fps):
+        self.interval = 1.0 / fps if fps and fps > 0 else 0.0
+        self._next = None
+
+    def wait(self):
+        if not self.interval: return
+        now = time.monotonic()
+        if self._next is None or now - self._next > self.interval: self._next = now # Resync after a stall
+        elif self._next > now: time.sleep(self._next - now)
+        self._next += self.interval
+
+class VideoFileSource:
+    """ Replays a recorded video file, looping at EOF, paced at the file's frame rate or as fast as possible. """
+    def __init__(self, path, pace="realtime", loop=True, fps=None):
+        self.path = path; self.loop = loop
+        self._cap = cv2.VideoCapture(path)
+        file_fps = self._cap.get(cv2.CAP_PROP_FPS) if self._cap.isOpened() else 0
+        self._pacer = FramePacer((fps or file_fps or 30.0) if pace == "realtime" else 0)
+
+    def isOpened(self): return self._cap.isOpened()
+
+    def read(self, image=None):
+        self._pacer.wait()
+        ret, frame = self._cap.read()
+        if not ret and self.loop:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0); ret, frame = self._cap.read()
+        if not ret: return False, None
+        return True, _fill_output(frame, image)
+
+    def set(self, prop, value): return False # Recorded footage has a fixed resolution
+    def get(self, prop): return self._cap.get(prop)
+    def release(self): self._cap.release()
+
+class ImageDirectorySource:
+    """ Cycles through the images of a directory in name order. """
+    def __init__(self, path, pace="realtime", loop=True, fps=None):
+        self.path = path; self.loop = loop
+        self._files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+        self._index = 0; self._shape = None; self._open = bool(self._files)
+        self._pacer = FramePacer((fps or 10.0) if pace == "realtime" else 0)
+        if not self._files: logging.error(f"Image directory source '{path}' contains no images.")
+
+    def isOpened(self): return self._open
+
+    def read(self, image=None):
+        if not self._open: return False, None
+        if self._index >= len(self._files):
+            if not self.loop: return False, None
+            self._index = 0
+        self._pacer.wait()
+        frame = cv2.imread(self._files[self._index]); self._index += 1
+        if frame is None: logging.warning(f"Could not read image {self._files[self._index - 1]}."); return False, None
+        self._shape = frame.shape
+        return True, _fill_output(frame, image)
+
+    def set(self, prop, value): return False
+    def get(self, prop):
+        if self._shape is None and self._files:
+            first = cv2.imread(self._files[0]); self._shape = first.shape if first is not None else None
+        if self._shape is None: return 0
+        if prop == cv2.CAP_PROP_FRAME_WIDTH: return self._shape[1]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT: return self._shape[0]
+        return 0
+    def release(self): self._open = False
+
+class SyntheticSource:
+    """
+    Deterministic generated traffic scene: a static background with a few moving "vehicles" and a
+    frame counter, rendered straight into the caller's buffer. Used for headless runs and benchmarks.
+    """
+    def __init__(self, width=1280, height=720, fps=30.0, seed=0):
+        self.fps = fps; self.seed = seed; self._open = True; self._frame_index = 0
+        self._fourcc = 0; self._convert_rgb = True # MJPG + CONVERT_RGB=0 emulates a raw MJPEG camera
+        self._pacer = FramePacer(fps)
+        self._resize(width, height)
+
+    def _resize(self, width, height):
+        self.width, self.height = int(width), int(height)
+        rng = np.random.default_rng(self.seed)
+        gradient = np.linspace(60, 140, self.height, dtype=np.uint8)[:, None, None]
+        self._background = np.repeat(np.repeat(gradient, self.width, axis=1), 3, axis=2)
+        cv2.rectangle(self._background, (0, self.height // 3), (self.width, 2 * self.height // 3), (70, 70, 70), -1) # Road
+        self._vehicles = [(int(rng.integers(20, 120)), int(rng.integers(40, 255)), int(rng.integers(40, 255)), int(rng.integers(40, 255)),
+                           float(rng.uniform(2, 9))) for _ in range(4)]
+
+    def isOpened(self): return self._open
+
+    def read(self, image=None):
+        if not self._open: return False, None
+        self._pacer.wait()
+        frame = image if image is not None and image.shape == self._background.shape else np.empty_like(self._background)
+        np.copyto(frame, self._background)
+        scale = self.width / 640.0; lane_h = (self.height // 3) // len(self._vehicles)
+        for lane, (size, b, g, r, speed) in enumerate(self._vehicles):
+            w = int(size * scale); x = int(self._frame_index * speed * scale) % (self.width + w) - w
+            y = self.height // 3 + lane * lane_h + 4
+            cv2.rectangle(frame, (x, y), (x + w, y + lane_h - 8), (b, g, r), -1)
+        cv2.putText(frame, f"SYNTHETIC {self._frame_index}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+        self._frame_index += 1
+        if self._fourcc == MJPG_FOURCC and not self._convert_rgb:
+            flag, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            return flag, encoded.reshape(1, -1) if flag else None # Same (1, N) layout as a raw V4L2 read
+        return True, frame
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH: self._resize(value, self.height); return True
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT: self._resize(self.width, value); return True
+        if prop == cv2.CAP_PROP_FOURCC: self._fourcc = int(value); return True
+        if prop == cv2.CAP_PROP_CONVERT_RGB: self._convert_rgb = bool(value); return True
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FOURCC: return self._fourcc
+        if prop == cv2.CAP_PROP_FRAME_WIDTH: return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT: return self.height
+        if prop == cv2.CAP_PROP_FPS: return self.fps
+        return 0
+
+    def release(self): self._open = False
+
+def open_frame_source(spec):
+    """ Opens a non-device source spec (see the table above). Returns the source or None. """
+    kind, _, rest = spec.partition(":")
+    path, _, query = rest.partition("?")
+    options = dict(item.partition("=")[::2] for item in query.split("&") if item)
+    try:
+        if kind == "file":
+            pace = options.get("pace", "realtime"); loop = options.get("loop", "1") != "0"
+            fps = float(options["fps"]) if "fps" in options else None
+            source = ImageDirectorySource(path, pace, loop, fps) if os.path.isdir(path) else VideoFileSource(path, pace, loop, fps)
+        elif kind == "synthetic":
+            size, _, fps = path.partition("@")
+            width, _, height = (size or "1280x720").partition("x")
+            source = SyntheticSource(int(width), int(height), float(fps or 30), int(options.get("seed", 0)))
+        elif kind == "shm":
+            source = SharedMemorySource(path)
+        elif kind in ("rtsp", "rtsps", "http", "https", "url"):
+            url = rest if kind == "url" else spec
+            source = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+        else:
+            logging.error(f"Unknown frame source type '{kind}' in '{spec}'.")
+            return None
+    except Exception as e:
+        logging.error(f"Error opening frame source '{spec}': {e}", exc_info=True)
+        return None
+    if not source.isOpened():
+        logging.error(f"Frame source '{spec}' could not be opened.")
+        source.release(); return None
+    return source
+
+
+
+# --- Devices ---
+def grab_frame(device, image=None):
+    """
+    grab() + retrieve() where the backend supports it (cv2.VideoCapture), else read(). grab() blocks
+    until the driver has a frame, so the loop needs no sleep; retrieve() decodes into `image`.
+    """
+    grab = getattr(device, "grab", None)
+    if grab is None: return device.read(image)
+    if not grab(): return False, None
+    return device.retrieve(image) if image is not None else device.retrieve()
+
+def open_device(source, label="Camera"):
+    """ Opens a frame source (a device index, "auto" probing 0 and 1, or a source spec). Returns it or None. """
+    if source != "auto" and not source.isdigit():
+        logging.info(f"{label}: opening frame source '{source}'.")
+        return open_frame_source(source)
+    indices = range(2) if source == "auto" else [int(source)]
+    for index in indices:
+        try:
+             # Add API preference if needed, e.g., cv2.CAP_ANY, cv2.CAP_DSHOW etc.
+             temp_cap = cv2.VideoCapture(index)
+             if temp_cap and temp_cap.isOpened():
+                 logging.info(f"{label}: opened successfully at index {index}.")
+                 return temp_cap
+             logging.warning(f"{label}: failed to open index {index}.")
+             if temp_cap: temp_cap.release()
+        except Exception as e:
+             logging.error(f"{label}: error probing index {index}: {e}")
+    return None
+
+def open_configured_device(source, resolution="default", label="Camera", mjpeg_passthrough=False):
+    """
+    Opens the source and applies the resolution setting and a 1-frame driver buffer. With `mjpeg_passthrough`
+    it asks for raw MJPEG reads (see CAPTURE_MJPEG_PASSTHROUGH in app.py). Returns (device or None, passthrough).
+    """
+    device = open_device(source, label)
+    if device is None: return None, False
+
+    passthrough = False
+    if mjpeg_passthrough:
+        # FOURCC first: V4L2 picks the frame size per pixel format. CONVERT_RGB=0 makes read() return the raw JPEG.
+        try:
+            device.set(cv2.CAP_PROP_FOURCC, MJPG_FOURCC)
+            passthrough = int(device.get(cv2.CAP_PROP_FOURCC)) == MJPG_FOURCC and bool(device.set(cv2.CAP_PROP_CONVERT_RGB, 0))
+        except Exception as e:
+            logging.warning(f"{label}: cannot request MJPEG passthrough: {e}")
+        logging.info(f"{label}: MJPEG passthrough {'enabled' if passthrough else 'not supported, decoding frames'}.")
+
+    target_resolution = resolution; target_width, target_height = 0, 0
+    if target_resolution != 'default' and 'x' in target_resolution:
+        try: parts = target_resolution.split('x'); target_width = int(parts[0]); target_height = int(parts[1])
+        except ValueError: logging.warning(f"Invalid resolution format: {target_resolution}. Using default."); target_width, target_height = 0, 0
+
+    if target_width > 0 and target_height > 0:
+        try:
+            logging.info(f"{label}: attempting to set resolution: {target_width}x{target_height}...")
+            res_set_w = device.set(cv2.CAP_PROP_FRAME_WIDTH, target_width)
+            res_set_h = device.set(cv2.CAP_PROP_FRAME_HEIGHT, target_height)
+            if not res_set_w or not res_set_h:
+                logging.warning("Setting resolution properties returned false. Camera might not support it.")
+            # Give camera time to potentially adjust
+            time.sleep(0.5)
+            # Verify actual resolution
+            actual_width = int(device.get(cv2.CAP_PROP_FRAME_WIDTH))
+            actual_height = int(device.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            logging.info(f"{label}: actual resolution after attempting set: {actual_width}x{actual_height}")
+            if actual_width != target_width or actual_height != target_height:
+                 logging.warning(f"{label} did not accept target resolution. Using {actual_width}x{actual_height}.")
+        except Exception as e:
+            logging.error(f"{label}: error setting resolution: {e}")
+    else:
+        logging.info(f"{label}: using default resolution: {int(device.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(device.get(cv2.CAP_PROP_FRAME_HEIGHT))}")
+    # Keep driver-side queueing to one frame so grab() returns the newest frame, not a stale backlog
+    try:
+        if not device.set(cv2.CAP_PROP_BUFFERSIZE, 1): logging.debug(f"{label}: backend ignores CAP_PROP_BUFFERSIZE.")
+    except Exception as e:
+        logging.debug(f"{label}: cannot set buffer size: {e}")
+    return device, passthrough
+
+
+# --- Shared-Memory Frames (capture processes) ---
+# With CAPTURE_PROCESS=1 (or capture_worker.py run by hand) each camera is read by its own process, which
+# decodes every frame into a slot of a multiprocessing.shared_memory segment and JPEG-encodes it right
+# beside it. Web processes open the segment as the frame source "shm:<name>": they read the pixels in
+# place and send the worker's JPEG on the full stream, so device reads and the full-size encode never
+# compete with request handling for the GIL, and any number of web processes can read one camera.
+# The worker holds an flock on capture_lock_path(name) for its lifetime, so at most one process captures
+# a camera and the others can tell a live writer from a dead one (the kernel drops the lock with it).
+# Layout: a 64-byte header, then `slots` slots of [64-byte slot header | BGR pixels | JPEG area].
+# The writer only rewrites the oldest slot, and each slot carries its sequence number before
+# (seq_begin) and after (seq_end) its data: a reader that sees both equal to the slot's sequence
+# before its copy and seq_begin unchanged after it got a consistent frame (a seqlock, no locks shared
+# between processes). Timestamps are time.monotonic(), which is one system-wide clock on Linux.
+SHM_SLOTS = max(3, int(os.getenv("SHM_SLOTS", "4"))) # Slots per camera segment
+SHM_STALE_SEC = float(os.getenv("SHM_STALE_SEC", "2")) # A reader reattaches after this long without a new frame
+SHM_POLL_SEC = 0.001 # Reader poll step once the next frame is due
+SHM_MAGIC = b"TSIGSHM1"
+SHM_HEADER = struct.Struct("<8sIIIIIII") # magic, state (1 live, 0 closed), width, height, channels, slots, JPEG capacity, writer pid
+SHM_STATE = struct.Struct("<I") # at offset 8
+SHM_LATEST = struct.Struct("<Q") # newest published sequence, at SHM_LATEST_OFFSET
+SHM_LATEST_OFFSET = 40
+SHM_SLOT = struct.Struct("<QQdI") # seq_begin, seq_end, captured_at, JPEG length
+SHM_SEQ = struct.Struct("<Q")
+SHM_BLOCK = 64 # Header, slot header and slot stride alignment
+
+class SharedFrameBuffer:
+    """ One camera's shared-memory frame slots (layout above): create() is the capture process's side, attach() a reader's. """
+    def __init__(self, shm, owner):
+        self.shm = shm; self.owner = owner; self.name = shm.name
+        magic, _, self.width, self.height, self.channels, self.slots, self.jpeg_capacity, self.writer_pid = SHM_HEADER.unpack_from(shm.buf, 0)
+        if magic != SHM_MAGIC: raise ValueError(f"shared memory '{shm.name}' is not a frame buffer")
+        self.pixel_bytes = self.width * self.height * self.channels
+        self.stride = self.slot_stride(self.pixel_bytes, self.jpeg_capacity)
+        if shm.size < SHM_BLOCK + self.slots * self.stride: raise ValueError(f"shared memory '{shm.name}' is truncated")
+        self._pixels = [np.ndarray(self.shape, np.uint8, shm.buf, self._offset(i) + SHM_BLOCK) for i in range(self.slots)]
+        if not owner:
+            for view in self._pixels: view.flags.writeable = False # Readers share the writer's slots
+        self._jpegs = [np.ndarray((self.jpeg_capacity,), np.uint8, shm.buf, self._offset(i) + SHM_BLOCK + self.pixel_bytes) for i in range(self.slots)]
+
+    @staticmethod
+    def slot_stride(pixel_bytes, jpeg_capacity):
+        return -(-(SHM_BLOCK + pixel_bytes + jpeg_capacity) // SHM_BLOCK) * SHM_BLOCK
+
+    @classmethod
+    def create(cls, name, shape, slots=SHM_SLOTS):
+        """ New segment for frames of `shape` (h, w, 3), replacing one a killed writer left behind under the same name. """
+        height, width, channels = shape
+        jpeg_capacity = width * height * channels // 2 + 65536 # Frames whose JPEG is larger are published without one
+        try:
+            stale = shared_memory.SharedMemory(name); stale.close(); stale.unlink()
+            logging.warning(f"Shared memory '{name}': removed a stale segment.")
+        except FileNotFoundError: pass
+        shm = shared_memory.SharedMemory(name, create=True, size=SHM_BLOCK + slots * cls.slot_stride(width * height * channels, jpeg_capacity))
+        SHM_HEADER.pack_into(shm.buf, 0, SHM_MAGIC, 1, width, height, channels, slots, jpeg_capacity, os.getpid())
+        logging.info(f"Shared memory '{name}': {slots} slots x {width}x{height} = {shm.size / (1024 * 1024):.1f} MB")
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name)
+        # Attaching registers the segment with this process's resource tracker too (Python < 3.13), which would
+        # unlink it when this process exits; its lifetime belongs to the writer.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        try: return cls(shm, owner=False)
+        except ValueError: shm.close(); raise
+
+    @property
+    def shape(self): return (self.height, self.width, self.channels)
+
+    @property
+    def closed(self): return SHM_STATE.unpack_from(self.shm.buf, 8)[0] == 0
+
+    def _offset(self, slot): return SHM_BLOCK + slot * self.stride
+
+    # Writer side
+    def begin_write(self, seq):
+        """ Marks the slot for frame `seq` in progress. Returns (slot, writable pixel view). """
+        slot = seq % self.slots
+        SHM_SEQ.pack_into(self.shm.buf, self._offset(slot), seq)
+        return slot, self._pixels[slot]
+
+    def publish(self, slot, seq, captured_at, jpeg=None):
+        """ Completes the slot begun for `seq` (pixels already written) and makes it the newest frame. """
+        length = 0
+        if jpeg is not None and jpeg.size <= self.jpeg_capacity:
+            length = jpeg.size; self._jpegs[slot][:length] = jpeg.reshape(-1)
+        SHM_SLOT.pack_into(self.shm.buf, self._offset(slot), seq, seq, captured_at, length)
+        SHM_LATEST.pack_into(self.shm.buf, SHM_LATEST_OFFSET, seq)
+
+    # Reader side
+    def read_latest(self, after_seq, image=None):
+        """
+        The newest frame unless it is `after_seq`: (seq, captured_at, pixels, JPEG bytes or None), or None.
+        Pixels are copied into `image` (or a new array); with image=False they are a read-only view of the
+        slot, valid while holds(seq) is True.
+        """
+        buf = self.shm.buf
+        for _ in range(3): # Retried only when the writer laps the slot mid-copy
+            seq = SHM_LATEST.unpack_from(buf, SHM_LATEST_OFFSET)[0]
+            if seq == 0 or seq == after_seq: return None
+            slot = seq % self.slots; offset = self._offset(slot)
+            begin, end, captured_at, length = SHM_SLOT.unpack_from(buf, offset)
+            if begin != seq or end != seq: continue
+            if image is False: pixels = self._pixels[slot]
+            else:
+                pixels = image if image is not None and image.shape == self.shape and image.dtype == np.uint8 else np.empty(self.shape, np.uint8)
+                np.copyto(pixels, self._pixels[slot])
+            jpeg = self._jpegs[slot][:length].tobytes() if length else None
+            if SHM_SEQ.unpack_from(buf, offset)[0] == seq: return seq, captured_at, pixels, jpeg
+        return None
+
+    def holds(self, seq):
+        """ True while frame `seq` is still in its slot (the writer has not begun overwriting it). """
+        buf = self.shm.buf
+        return buf is not None and SHM_SEQ.unpack_from(buf, self._offset(seq % self.slots))[0] == seq
+
+    def close(self):
+        """ Unmaps the segment; the writer also marks it closed (readers reattach) and unlinks it. """
+        if self.owner: SHM_STATE.pack_into(self.shm.buf, 8, 0)
+        self._pixels = []; self._jpegs = []
+        try: self.shm.close()
+        except BufferError: logging.debug(f"Shared memory '{self.name}': a slot view is still referenced; unmapped when it is released.")
+        if self.owner:
+            try: self.shm.unlink()
+            except FileNotFoundError: pass
+
+class SharedMemorySource:
+    """
+    Frame source over a capture process's segment ("shm:<name>"). read() waits for the next frame and copies
+    its pixels into the caller's buffer; read_view() returns a read-only view of the slot instead, and
+    still_valid() tells when the writer starts reusing it. `captured_at` and `jpeg` describe the frame
+    returned last. The size is the writer's: set() only accepts it. Not open once the writer closes the
+    segment or stops publishing, so the camera's reconnect loop reattaches to the segment a restarted
+    writer creates.
+    """
+    def __init__(self, name, stale_sec=SHM_STALE_SEC):
+        self.name = name; self.stale_sec = stale_sec
+        self.captured_at = None; self.jpeg = None
+        self._seq = 0; self._interval = 1 / 30 # Frame interval estimate, used to sleep until a frame is due
+        try: self._buffer = SharedFrameBuffer.attach(name)
+        except (FileNotFoundError, ValueError) as e:
+            logging.warning(f"Shared-memory source '{name}': not available ({e})."); self._buffer = None
+        self._stale = False
+
+    def isOpened(self): return self._buffer is not None and not self._stale and not self._buffer.closed
+
+    def read(self, image=None):
+        deadline = time.monotonic() + self.stale_sec
+        while self.isOpened():
+            frame = self._buffer.read_latest(self._seq, image)
+            if frame is not None:
+                seq, captured_at, pixels, self.jpeg = frame
+                if self.captured_at is not None and seq == self._seq + 1: self._interval += 0.1 * (captured_at - self.captured_at - self._interval)
+                self._seq, self.captured_at = seq, captured_at
+                return True, pixels
+            now = time.monotonic()
+            if now > deadline:
+                logging.warning(f"Shared-memory source '{self.name}': no new frame for {self.stale_sec:.1f}s.")
+                self._stale = True; return False, None
+            due = (self.captured_at or now) + 0.9 * self._interval
+            time.sleep(min(max(due - now, SHM_POLL_SEC), 0.05))
+        return False, None
+
+    def read_view(self):
+        """ read() without the copy: the pixels stay in the writer's slot. """
+        return self.read(False)
+
+    def validity_check(self):
+        """ For the frame returned last: a callable that is True until the writer begins overwriting its slot. """
+        return functools.partial(self._buffer.holds, self._seq)
+
+    def set(self, prop, value):
+        if self._buffer is None: return False
+        if prop == cv2.CAP_PROP_FRAME_WIDTH: return int(value) == self._buffer.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT: return int(value) == self._buffer.height
+        return False
+
+    def get(self, prop):
+        if self._buffer is None: return 0
+        if prop == cv2.CAP_PROP_FRAME_WIDTH: return self._buffer.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT: return self._buffer.height
+        if prop == cv2.CAP_PROP_FPS: return round(1 / self._interval, 1)
+        return 0
+
+    def release(self):
+        buffer, self._buffer = self._buffer, None
+        if buffer is not None: buffer.close()
+
+
+# --- Capture Process ---
+def capture_lock_path(name):
+    return os.path.join(tempfile.gettempdir(), f"{name}.capture.lock")
+
+def acquire_capture_lock(name):
+    """ Takes the camera's capture lock without waiting. Returns the locked file descriptor, or None if another process holds it. """
+    fd = os.open(capture_lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB); return fd
+    except BlockingIOError: os.close(fd); return None
+
+def capture_running(name):
+    """ True while some process's capture worker holds the lock for segment `name`. """
+    fd = acquire_capture_lock(name)
+    if fd is None: return True
+    os.close(fd); return False # Closing drops the lock
+
+def run_capture_worker(name, source="auto", resolution="default", quality=CAPTURE_JPEG_QUALITY, slots=SHM_SLOTS, parent_pid=None):
+    """
+    Body of a capture process (see "Shared-Memory Frames"): opens `source` as a camera would, decodes each
+    frame straight into the next slot of segment `name` and encodes its JPEG beside it, reopening the source
+    with back-off after failures. A new frame size recreates the segment under the same name. Returns 0 on
+    SIGTERM/SIGINT or when `parent_pid` is no longer its parent, after closing and unlinking the segment,
+    or CAPTURE_WORKER_BUSY right away if another process already captures this camera.
+    """
+    lock = acquire_capture_lock(name)
+    if lock is None:
+        logging.info(f"Capture worker '{name}': another process already captures this camera.")
+        return CAPTURE_WORKER_BUSY
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT): signal.signal(signum, lambda *_: stopping.set())
+    running = lambda: not stopping.is_set() and (parent_pid is None or os.getppid() == parent_pid)
+    label = f"Capture worker '{name}'"
+    encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    frames = None; seq = 0; delay = CAPTURE_RECONNECT_INITIAL_SEC
+    logging.info(f"{label}: source '{source}', resolution {resolution}, pid {os.getpid()}.")
+    try:
+        while running():
+            device, _ = open_configured_device(source, resolution, label) # No passthrough: readers need pixels; this process makes the JPEG
+            if device is None:
+                logging.warning(f"{label}: cannot open '{source}', retrying in {delay:.1f}s.")
+                stopping.wait(delay); delay = min(delay * 2, CAPTURE_RECONNECT_MAX_SEC); continue
+            delay = CAPTURE_RECONNECT_INITIAL_SEC
+            try:
+                while running():
+                    slot, pixels = frames.begin_write(seq + 1) if frames is not None else (None, None)
+                    ret, frame = grab_frame(device, pixels)
+                    if not ret: logging.warning(f"{label}: frame read failed, reopening the source."); break
+                    captured_at = time.monotonic()
+                    if frame is not pixels:
+                        # First frame, or the source returned its own array (new size): (re)create the segment for it
+                        if frame.ndim == 2: frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+                        if frames is None or frames.shape != frame.shape:
+                            pixels = None
+                            if frames is not None: frames.close()
+                            frames = SharedFrameBuffer.create(name, frame.shape, slots)
+                        slot, pixels = frames.begin_write(seq + 1); np.copyto(pixels, frame)
+                    seq += 1
+                    flag, jpeg = cv2.imencode(".jpg", pixels, encode_params)
+                    frames.publish(slot, seq, captured_at, jpeg if flag else None)
+            except Exception as e:
+                logging.error(f"{label} error: {e}", exc_info=True)
+            finally:
+                device.release()
+    finally:
+        pixels = frame = None
+        if frames is not None: frames.close()
+        os.close(lock)
+        logging.info(f"{label}: stopped after {seq} frames.")
+    return 0
@@ -0,0 +1,258 @@
+"""
+Accelerated offline simulator for tuning the signal timing settings (greenLightDurationMs,
+yellowLightDurationMs, maxTimeSmartA_Ms and apiCallsPerMinute) before pushing them through /api/settings.
+
+    python simulator.py                                                  # 1 h of synthetic demand, default grid
+    python simulator.py --rates A=6,B=2,C=2,D=1 --duration 7200 --green 2:12:1 --max-a 5:60:5
+    python simulator.py --demand recorded.csv --modes smart --top 5 --output sweep.json --check
+
+Vehicle arrivals (recorded rates or synthetic Poisson) are replayed through the same cycle and smart-A
+rules as SignalController: A -> B -> C -> D, each GREEN -> YELLOW -> ALL_RED. In smart mode A's green is
+skipped when the last analysis saw no vehicles, ends early when a result reports them cleared, and is capped
+at maxTimeSmartA. Analyses are sampled every 60/apiCallsPerMinute seconds (never while A is being released)
+and arrive --analysis-latency seconds later. Every parameter combination advances in lock step as one row of
+NumPy arrays, on the same arrivals, so a sweep of thousands of combinations over hours of traffic takes seconds.
+Queues are fluid: each direction discharges --saturation vehicles per second while green.
+
+--demand CSV columns: `t` (seconds from start) and any of A, B, C, D as arrival rates in vehicles per minute,
+held until the next row. --check replays the best combination through the real SignalController on a
+VirtualClock and reports how many time steps show the same phase.
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+os.environ.setdefault("AI_BACKEND", "MOCK") # Importing app must not need credentials
+os.environ.setdefault("CAMERAS", "")
+
+import numpy as np
+
+import app as server # Cycle definition and the reference SignalController
+
+DIRECTIONS = list(server.SIGNAL_DIRECTIONS)
+CYCLE = server.SIGNAL_CYCLE
+A_GREEN, A_YELLOW = CYCLE.index("A_GREEN"), CYCLE.index("A_YELLOW")
+GREEN_STATES = np.array([CYCLE.index(f"{d}_GREEN") for d in DIRECTIONS])
+NO_ANALYSIS_STATES = np.array([CYCLE.index(s) for s in server.SIGNAL_NO_ANALYSIS_STATES])
+
+
+# --- Helpers ---
+def parse_values(text):
+    """ "2:20:2" (inclusive range) or "6,12,30" -> list of floats. """
+    if ":" in text:
+        start, stop, step = (float(v) for v in text.split(":"))
+        return [round(v, 6) for v in np.arange(start, stop + step / 2, step)]
+    return [float(v) for v in text.split(",") if v]
+
+def parse_rates(text):
+    rates = dict.fromkeys(DIRECTIONS, 0.0)
+    for item in text.split(","):
+        direction, _, value = item.partition("=")
+        if direction.strip() not in rates: raise ValueError(f"Unknown direction '{direction}' in --rates.")
+        rates[direction.strip()] = float(value)
+    return rates
+
+def rate_schedule(args, steps):
+    """ Arrival rate per step and direction (vehicles per second), shape (steps, 4). """
+    rates = np.tile([parse_rates(args.rates)[d] / 60 for d in DIRECTIONS], (steps, 1))
+    if not args.demand: return rates
+    with open(args.demand, newline="") as f:
+        rows = sorted(csv.DictReader(f), key=lambda row: float(row["t"]))
+    times = np.arange(steps) * args.dt
+    for row in rows:
+        held = times >= float(row["t"])
+        for i, d in enumerate(DIRECTIONS):
+            if row.get(d) not in (None, ""): rates[held, i] = float(row[d]) / 60
+    return rates
+
+def build_grid(args):
+    """ Every parameter combination as parallel arrays (one entry per combination). """
+    modes = [m.strip() for m in args.modes.split(",")]
+    if any(m not in ("smart", "timer") for m in modes): raise ValueError("--modes takes smart and/or timer.")
+    combos = set()
+    for green, yellow, max_a, cpm, mode in itertools.product(parse_values(args.green), parse_values(args.yellow), parse_values(args.max_a),
+                                                             parse_values(args.calls_per_minute), modes):
+        if mode == "timer": max_a = cpm = 0.0 # Not used without the AI: one timer run per green/yellow pair
+        combos.add((green, yellow, max_a, cpm, mode == "smart"))
+    combos = sorted(combos)
+    green, yellow, max_a, cpm, smart = (np.array(column) for column in zip(*combos))
+    return {"green": green, "yellow": yellow, "maxA": max_a, "callsPerMinute": cpm, "smart": smart.astype(bool)}
+
+def to_steps(seconds, dt):
+    return np.maximum(1, np.rint(np.asarray(seconds, dtype=float) / dt)).astype(np.int64)
+
+
+# --- Simulation ---
+def simulate(grid, arrivals, args, trace=False):
+    """
+    Runs every combination of `grid` over the arrival counts (steps, 4). Each step: phase transitions due now,
+    analysis results arriving now (rule 2b), a new analysis capture, then arrivals and green discharge.
+    Returns per-combination metric arrays (and, with trace=True, the phase index per step and the
+    (step, vehicles_present) results of combination 0).
+    """
+    combos = len(grid["green"]); steps = len(arrivals); rows = np.arange(combos)
+    smart = grid["smart"]
+    durations = np.empty((combos, len(CYCLE)), dtype=np.int64)
+    for state, name in enumerate(CYCLE):
+        if name.startswith("ALL_RED"): durations[:, state] = to_steps(server.SIGNAL_ALL_RED_MS / 1000, args.dt)
+        elif name.endswith("_YELLOW"): durations[:, state] = to_steps(grid["yellow"], args.dt)
+        else: durations[:, state] = to_steps(grid["green"], args.dt)
+    durations[:, A_GREEN] = np.where(smart, to_steps(grid["maxA"], args.dt), durations[:, A_GREEN])
+    interval = np.where(smart, to_steps(60.0 / np.maximum(grid["callsPerMinute"], 1e-9), args.dt), 0)
+    latency = int(to_steps(args.analysis_latency, args.dt))
+
+    state = np.zeros(combos, dtype=np.int64); phase = np.zeros(combos, dtype=np.int64)
+    present = np.zeros(combos, dtype=bool) # Latest analysis result for A
+    pending = np.zeros(combos, dtype=bool); pending_value = np.zeros(combos, dtype=bool)
+    result_at = np.zeros(combos, dtype=np.int64); next_capture = np.zeros(combos, dtype=np.int64)
+    queue = np.zeros((combos, 4)); max_queue = np.zeros((combos, 4)); delay = np.zeros((combos, 4))
+    served = np.zeros((combos, 4)); green_steps = np.zeros((combos, 4), dtype=np.int64)
+    cycles = np.zeros(combos, dtype=np.int64); a_skips = np.zeros(combos, dtype=np.int64)
+    a_cleared = np.zeros(combos, dtype=np.int64); a_max_time = np.zeros(combos, dtype=np.int64)
+    capacity = args.saturation * args.dt
+    states_trace = np.empty(steps, dtype=np.int64) if trace else None; results_trace = []
+
+    def enter(mask, new_state):
+        state[mask] = new_state[mask]; phase[mask] = 0
+        entering_a = mask & (state == A_GREEN)
+        cycles[entering_a] += 1
+        skip = entering_a & smart & ~present # Rule 1b: no vehicles seen on A, straight to yellow
+        state[skip] = A_YELLOW; a_skips[skip] += 1
+
+    enter(np.ones(combos, dtype=bool), np.full(combos, A_GREEN))
+    for k in range(steps):
+        due = phase >= durations[rows, state]
+        if due.any():
+            a_max_time[due & smart & (state == A_GREEN)] += 1 # Rule 2a
+            enter(due, (state + 1) % len(CYCLE))
+        arrived = pending & (result_at == k)
+        if arrived.any():
+            cleared = arrived & smart & (state == A_GREEN) & present & ~pending_value # Rule 2b
+            present[arrived] = pending_value[arrived]; pending[arrived] = False
+            if trace and arrived[0]: results_trace.append((k, bool(pending_value[0])))
+            a_cleared[cleared] += 1
+            enter(cleared, np.full(combos, A_YELLOW))
+        capture = smart & ~pending & (k >= next_capture) & ~np.isin(state, NO_ANALYSIS_STATES)
+        if capture.any():
+            pending_value[capture] = queue[capture, 0] >= 1.0; pending[capture] = True
+            result_at[capture] = k + latency
+            next_capture[capture] = k + np.maximum(interval[capture], latency) # One call in flight at a time
+        if trace: states_trace[k] = state[0]
+
+        queue += arrivals[k]
+        green = state[:, None] == GREEN_STATES[None, :]
+        discharged = np.where(green, np.minimum(queue, capacity), 0.0)
+        queue -= discharged; served += discharged; green_steps += green
+        np.maximum(max_queue, queue, out=max_queue)
+        delay += queue * args.dt # Vehicle-seconds spent waiting
+        phase += 1
+
+    arrived_total = arrivals.sum(axis=0)
+    metrics = {
+        "avgDelaySec": delay.sum(axis=1) / max(arrived_total.sum(), 1),
+        "delaySec": delay / np.maximum(arrived_total, 1),
+        "maxQueue": max_queue, "endQueue": queue, "served": served,
+        "greenShare": green_steps / steps, "cycles": cycles,
+        "aSkips": a_skips, "aClearedEarly": a_cleared, "aMaxTime": a_max_time,
+    }
+    return (metrics, states_trace, results_trace) if trace else metrics
+
+def check_against_controller(grid, index, arrivals, args):
+    """ Replays one combination through the real SignalController on a VirtualClock. Returns the share of matching steps. """
+    single = {key: values[index:index + 1] for key, values in grid.items()}
+    _, expected, results = simulate(single, arrivals, args, trace=True)
+    settings = {"greenLightDurationMs": single["green"][0] * 1000, "yellowLightDurationMs": single["yellow"][0] * 1000,
+                "maxTimeSmartA_Ms": single["maxA"][0] * 1000}
+    smart = bool(single["smart"][0])
+    clock = server.VirtualClock()
+    controller = server.SignalController(settings=settings, clock=clock, smart_mode=lambda: smart)
+    camera_id = server.get_camera().cam_id
+    results_by_step = dict(results)
+    matches = 0
+    for k in range(len(arrivals)):
+        clock.advance(k * args.dt - clock.now())
+        if k in results_by_step:
+            controller.on_analysis({"cameraId": camera_id, "status": 200, "result": {"Vehicles_Present": "True" if results_by_step[k] else "False"}})
+        else:
+            controller.tick()
+        matches += CYCLE.index(controller.state) == expected[k]
+    return matches / len(arrivals)
+
+
+# --- Runner ---
+def combination_report(grid, metrics, i):
+    entry = {"mode": "smart" if grid["smart"][i] else "timer", "greenSec": grid["green"][i], "yellowSec": grid["yellow"][i]}
+    if grid["smart"][i]: entry.update(maxTimeSmartASec=grid["maxA"][i], apiCallsPerMinute=grid["callsPerMinute"][i])
+    entry.update({
+        "avgDelaySec": round(float(metrics["avgDelaySec"][i]), 2),
+        "delaySec": {d: round(float(v), 2) for d, v in zip(DIRECTIONS, metrics["delaySec"][i])},
+        "maxQueue": {d: round(float(v), 1) for d, v in zip(DIRECTIONS, metrics["maxQueue"][i])},
+        "endQueue": {d: round(float(v), 1) for d, v in zip(DIRECTIONS, metrics["endQueue"][i])},
+        "greenShare": {d: round(float(v), 3) for d, v in zip(DIRECTIONS, metrics["greenShare"][i])},
+        "cycles": int(metrics["cycles"][i]), "aSkips": int(metrics["aSkips"][i]),
+        "aClearedEarly": int(metrics["aClearedEarly"][i]), "aMaxTime": int(metrics["aMaxTime"][i]),
+    })
+    return entry
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep signal timing settings over recorded or synthetic demand.")
+    parser.add_argument("--rates", default="A=4,B=2,C=2,D=2", help="Synthetic arrival rates in vehicles per minute per direction.")
+    parser.add_argument("--demand", help="CSV of arrival rates over time (t, A, B, C, D); overrides --rates where given.")
+    parser.add_argument("--duration", default=3600.0, type=float, help="Simulated seconds.")
+    parser.add_argument("--dt", default=0.25, type=float, help="Time step in seconds (durations are rounded to it).")
+    parser.add_argument("--seed", default=0, type=int, help="Seed for the Poisson arrivals (shared by all combinations).")
+    parser.add_argument("--green", default="2:20:1", help="greenLightDuration values in seconds (start:stop:step or a,b,c).")
+    parser.add_argument("--yellow", default="1,2,3", help="yellowLightDuration values in seconds.")
+    parser.add_argument("--max-a", default="5:60:5", help="maxTimeSmartA values in seconds.")
+    parser.add_argument("--calls-per-minute", default="6,12,30", help="apiCallsPerMinute values.")
+    parser.add_argument("--modes", default="smart,timer", help="smart and/or timer (timer = fixed cycle baseline).")
+    parser.add_argument("--analysis-latency", default=1.0, type=float, help="Seconds from frame capture to analysis result.")
+    parser.add_argument("--saturation", default=0.5, type=float, help="Vehicles per second discharged per direction while green.")
+    parser.add_argument("--top", default=10, type=int, help="Best combinations to print.")
+    parser.add_argument("--check", action="store_true", help="Cross-check the best combination against SignalController.")
+    parser.add_argument("--output", help="Write every combination's metrics to this JSON file.")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING) # SignalController logs every transition at INFO
+    try:
+        grid = build_grid(args)
+        steps = int(args.duration / args.dt)
+        arrivals = np.random.default_rng(args.seed).poisson(rate_schedule(args, steps) * args.dt).astype(float)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(str(e))
+
+    combos = len(grid["green"])
+    print(f"Simulating {combos} combinations x {args.duration:.0f}s ({steps} steps, {int(arrivals.sum())} vehicles)...", flush=True)
+    started = time.perf_counter()
+    metrics = simulate(grid, arrivals, args)
+    elapsed = time.perf_counter() - started
+    print(f"Done in {elapsed:.2f}s: {combos * args.duration / max(elapsed, 1e-9):,.0f} simulated seconds per second.")
+
+    order = np.lexsort((metrics["maxQueue"].max(axis=1), metrics["avgDelaySec"])) # Lowest delay, then smallest worst queue
+    print(f"\n{'mode':<6} {'green':>6} {'yellow':>6} {'maxA':>6} {'calls':>6} {'delay s':>8} {'delay A/B/C/D':>24} {'max queue A/B/C/D':>24} {'skips':>6}")
+    for i in order[:args.top]:
+        r = combination_report(grid, metrics, i)
+        print(f"{r['mode']:<6} {r['greenSec']:>6g} {r['yellowSec']:>6g} {r.get('maxTimeSmartASec', 0):>6g} {r.get('apiCallsPerMinute', 0):>6g} "
+              f"{r['avgDelaySec']:>8.2f} {'/'.join(f'{v:.1f}' for v in r['delaySec'].values()):>24} "
+              f"{'/'.join(f'{v:.0f}' for v in r['maxQueue'].values()):>24} {r['aSkips']:>6}")
+
+    best = combination_report(grid, metrics, order[0])
+    print(f"\nBest: POST /api/settings with greenLightDurationSec={best['greenSec']:g}, yellowLightDurationSec={best['yellowSec']:g}"
+          + (f", maxTimeSmartA_Sec={best['maxTimeSmartASec']:g}, apiCallsPerMinute={best['apiCallsPerMinute']:g}" if best["mode"] == "smart" else " (timer mode)"))
+    if args.check:
+        agreement = check_against_controller(grid, order[0], arrivals, args)
+        print(f"SignalController cross-check: {agreement:.2%} of steps in the same phase.")
+    if args.output:
+        report = {"args": vars(args), "vehicles": int(arrivals.sum()), "elapsedSec": round(elapsed, 3),
+                  "results": [combination_report(grid, metrics, i) for i in order]}
+        with open(args.output, "w") as f: json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,11 +8,17 @@
     const AI_HALO_RED_CLASS = 'ai-halo-effect--red'; // Keep for potential future use
     const AI_HALO_AMBER_CLASS = 'ai-halo-effect--amber';
     const LIVE_TIMER_UPDATE_INTERVAL_MS = 1000;
-    const TRAFFIC_LIGHT_ALL_RED_DELAY_MS = 1000;
+    const SIGNAL_POLL_INTERVAL_MS = 500; // Max delay between reads of the server-side signal controller
+    const SIGNAL_RETRY_DELAY_MS = 2000;
     const DEFAULT_API_CALLS_PER_MINUTE = 6; // Fallback if setting is invalid
     const DEFAULT_GREEN_LIGHT_DURATION_MS = 3000; // Fallback
     const DEFAULT_YELLOW_LIGHT_DURATION_MS = 1000; // Fallback
     const DEFAULT_MAX_TIME_SMART_A_MS = 10000; // Fallback (10 seconds)
+    const ANALYSIS_POLL_INTERVAL_MS = 1000; // How often to read the backend scheduler's latest result
+    const EVENTS_FALLBACK_POLL_INTERVAL_MS = 5000; // Signal/analysis polling while /api/events pushes the changes
+    const EVENTS_RECONNECT_DELAY_MS = 30000; // Retry after the server refused the event stream
+    // States in which Direction A is analyzed (the server skips A while it is being released)
+    const ANALYSIS_ALLOWED_STATES = ['D_GREEN', 'D_YELLOW', 'ALL_RED_BEFORE_A', 'A_GREEN', 'B_GREEN', 'B_YELLOW', 'ALL_RED_BEFORE_C', 'C_GREEN', 'C_YELLOW', 'ALL_RED_BEFORE_D'];
 
     // --- DOM Element References ---
     const cameraFeedImg = document.getElementById('cameraFeedImg');
@@ -76,18 +82,21 @@
         aiModelName: 'N/A'
     };
     let isSmartModeActive = false;
-    let trafficLightTimerId = null;
-    let currentTrafficLightState = null;
+    let currentTrafficLightState = null; // Rendered from the server-side signal controller (GET /api/signal)
     let latestVehiclesPresent = "False"; // Default to false
-    let smartAMaxTimerId = null; // Timer for max duration of A_GREEN in AI mode
     let isInitialized = false;
-    let lastGreenDirection = null; // Keep track of last green
-    let cycleStartTimes = { A: 0, B: 0, C: 0, D: 0 }; // Track when each direction went green
+    let signalSnapshot = null; // Last /api/signal response
+    let signalReceivedAt = 0; // performance.now() when it arrived, to run the live timer between polls
+    let signalPollTimeoutId = null;
+    let lastSignalEventSeq = 0; // Newest controller event already logged
     let lastDisplayedDurations = { A: null, B: null, C: null, D: null };
     let gemini_model = false; // Flag indicating if AI model is available
     let highlightDirection = null; // Which direction's group to highlight
     let liveTimerIntervalId = null; // Interval for updating displayed timer
     let lastAnalysisErrorTime = 0; // Track time of last analysis error for A_GREEN logic
+    let lastAnalysisSeq = 0; // analysisSeq of the last backend result processed
+    let eventSource = null; // /api/events stream (Server-Sent Events)
+    let eventsConnected = false;
     // ** References for one-time event listeners **
     let firstFrameLoadListener = null;
     let firstFrameErrorListener = null;
@@ -164,8 +173,6 @@
     function updateResultsDisplay(parsedData) {
         if (!isSmartModeActive) return; // Don't update if not in AI mode
 
-        const previousVehiclesPresent = latestVehiclesPresent; // Store previous state
-
         if (analysisDataDiv && resultsPlaceholder) {
             if (parsedData && typeof parsedData === 'object' && parsedData !== null) {
                 resultsPlaceholder.style.display = 'none';
@@ -180,14 +187,7 @@
                 busCountSpan.textContent = parsedData.Buses ?? 'N/A';
                 unknownCountSpan.textContent = parsedData.Unknown ?? 'N/A';
                 lastUpdateTimestamp.textContent = new Date().toLocaleString();
-
-                // --- Rule 2b: No Vehicles Detected while A is Green ---
-                // If vehicles disappeared while A was green, force cycle
-                if (currentTrafficLightState === 'A_GREEN' && latestVehiclesPresent === "False" && previousVehiclesPresent === "True") {
-                    console.log("Rule 2b: Vehicles cleared during A_GREEN. Forcing cycle.");
-                    addLogEntry("Vehicles cleared, cycling Direction A.", 'info');
-                    forceCycleFromA('NO_VEHICLES'); // Pass reason
-                }
+                // Rule 2b (vehicles cleared during A_GREEN) is applied by the server-side controller
             } else {
                 if (analysisDataDiv) analysisDataDiv.style.display = 'none';
                 if (resultsPlaceholder) {
@@ -206,7 +206,10 @@
          if (currentModeSpan) currentModeSpan.textContent = currentSettings.mode || 'Unknown';
          if (currentRateSpan) {
              const rate = currentSettings.apiCallsPerMinute || DEFAULT_API_CALLS_PER_MINUTE;
-             currentRateSpan.textContent = `${rate}/min`;
+             const governor = currentSettings.rateGovernor; // Backend backs off after quota errors and failures
+             if (governor && governor.breaker !== 'closed') currentRateSpan.textContent = `paused (${rate}/min)`;
+             else if (governor && governor.effectiveCallsPerMinute < rate) currentRateSpan.textContent = `${governor.effectiveCallsPerMinute}/${rate}/min (backed off)`;
+             else currentRateSpan.textContent = `${rate}/min`;
          }
      }
 
@@ -234,24 +237,6 @@
             }
         });
     }
-    function setLightState(direction, color) {
-        setAllLightsRed(); // Start by setting all red
-        const lights = lightElements[direction];
-        if (!lights) { console.error(`Invalid direction: ${direction}`); return; }
-
-        // If setting green or yellow, ensure red is off for that direction
-        if ((color === 'yellow' || color === 'green') && lights.red && lights.red.classList.contains('active')) {
-             lights.red.classList.remove('active');
-        }
-        // Activate the target color
-        const lightEl = lights[color];
-        if (lightEl) {
-             if (!lightEl.classList.contains('active')) lightEl.classList.add('active');
-        } else {
-             console.error(`Invalid color element '${color}' for ${direction}, defaulting to red.`);
-             if (lights.red && !lights.red.classList.contains('active')) lights.red.classList.add('active'); // Ensure red is on if color is invalid
-        }
-    }
     function updateActiveLightBorder(directionToHighlight) {
         const timerHighlightClass = TIMER_HIGHLIGHT_CLASS;
         const aiHighlightClass = AI_HIGHLIGHT_CLASS;
@@ -272,27 +257,6 @@
         });
     }
 
-    // --- MODIFIED: Renamed and simplified ---
-    function clearSmartATimers() {
-        if (smartAMaxTimerId) {
-            clearTimeout(smartAMaxTimerId);
-            smartAMaxTimerId = null;
-            console.log("Cleared Smart A Max Timer.");
-        }
-    }
-
-    // --- MODIFIED: Force cycle for A_GREEN (AI Mode) ---
-    function forceCycleFromA(reason = 'UNKNOWN') {
-        console.log(`Forcing cycle from A_GREEN (AI Mode). Reason: ${reason}`);
-        if (currentTrafficLightState === 'A_GREEN' && isSmartModeActive) {
-             clearSmartATimers(); // Clear any running max timer
-             advanceTrafficLights('A_YELLOW'); // Move immediately to yellow
-        } else {
-            console.log(`forceCycleFromA ignored (State: ${currentTrafficLightState}, Mode: ${isSmartModeActive ? 'AI' : 'Timer'}).`);
-        }
-    }
-    // --- REMOVED checkBaseTimeExpired - Logic integrated into analysis result and error handling ---
-
     function resetTimerLabel(direction) {
         if (timerElements[direction]) {
              timerElements[direction].textContent = '0 Sec';
@@ -301,7 +265,6 @@
     }
     function resetAllTimerLabels() {
         trafficDirections.forEach(dir => resetTimerLabel(dir));
-        cycleStartTimes = { A: 0, B: 0, C: 0, D: 0 };
     }
     function updateTimerLabel(direction, durationMs) {
         if (!timerElements[direction] || durationMs < 0) return;
@@ -312,177 +275,80 @@
         }
     }
     function updateActiveTimerDisplay() {
-        if (highlightDirection && cycleStartTimes[highlightDirection] > 0) {
-             const elapsedMs = Date.now() - cycleStartTimes[highlightDirection];
-             updateTimerLabel(highlightDirection, elapsedMs);
-        }
+        // Green (+ yellow) time of each direction: live for the running one, else its last completed duration
+        if (!signalSnapshot || !signalSnapshot.state) return;
+        const sinceSnapshotMs = performance.now() - signalReceivedAt;
+        trafficDirections.forEach(dir => {
+            const elapsedMs = signalSnapshot.greenElapsedMs?.[dir];
+            if (elapsedMs !== null && elapsedMs !== undefined) updateTimerLabel(dir, elapsedMs + sinceSnapshotMs);
+            else if (signalSnapshot.lastGreenMs?.[dir] !== null && signalSnapshot.lastGreenMs?.[dir] !== undefined) updateTimerLabel(dir, signalSnapshot.lastGreenMs[dir]);
+        });
     }
 
-    // --- Traffic Light State Machine ---
-    function advanceTrafficLights(newState) {
-        if (!isInitialized) { console.warn("advanceTrafficLights aborted: not initialized."); return; }
-        if (trafficLightTimerId) { clearTimeout(trafficLightTimerId); trafficLightTimerId = null; } // Clear previous timer
-
-        // Clear Smart A timers if leaving A_GREEN in AI mode
-        if (currentTrafficLightState === 'A_GREEN' && isSmartModeActive && newState !== 'A_GREEN') {
-            clearSmartATimers();
-        }
-
-        const now = Date.now();
-        let completedDirection = null; // Track which direction's timer label to finalize
-        if (newState === 'ALL_RED_BEFORE_B' && cycleStartTimes.A > 0) completedDirection = 'A';
-        else if (newState === 'ALL_RED_BEFORE_C' && cycleStartTimes.B > 0) completedDirection = 'B';
-        else if (newState === 'ALL_RED_BEFORE_D' && cycleStartTimes.C > 0) completedDirection = 'C';
-        else if (newState === 'ALL_RED_BEFORE_A' && cycleStartTimes.D > 0) completedDirection = 'D';
-
-        // Update the timer label for the direction that just finished its green/yellow cycle
-        if (completedDirection && cycleStartTimes[completedDirection]) {
-            const durationMs = now - cycleStartTimes[completedDirection];
-            updateTimerLabel(completedDirection, durationMs);
-            cycleStartTimes[completedDirection] = 0; // Reset start time
-        }
-
-        currentTrafficLightState = newState; // Update current state
-        let nextState = null;
-        let delay = 0;
-        // Get durations from settings, with fallbacks
-        let greenDuration = currentSettings.greenLightDurationMs || DEFAULT_GREEN_LIGHT_DURATION_MS;
-        let yellowDuration = currentSettings.yellowLightDurationMs || DEFAULT_YELLOW_LIGHT_DURATION_MS;
-        let maxTimeSmartA = currentSettings.maxTimeSmartA_Ms || DEFAULT_MAX_TIME_SMART_A_MS;
-
-        console.log(`Advancing to state: ${newState} (Mode: ${isSmartModeActive ? 'AI' : 'Timer'})`);
+    // --- Traffic Signal Rendering (state machine runs server-side in SignalController) ---
+    function renderLights(lights) {
+        trafficDirections.forEach(dir => {
+            const elements = lightElements[dir];
+            if (!elements) return;
+            const color = lights?.[dir] || 'red';
+            ['red', 'yellow', 'green'].forEach(c => { if (elements[c]) elements[c].classList.toggle('active', c === color); });
+        });
+    }
+    function renderSignal(snapshot) {
+        const previousState = currentTrafficLightState;
+        signalSnapshot = snapshot; signalReceivedAt = performance.now();
+        currentTrafficLightState = snapshot.state;
+        if (!snapshot.state) { setAllLightsRed(); updateActiveLightBorder(null); highlightDirection = null; return; }
+
+        renderLights(snapshot.lights);
+        highlightDirection = snapshot.direction;
+        updateActiveLightBorder(highlightDirection);
+        updateActiveTimerDisplay();
 
-        try {
-            switch (newState) {
-                // --- Direction A Logic ---
-                case 'A_GREEN':
-                    resetTimerLabel('A'); // Reset display timer
-                    highlightDirection = 'A';
-                    cycleStartTimes.A = now; // Record start time for A
-                    if (isSmartModeActive) {
-                        // Analysis should have ideally run during D_GREEN. Check result now.
-                        if (latestVehiclesPresent !== "True") {
-                            console.log("Rule 1b: No vehicles detected on A. Skipping green, going to yellow.");
-                            addLogEntry("No vehicles detected on A, skipping green.", 'info');
-                            setLightState('A', 'yellow');
-                            delay = yellowDuration;
-                            nextState = 'ALL_RED_BEFORE_B';
-                        } else {
-                            console.log("Rule 1a: Vehicles detected on A. Turning green.");
-                            addLogEntry("Vehicles detected on A, turning green.", 'info');
-                            setLightState('A', 'green');
-                            clearSmartATimers();
-                            console.log(`Setting max timer for A_GREEN: ${maxTimeSmartA}ms`);
-                            smartAMaxTimerId = setTimeout(() => {
-                                console.log("Rule 2a: Max time expired for A_GREEN.");
-                                addLogEntry("Max time expired for Direction A.", 'info');
-                                forceCycleFromA('MAX_TIME');
-                            }, maxTimeSmartA);
-                            nextState = null; // Wait for analysis/timer
-                            delay = 0;
-                            // Ensure analysis resumes if it was paused
-                            scheduleNextAnalysis(false); // Resume analysis loop
-                        }
-                    } else {
-                        // Timer Mode
-                        setLightState('A', 'green');
-                        delay = greenDuration;
-                        nextState = 'A_YELLOW';
-                    }
-                    break;
-
-                case 'A_YELLOW':
-                    setLightState('A', 'yellow');
-                    highlightDirection = 'A';
-                    delay = yellowDuration;
-                    nextState = 'ALL_RED_BEFORE_B';
-                    clearSmartATimers(); // Ensure timers cleared
-                    // *** MODIFICATION: Stop analysis when A turns yellow ***
-                    if (isSmartModeActive) {
-                        console.log("State A_YELLOW: Cancelling analysis.");
-                        addLogEntry("Direction A yellow, pausing analysis.", 'info');
-                        cancelNextAnalysis();
-                    }
-                    break;
-
-                case 'ALL_RED_BEFORE_B':
-                    setAllLightsRed();
-                    highlightDirection = 'A';
-                    delay = TRAFFIC_LIGHT_ALL_RED_DELAY_MS;
-                    nextState = 'B_GREEN';
-                    // Analysis remains cancelled from A_YELLOW state
-                    break;
-
-                // --- Directions B, C ---
-                case 'B_GREEN': resetTimerLabel('B'); setLightState('B', 'green'); highlightDirection = 'B'; cycleStartTimes.B = now; delay = greenDuration; nextState = 'B_YELLOW'; break;
-                case 'B_YELLOW': setLightState('B', 'yellow'); highlightDirection = 'B'; delay = yellowDuration; nextState = 'ALL_RED_BEFORE_C'; break;
-                case 'ALL_RED_BEFORE_C': setAllLightsRed(); highlightDirection = 'B'; delay = TRAFFIC_LIGHT_ALL_RED_DELAY_MS; nextState = 'C_GREEN'; break;
-                case 'C_GREEN': resetTimerLabel('C'); setLightState('C', 'green'); highlightDirection = 'C'; cycleStartTimes.C = now; delay = greenDuration; nextState = 'C_YELLOW'; break;
-                case 'C_YELLOW': setLightState('C', 'yellow'); highlightDirection = 'C'; delay = yellowDuration; nextState = 'ALL_RED_BEFORE_D'; break;
-                case 'ALL_RED_BEFORE_D': setAllLightsRed(); highlightDirection = 'C'; delay = TRAFFIC_LIGHT_ALL_RED_DELAY_MS; nextState = 'D_GREEN'; break;
-
-                // --- Direction D ---
-                case 'D_GREEN':
-                    resetTimerLabel('D');
-                    setLightState('D', 'green');
-                    highlightDirection = 'D';
-                    cycleStartTimes.D = now;
-                    delay = greenDuration;
-                    nextState = 'D_YELLOW';
-                    // *** MODIFICATION: Start analysis when D turns green ***
-                    if (isSmartModeActive) {
-                        console.log("State D_GREEN: Scheduling analysis restart.");
-                        addLogEntry("Direction D green, resuming analysis.", 'info');
-                        scheduleNextAnalysis(false); // Restart analysis loop
-                    }
-                    break;
-                case 'D_YELLOW': setLightState('D', 'yellow'); highlightDirection = 'D'; delay = yellowDuration; nextState = 'ALL_RED_BEFORE_A'; break;
-                case 'ALL_RED_BEFORE_A': setAllLightsRed(); highlightDirection = 'D'; delay = TRAFFIC_LIGHT_ALL_RED_DELAY_MS; nextState = 'A_GREEN'; break;
-
-                default:
-                    console.error(`Invalid state encountered: ${newState}. Resetting to all red.`);
-                    setAllLightsRed();
-                    highlightDirection = null;
-                    resetAllTimerLabels();
-                    clearSmartATimers();
-                     // Ensure analysis is cancelled in error state
-                    if (isSmartModeActive) cancelNextAnalysis();
-                    return;
-            }
-        } catch (error) {
-            console.error(`Error during state switch logic for ${newState}:`, error);
-            setAllLightsRed(); highlightDirection = null; clearSmartATimers();
-            // Ensure analysis is cancelled in error state
-            if (isSmartModeActive) cancelNextAnalysis();
-            return;
-        }
+        // Log the controller's non-routine decisions (skips, early ends) in AI mode
+        (snapshot.events || []).forEach(event => {
+            if (event.seq > lastSignalEventSeq && event.reason !== 'timer' && isSmartModeActive) addLogEntry(`Signal ${event.state}: ${event.reason}.`, 'info');
+        });
+        if (snapshot.events?.length) lastSignalEventSeq = Math.max(lastSignalEventSeq, ...snapshot.events.map(e => e.seq));
 
-        // Update visual cues (border, halo) - Logic from previous correction
+        // Halo on Direction A while AI controls it
         const lightGroupA = lightGroupElements.A;
         if (lightGroupA) {
              lightGroupA.classList.remove(AI_HALO_GREEN_CLASS, AI_HALO_AMBER_CLASS);
              if (isSmartModeActive) {
-                 const isControlConsideredA = (newState === 'A_GREEN' || newState === 'A_YELLOW' || newState === 'ALL_RED_BEFORE_B');
-                 if (newState === 'A_GREEN') {
-                     lightGroupA.classList.add(AI_HALO_GREEN_CLASS);
-                 } else if (!isControlConsideredA) {
-                     lightGroupA.classList.add(AI_HALO_AMBER_CLASS);
-                 }
+                 const isControlConsideredA = ['A_GREEN', 'A_YELLOW', 'ALL_RED_BEFORE_B'].includes(snapshot.state);
+                 if (snapshot.state === 'A_GREEN') lightGroupA.classList.add(AI_HALO_GREEN_CLASS);
+                 else if (!isControlConsideredA) lightGroupA.classList.add(AI_HALO_AMBER_CLASS);
              }
-        } else { console.warn("Light group element A not found for halo update."); }
-        updateActiveLightBorder(highlightDirection);
+        }
 
-        // Schedule the next state transition if needed
-        if (nextState && delay > 0) {
-            trafficLightTimerId = setTimeout(() => {
-                if (currentTrafficLightState === newState) {
-                    advanceTrafficLights(nextState);
-                } else {
-                    console.log(`Skipping scheduled transition from ${newState} to ${nextState}. Current state is now ${currentTrafficLightState}.`);
-                }
-            }, delay);
+        // Show analysis results while Direction A is being analyzed; pause while it is released
+        if (snapshot.state !== previousState && isSmartModeActive) {
+            if (ANALYSIS_ALLOWED_STATES.includes(snapshot.state)) {
+                if (!analysisTimeoutId && !isAnalysisInProgress) scheduleNextAnalysis(false);
+            } else if (previousState && ANALYSIS_ALLOWED_STATES.includes(previousState)) {
+                addLogEntry("Direction A released, pausing analysis.", 'info');
+                cancelNextAnalysis();
+            }
         }
-    } // --- End advanceTrafficLights ---
+    }
+    async function pollSignal() {
+        if (signalPollTimeoutId) { clearTimeout(signalPollTimeoutId); signalPollTimeoutId = null; }
+        let delayMs = eventsConnected ? EVENTS_FALLBACK_POLL_INTERVAL_MS : SIGNAL_POLL_INTERVAL_MS;
+        try {
+            const response = await fetch('/api/signal');
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            const snapshot = await response.json();
+            renderSignal(snapshot);
+            // Poll right after the phase is due to end (the server keeps the exact timing); phase changes are pushed when connected
+            if (snapshot.state && !eventsConnected) delayMs = Math.min(SIGNAL_POLL_INTERVAL_MS, Math.max(100, snapshot.phaseRemainingMs + 50));
+        } catch (error) {
+            console.error("Error reading signal state:", error);
+            delayMs = SIGNAL_RETRY_DELAY_MS;
+        } finally {
+            signalPollTimeoutId = setTimeout(pollSignal, delayMs);
+        }
+    }
 
 
     // --- Camera Feed Handling ---
@@ -506,18 +372,7 @@
              displayError(cameraError, 'Error loading video stream from server.');
              cameraFeedImg.style.display = 'none';
              updateStatus('Video Error');
-             if (isSmartModeActive && currentTrafficLightState === 'A_GREEN') {
-                 console.warn("Video error occurred during A_GREEN. Checking standard green time...");
-                 const elapsedGreenTime = Date.now() - (cycleStartTimes.A || Date.now());
-                 if (elapsedGreenTime >= (currentSettings.greenLightDurationMs || DEFAULT_GREEN_LIGHT_DURATION_MS)) {
-                    console.log("Rule 2c (Video Error): Standard green time met. Forcing cycle.");
-                    addLogEntry("Video Error during A_GREEN (standard time met), forcing cycle.", "error");
-                    forceCycleFromA('VIDEO_ERROR_TIMEOUT');
-                 } else {
-                    console.log("Rule 2c (Video Error): Standard green time not met. Allowing max timer to proceed.");
-                    addLogEntry("Video Error during A_GREEN (standard time not met).", "error");
-                 }
-             }
+             // A lost camera reaches the server-side controller as analysis errors (Rule 2c)
          };
          cameraFeedImg.onload = function() {
              console.log("Camera feed image loaded successfully.");
@@ -534,8 +389,7 @@
     async function triggerAnalysis() {
         // Prevent analysis if not in AI mode, AI model not ready, already in progress, or offline
         // Also check if current state allows analysis (i.e., not paused during A_YELLOW/A_RED)
-        const analysisAllowedStates = ['D_GREEN', 'D_YELLOW', 'ALL_RED_BEFORE_A', 'A_GREEN', 'B_GREEN', 'B_YELLOW', 'ALL_RED_BEFORE_C', 'C_GREEN', 'C_YELLOW', 'ALL_RED_BEFORE_D'];
-        if (!isSmartModeActive || !gemini_model || isAnalysisInProgress || !navigator.onLine || !analysisAllowedStates.includes(currentTrafficLightState)) {
+        if (!isSmartModeActive || !gemini_model || isAnalysisInProgress || !navigator.onLine || !ANALYSIS_ALLOWED_STATES.includes(currentTrafficLightState)) {
              if (!isSmartModeActive) console.log("Analysis trigger skipped: AI mode not active.");
              if (!gemini_model) console.log("Analysis trigger skipped: AI model not ready.");
              if (isAnalysisInProgress) console.warn("Analysis trigger skipped: Previous analysis still in progress.");
@@ -548,7 +402,7 @@
                  // Rule 2c check for Offline during A_GREEN remains relevant
                  if (currentTrafficLightState === 'A_GREEN') { /* ... (existing offline check) ... */ }
              }
-              if (!analysisAllowedStates.includes(currentTrafficLightState)) {
+              if (!ANALYSIS_ALLOWED_STATES.includes(currentTrafficLightState)) {
                  console.log(`Analysis trigger skipped: Current state (${currentTrafficLightState}) does not allow analysis.`);
                  // Don't reschedule automatically here, scheduleNextAnalysis is called from D_GREEN
              }
@@ -556,13 +410,12 @@
              return;
         }
 
-        // --- Start Analysis ---
+        // --- Read the backend scheduler's latest result ---
+        // Analysis itself runs server-side (one scheduler for all tabs); we only pick up new results.
         isAnalysisInProgress = true;
-        showSpinner(analysisSpinner);
-        console.log(`Triggering analysis (State: ${currentTrafficLightState})...`);
-        addLogEntry("Calling LLM API...", 'info');
+        console.log(`Polling latest analysis (State: ${currentTrafficLightState})...`);
 
-        let startTime = performance.now();
+        let serverDurationMs = null;
         let rawResponseText = null;
         let responseJson = null;
         let parsedData = null;
@@ -572,10 +425,16 @@
         let statusToSetOnError = 'Analysis Error';
 
         try {
-            const response = await fetch('/api/analyze', { method: 'POST' });
+            const latestResponse = await fetch(`/api/analysis/latest?since=${lastAnalysisSeq}`);
+            if (latestResponse.status === 204) { return; } // Nothing new; finally{} schedules the next poll
+            if (!latestResponse.ok) throw new Error(`HTTP error! status: ${latestResponse.status}`);
+            const latest = await latestResponse.json();
+            lastAnalysisSeq = latest.analysisSeq;
+            serverDurationMs = latest.durationMs;
+            const response = { status: latest.status, ok: latest.status >= 200 && latest.status < 300, statusText: `HTTP ${latest.status}` };
             responseOk = response.ok;
-            rawResponseText = await response.text();
-            try { responseJson = JSON.parse(rawResponseText); } catch (e) { responseJson = null; }
+            responseJson = latest.result;
+            rawResponseText = JSON.stringify(latest.result);
 
             const loggableResponseText = responseJson?.raw_response || rawResponseText || '(Empty Response Body)';
             const formattedLogText = formatJsonLog(loggableResponseText);
@@ -659,31 +518,16 @@
             statusToSetOnError = "Network Error";
             updateStatus(statusToSetOnError);
         } finally {
-            hideSpinner(analysisSpinner);
-            const elapsedTime = performance.now() - startTime;
-            if (llmApiDuration) llmApiDuration.textContent = `${(elapsedTime / 1000).toFixed(3)} Sec`;
-
-            // --- Rule 2c: API/Logical Errors during A_GREEN ---
-            if (apiErrorOccurred && currentTrafficLightState === 'A_GREEN' && isSmartModeActive) {
-                 const elapsedGreenTime = Date.now() - (cycleStartTimes.A || Date.now());
-                 const standardGreenTime = currentSettings.greenLightDurationMs || DEFAULT_GREEN_LIGHT_DURATION_MS;
-                 if (elapsedGreenTime >= standardGreenTime) {
-                     console.log(`Rule 2c (API Error - ${statusToSetOnError}): Standard green time met (${elapsedGreenTime}ms >= ${standardGreenTime}ms). Forcing cycle.`);
-                     addLogEntry(`API Error during A_GREEN (standard time met), forcing cycle.`, "error");
-                     forceCycleFromA('API_ERROR_TIMEOUT');
-                 } else {
-                     console.log(`Rule 2c (API Error - ${statusToSetOnError}): Standard green time not met (${elapsedGreenTime}ms < ${standardGreenTime}ms). Allowing max timer.`);
-                     addLogEntry(`API Error during A_GREEN (standard time not met).`, "error");
-                 }
-            }
+            if (llmApiDuration && serverDurationMs !== null) llmApiDuration.textContent = `${(serverDurationMs / 1000).toFixed(3)} Sec`;
 
+            // Rule 2c (errors during A_GREEN) is applied by the server-side controller
             isAnalysisInProgress = false; // Mark as finished *before* scheduling next
 
-            // Schedule next analysis ONLY if AI mode is active AND no critical error occurred (like camera stopping)
-            // The scheduling itself will be triggered again from D_GREEN state by advanceTrafficLights
-            // We only need to schedule the *next* immediate call if analysis is allowed in the current state
-            if (isSmartModeActive && !apiErrorOccurred && analysisAllowedStates.includes(currentTrafficLightState)) {
-                 scheduleNextAnalysis(false, apiErrorOccurred); // Schedule next regular call (force delay on error)
+            // Keep polling while AI mode is active and the current state allows analysis.
+            // Errors are one-off results from the backend scheduler, so they do not stop the poll loop
+            // (except a stopped camera). Polling resumes from D_GREEN via renderSignal.
+            if (isSmartModeActive && statusToSetOnError !== 'Camera Stopped' && ANALYSIS_ALLOWED_STATES.includes(currentTrafficLightState)) {
+                 scheduleNextAnalysis(false, true); // Next poll after ANALYSIS_POLL_INTERVAL_MS
             } else if (apiErrorOccurred) {
                  console.log(`Not scheduling next analysis due to error (${statusToSetOnError}) or disallowed state.`);
             } else {
@@ -702,15 +546,14 @@
         removeFirstFrameListeners(); // Ensure listeners are removed before scheduling
 
         // Double check conditions before scheduling the timeout
-        const analysisAllowedStates = ['D_GREEN', 'D_YELLOW', 'ALL_RED_BEFORE_A', 'A_GREEN', 'B_GREEN', 'B_YELLOW', 'ALL_RED_BEFORE_C', 'C_GREEN', 'C_YELLOW', 'ALL_RED_BEFORE_D'];
-        if (!isSmartModeActive || !analysisAllowedStates.includes(currentTrafficLightState)) {
+        if (!isSmartModeActive || !ANALYSIS_ALLOWED_STATES.includes(currentTrafficLightState)) {
             console.log(`Not scheduling analysis: AI mode off or current state (${currentTrafficLightState}) prevents it.`);
             isAnalysisInProgress = false; return;
         }
         isAnalysisInProgress = false; // Ensure flag is reset
 
-        const callsPerMinute = currentSettings.apiCallsPerMinute > 0 ? currentSettings.apiCallsPerMinute : DEFAULT_API_CALLS_PER_MINUTE;
-        const minDelayMs = Math.max(500, 60000 / callsPerMinute); // Ensure minimum 0.5s delay
+        // The backend scheduler enforces apiCallsPerMinute; the browser only polls for new results (pushed when connected)
+        const minDelayMs = eventsConnected ? EVENTS_FALLBACK_POLL_INTERVAL_MS : ANALYSIS_POLL_INTERVAL_MS;
 
         // Startup check is usually only needed once when AI mode starts
         if (useStartupCheck && cameraFeedImg) {
@@ -726,7 +569,7 @@
                     addLogEntry("First frame received.", 'info');
                     removeFirstFrameListeners();
                     // Check state again *after* frame loads, before scheduling
-                     if (isSmartModeActive && analysisAllowedStates.includes(currentTrafficLightState)) {
+                     if (isSmartModeActive && ANALYSIS_ALLOWED_STATES.includes(currentTrafficLightState)) {
                         analysisTimeoutId = setTimeout(triggerAnalysis, 0);
                      } else {
                          console.log("State changed or AI mode off after first frame loaded, not scheduling analysis.");
@@ -737,7 +580,7 @@
                     addLogEntry("Error loading camera stream.", 'error');
                     removeFirstFrameListeners();
                     // Schedule a delayed attempt even on error, but check state again
-                    if (isSmartModeActive && analysisAllowedStates.includes(currentTrafficLightState)) {
+                    if (isSmartModeActive && ANALYSIS_ALLOWED_STATES.includes(currentTrafficLightState)) {
                          console.log(`Scheduling fallback analysis trigger in ${minDelayMs}ms due to frame load error.`);
                          analysisTimeoutId = setTimeout(triggerAnalysis, minDelayMs);
                     } else {
@@ -795,12 +638,10 @@
                 } else {
                     console.log("AI Backend available. Preparing for analysis."); updateStatus('AI Mode Active');
                     addLogEntry("AI Backend ready.", 'info');
-                    // Analysis will be started by advanceTrafficLights when state allows (e.g., D_GREEN)
+                    // Analysis display starts from renderSignal when the state allows (e.g., D_GREEN)
                 }
-                // Start/Restart light cycle in the new mode
-                console.log("Restarting/Syncing traffic light cycle in AI mode.");
-                 // Start cycle; analysis scheduling is handled within advanceTrafficLights
-                advanceTrafficLights(currentTrafficLightState || 'A_GREEN');
+                // The server-side controller follows the camera into smart mode; re-read it now
+                currentTrafficLightState = null; pollSignal();
 
                 if(analysisStatus && !analysisStatus.textContent.includes('Failed') && !analysisStatus.textContent.includes('Error')) { hideSpinner(analysisSpinner); }
 
@@ -810,9 +651,8 @@
                  addLogEntry(`ERROR starting AI Mode: ${error.message}`, 'error');
                  isSmartModeActive = false; syncToggleState(); // Revert toggle state
                  if (lightGroupA) { lightGroupA.classList.remove(AI_HALO_GREEN_CLASS, AI_HALO_RED_CLASS, AI_HALO_AMBER_CLASS); }
-                 resetAllTimerLabels(); cancelNextAnalysis(); hideSpinner(analysisSpinner); clearSmartATimers();
-                 console.log("Fallback: Restarting traffic light cycle in Timer mode after AI failure.");
-                 advanceTrafficLights(currentTrafficLightState || 'A_GREEN'); // Resume or start at A in Timer mode
+                 resetAllTimerLabels(); cancelNextAnalysis(); hideSpinner(analysisSpinner);
+                 pollSignal(); // Controller stays in Timer mode
             }
         } else {
              // --- Turn OFF AI Mode ---
@@ -820,7 +660,6 @@
              resetAllTimerLabels(); // Reset display timers
              if (lightGroupA) { lightGroupA.classList.remove(AI_HALO_GREEN_CLASS, AI_HALO_RED_CLASS, AI_HALO_AMBER_CLASS); } // Remove halo
              cancelNextAnalysis(); // Stop pending analysis calls
-             clearSmartATimers(); // Clear AI-specific timers
              hideSpinner(analysisSpinner);
              updateStatus('Stopping Camera...');
              addLogEntry("AI Mode deactivated. Stopping camera...", 'info');
@@ -833,12 +672,40 @@
              finally {
                   updateStatus('Timer Mode Active');
                   refreshVideoStream(); // Refresh feed (should show placeholder)
-                  console.log("Restarting/Syncing traffic light cycle in Timer mode.");
-                  advanceTrafficLights(currentTrafficLightState || 'A_GREEN'); // Resume or start at A in Timer mode
+                  pollSignal(); // Controller is back in Timer mode
              }
         }
     }
 
+    // --- Server Events (/api/events) ---
+    // Signal phases, analysis results, camera, settings and AI backend changes are pushed by the server, so this
+    // tab follows what other tabs (or the server) change. Polling continues at a slow rate as a fallback;
+    // EventSource reconnects by itself and the server replays what was missed (Last-Event-ID).
+    function connectEvents() {
+        if (!window.EventSource || eventSource) return;
+        eventSource = new EventSource('/api/events');
+        eventSource.onopen = () => { eventsConnected = true; console.log("Event stream connected."); };
+        eventSource.onerror = () => {
+            eventsConnected = false; // The browser retries on its own, unless the server refused the stream (503: too many clients)
+            if (eventSource.readyState === EventSource.CLOSED) { eventSource.close(); eventSource = null; setTimeout(connectEvents, EVENTS_RECONNECT_DELAY_MS); }
+        };
+        const on = (type, handler) => eventSource.addEventListener(type, event => {
+            try { handler(JSON.parse(event.data)); } catch (error) { console.error(`Error handling '${type}' event:`, error); }
+        });
+        const isDefaultCamera = camId => camId === currentSettings.defaultCameraId;
+        on('signal', snapshot => renderSignal(snapshot));
+        on('analysis', record => {
+            if (!isDefaultCamera(record.cameraId) || record.analysisSeq <= lastAnalysisSeq || isAnalysisInProgress) return;
+            if (isSmartModeActive && ANALYSIS_ALLOWED_STATES.includes(currentTrafficLightState)) { cancelNextAnalysis(); triggerAnalysis(); }
+        });
+        on('camera', status => { if (isDefaultCamera(status.id) && status.isRunning !== isSmartModeActive) loadInitialSettingsAndSync(false); }); // Started/stopped elsewhere
+        on('settings', data => { if (data.version !== currentSettings.version) loadInitialSettingsAndSync(false); });
+        on('ai', () => loadInitialSettingsAndSync(false));
+        on('governor', status => { currentSettings.rateGovernor = status; updateFooterInfo(); });
+        on('quota', data => { if (!isSmartModeActive) displayProcessError(`API quota exceeded (camera ${data.cameraId}).`); }); // AI mode shows it with the result
+        on('resync', () => { loadInitialSettingsAndSync(false); pollSignal(); });
+    }
+
     // --- Initialization ---
     async function loadInitialSettingsAndSync(startLights = true) {
         console.log("Loading initial settings...");
@@ -875,7 +742,7 @@
              } else if (isSmartModeActive) {
                  console.log("Starting in AI Mode (Camera Running)."); updateStatus('AI Mode Active');
                  addLogEntry("Initialized in AI Mode. Camera running.", "info");
-                 // Analysis scheduling is now handled by advanceTrafficLights
+                 // Analysis display is scheduled by renderSignal
              } else {
                  console.log("Starting in Timer Mode (Camera Stopped)."); updateStatus('Timer Mode Active');
                  addLogEntry("Initialized in Timer Mode. Camera stopped.", "info");
@@ -883,9 +750,9 @@
 
              refreshVideoStream(); // Refresh feed
 
-             if (startLights && !currentTrafficLightState) {
-                 console.log("Starting initial traffic light cycle after settings load.");
-                 advanceTrafficLights('A_GREEN'); // Start the cycle
+             if (startLights && !signalPollTimeoutId) {
+                 console.log("Following the server-side signal controller after settings load.");
+                 pollSignal(); // Render the intersection (the cycle itself runs on the server)
              }
 
         } catch (error) {
@@ -900,9 +767,9 @@
             currentSettings.maxTimeSmartA_Ms = DEFAULT_MAX_TIME_SMART_A_MS;
             updateFooterInfo(); syncToggleState(); updateStatus("Settings Error");
             if (lightGroupA) lightGroupA.classList.remove(AI_HALO_GREEN_CLASS, AI_HALO_RED_CLASS, AI_HALO_AMBER_CLASS);
-            if (startLights && !currentTrafficLightState) {
-                console.log("Starting initial traffic light cycle in fallback Timer Mode (Settings Error).");
-                advanceTrafficLights('A_GREEN'); // Start cycle even with settings error
+            if (startLights && !signalPollTimeoutId) {
+                console.log("Following the signal controller despite the settings error.");
+                pollSignal(); // Render lights even with settings error
             }
         } finally {
              hideSpinner(analysisSpinner);
@@ -937,13 +804,13 @@
          liveTimerIntervalId = setInterval(updateActiveTimerDisplay, LIVE_TIMER_UPDATE_INTERVAL_MS); // Start live timer updates
          console.log("Live timer update interval started.");
 
-         loadInitialSettingsAndSync(true).catch(initError => { // Load settings and start lights
+         loadInitialSettingsAndSync(true).then(connectEvents).catch(initError => { // Load settings and start lights
              console.error("Initialization failed during async settings load:", initError);
              updateStatus("Initialization Failed (Async Error)"); addLogEntry(`Initialization failed: ${initError.message}`, "error");
              hideSpinner(analysisSpinner);
-             if (!currentTrafficLightState) {
-                  console.log("Attempting fallback light cycle start after init error.");
-                  advanceTrafficLights('A_GREEN'); // Attempt to start lights even if settings fail
+             if (!signalPollTimeoutId) {
+                  console.log("Following the signal controller after init error.");
+                  pollSignal(); // Render lights even if settings fail
              }
          });
     }
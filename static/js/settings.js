@@ -27,6 +27,7 @@
     let currentSettings = {}; // Cache for loaded settings
     let isDragging = false;   // Flag for mouse dragging state
     let dragStartX, dragStartY; // Mouse position when drag starts
+    let isSaving = false; // Our own save is in flight (its settings event is not "changed elsewhere")
     // Note: IS_CAMERA_RUNNING is a global const defined in the HTML <script> tag
 
     // --- Utility Functions ---
@@ -157,6 +158,7 @@
         // *** END: Validate new field ***
         // --- End Validation ---
 
+        isSaving = true;
         try {
             const response = await fetch('/api/settings', {
                 method: 'POST',
@@ -177,17 +179,31 @@
                 greenLightDurationMs: settingsToSave.greenLightDurationSec * 1000,
                 yellowLightDurationMs: settingsToSave.yellowLightDurationSec * 1000,
                 // *** START: Update cache with new field (in ms) ***
-                maxTimeSmartA_Ms: settingsToSave.maxTimeSmartA_Sec * 1000
+                maxTimeSmartA_Ms: settingsToSave.maxTimeSmartA_Sec * 1000,
                 // *** END: Update cache with new field (in ms) ***
+                version: result.version
             }
             displayStatus('Settings saved. Changes will apply on next analysis cycle or traffic light cycle.', false); // Modified message slightly
 
         } catch (error) {
             console.error('Failed to save settings:', error);
             displayStatus(`Failed to save settings: ${error.message}`, true);
+        } finally {
+            isSaving = false;
         }
     }
 
+    // --- Changes From Other Tabs (/api/events) ---
+    function followSettingsEvents() {
+        if (!window.EventSource) return;
+        const events = new EventSource('/api/events');
+        events.addEventListener('settings', event => {
+            const data = JSON.parse(event.data);
+            if (isSaving || data.version <= (currentSettings.version ?? 0)) return;
+            loadSettings().then(() => displayStatus(`Settings were changed elsewhere (version ${data.version}); the form has been reloaded.`));
+        });
+    }
+
     // --- Cropping UI Logic ---
     function updateCropOverlayVisuals() { if (!IS_CAMERA_RUNNING || !settingsFeedImg || !cropOverlay || !settingsFeedImg.complete || settingsFeedImg.naturalWidth === 0) { if (cropOverlay) cropOverlay.style.display = 'none'; return; } if (cropOverlay) cropOverlay.style.display = 'block'; try { const imgRect = settingsFeedImg.getBoundingClientRect(); const containerRect = cropContainer.getBoundingClientRect(); if (imgRect.width === 0 || imgRect.height === 0 || containerRect.width === 0 || containerRect.height === 0) { if (cropOverlay) cropOverlay.style.display = 'none'; console.warn("Cannot update overlay, image or container has zero dimensions."); return; } const relX = parseFloat(cropXInput.value); const relY = parseFloat(cropYInput.value); const relW = parseFloat(cropWInput.value); const relH = parseFloat(cropHInput.value); if (isNaN(relX) || isNaN(relY) || isNaN(relW) || isNaN(relH) || relW <= 0 || relH <= 0) { console.warn("Invalid relative crop values, hiding overlay."); if (cropOverlay) cropOverlay.style.display = 'none'; return; } const pixelX = relX * imgRect.width; const pixelY = relY * imgRect.height; const pixelW = relW * imgRect.width; const pixelH = relH * imgRect.height; const offsetX = imgRect.left - containerRect.left; const offsetY = imgRect.top - containerRect.top; cropOverlay.style.left = `${offsetX + pixelX}px`; cropOverlay.style.top = `${offsetY + pixelY}px`; cropOverlay.style.width = `${pixelW}px`; cropOverlay.style.height = `${pixelH}px`; } catch (e) { console.error("Error updating crop overlay visuals:", e); if (cropOverlay) cropOverlay.style.display = 'none'; } }
     function handleMouseDown(event) { if (!IS_CAMERA_RUNNING) { console.log("handleMouseDown ignored: Camera is stopped."); return; } event.preventDefault(); if (!cropContainer || !cropOverlay || !settingsFeedImg) { console.error("handleMouseDown: Missing essential cropping elements."); return; } if (!settingsFeedImg.complete || settingsFeedImg.naturalWidth === 0) { console.warn("handleMouseDown ignored: Image not fully loaded."); return; } console.log("handleMouseDown start"); isDragging = true; cropOverlay.style.cursor = 'grabbing'; const containerRect = cropContainer.getBoundingClientRect(); dragStartX = event.clientX - containerRect.left; dragStartY = event.clientY - containerRect.top; cropOverlay.style.left = `${dragStartX}px`; cropOverlay.style.top = `${dragStartY}px`; cropOverlay.style.width = '0px'; cropOverlay.style.height = '0px'; cropOverlay.style.display = 'block'; if (cropXInput) cropXInput.value = "0.0"; if (cropYInput) cropYInput.value = "0.0"; if (cropWInput) cropWInput.value = "0.0"; if (cropHInput) cropHInput.value = "0.0"; document.addEventListener('mousemove', handleMouseMove); document.addEventListener('mouseup', handleMouseUp); }
@@ -215,7 +231,7 @@
             return;
         }
 
-        loadSettings(); // Load settings first
+        loadSettings().then(followSettingsEvents); // Load settings first
 
         settingsForm.addEventListener('submit', saveSettings);
         // No longer need change listener for modeSelect related to frameRate
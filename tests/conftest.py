@@ -0,0 +1,12 @@
+import os
+import sys
+
+# Import app without credentials, devices or files: no AI backend, the default camera (never started),
+# no settings.json, analysis history or clip segments
+os.environ["AI_BACKEND"] = "NONE"
+os.environ["CAMERAS"] = ""
+os.environ["SETTINGS_PATH"] = ""
+os.environ["ANALYSIS_HISTORY_PATH"] = ""
+os.environ["CLIP_BUFFER_MB"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+""" EventBus replay and resync for clients resuming with Last-Event-ID. """
+import socket
+
+import app
+
+
+def make_bus(events, replay_size=500):
+    bus = app.EventBus(replay_size=replay_size)
+    for n in range(1, events + 1): bus.publish("signal", {"n": n})
+    return bus
+
+def event_id(bus, seq):
+    return f"{bus.epoch}-{seq}"
+
+def replayed_numbers(payloads):
+    return [int(payload.decode().rsplit('"n":', 1)[1].split("}")[0]) for payload in payloads]
+
+
+def test_without_an_id_nothing_is_replayed():
+    bus = make_bus(5)
+    assert bus.replay_since("") == ([], 5, False)
+
+def test_resuming_replays_only_the_missed_events():
+    bus = make_bus(5)
+    replay, newest, resync = bus.replay_since(event_id(bus, 2))
+    assert (replayed_numbers(replay), newest, resync) == ([3, 4, 5], 5, False)
+    assert bus.replay_since(event_id(bus, 5)) == ([], 5, False) # Up to date
+
+def test_an_id_just_before_the_replay_buffer_still_resumes():
+    bus = make_bus(10, replay_size=3) # Keeps 8, 9 and 10
+    replay, _, resync = bus.replay_since(event_id(bus, 7))
+    assert (replayed_numbers(replay), resync) == ([8, 9, 10], False)
+
+def test_an_id_older_than_the_replay_buffer_needs_resync():
+    bus = make_bus(10, replay_size=3)
+    assert bus.replay_since(event_id(bus, 6)) == ([], 10, True)
+    assert bus.replay_since(event_id(bus, 1)) == ([], 10, True)
+
+def test_ids_from_another_run_or_malformed_need_resync():
+    bus = make_bus(3)
+    assert bus.replay_since("0-2")[2] # Earlier server run
+    assert bus.replay_since(event_id(bus, 9))[2] # Newer than anything published
+    assert bus.replay_since("not-an-id")[2]
+
+def test_stream_sends_resync_then_live_events():
+    bus = make_bus(10, replay_size=3)
+    assert bus.start(upstream_port=None, host="127.0.0.1", port=0)
+    try:
+        with socket.create_connection(("127.0.0.1", bus.port), timeout=5) as client:
+            client.sendall(f"GET /api/events HTTP/1.1\r\nHost: test\r\nLast-Event-ID: {event_id(bus, 2)}\r\n\r\n".encode())
+            received = b""
+            while b"event: resync" not in received: received += client.recv(4096)
+            assert received.startswith(b"HTTP/1.1 200 OK\r\n") and b'"n":' not in received
+            bus.publish("signal", {"n": 11})
+            while b'"n":11' not in received: received += client.recv(4096)
+            assert f"id: {event_id(bus, 11)}\n".encode() in received
+    finally:
+        bus.stop()
@@ -0,0 +1,13 @@
+""" Prometheus text exposition of the in-process metrics. """
+import app
+
+
+def test_label_values_are_escaped():
+    counter = app.Counter("test_escaped_total", "Escaping test.", ["camera"])
+    counter.inc(camera='north "A"\\2\nline')
+    assert counter.samples() == ['test_escaped_total{camera="north \\"A\\"\\\\2\\nline"} 1']
+
+def test_histogram_buckets_keep_escaped_labels_and_le():
+    histogram = app.Histogram("test_escaped_seconds", "Escaping test.", ["reason"], buckets=(1.0,))
+    histogram.observe(0.5, reason='a"b')
+    assert 'test_escaped_seconds_bucket{reason="a\\"b",le="1"} 1' in histogram.samples()
@@ -0,0 +1,92 @@
+""" TokenBucket and RateGovernor (AIMD back-off, retry-after holds, circuit breaker), on a VirtualClock. """
+import app
+
+
+def make_governor(calls_per_minute=6):
+    clock = app.VirtualClock()
+    configured = {"rpm": calls_per_minute}
+    bucket = app.TokenBucket(calls_per_minute / 60.0, clock=clock)
+    governor = app.RateGovernor(bucket, configured=lambda: configured["rpm"])
+    return governor, clock, configured
+
+def fail(governor, times, outcome="error"):
+    for _ in range(times): governor.record(outcome)
+
+
+def test_token_bucket_refills_at_its_rate():
+    clock = app.VirtualClock()
+    bucket = app.TokenBucket(0.1, clock=clock)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 10.0
+    clock.advance(4.0)
+    assert round(bucket.try_acquire(), 6) == 6.0
+    clock.advance(6.0)
+    assert bucket.try_acquire() == 0.0
+
+def test_token_bucket_rate_change_keeps_the_tokens_earned_so_far():
+    clock = app.VirtualClock()
+    bucket = app.TokenBucket(0.1, clock=clock)
+    bucket.try_acquire(); clock.advance(5.0) # Half a token at the old rate
+    bucket.set_rate(1.0)
+    assert round(bucket.try_acquire(), 6) == 0.5
+
+def test_failures_back_off_multiplicatively_and_successes_recover_additively():
+    governor, clock, _ = make_governor(6)
+    governor.record("quota")
+    assert governor.effective_rpm == 6 * app.ANALYSIS_BACKOFF_FACTOR
+    governor.record("timeout")
+    backed_off = 6 * app.ANALYSIS_BACKOFF_FACTOR ** 2
+    assert governor.effective_rpm == backed_off
+    assert governor.bucket.rate_per_sec == backed_off / 60.0
+    governor.record("ok")
+    assert governor.effective_rpm == backed_off + app.ANALYSIS_RECOVERY_STEP
+    for _ in range(20): governor.record("ok")
+    assert governor.effective_rpm == 6 and governor.breaker == "closed"
+
+def test_back_off_stops_at_the_minimum_rate():
+    governor, clock, _ = make_governor(6)
+    fail(governor, 20)
+    assert governor.effective_rpm == app.ANALYSIS_MIN_CALLS_PER_MINUTE
+    assert governor.bucket.rate_per_sec == app.ANALYSIS_MIN_CALLS_PER_MINUTE / 60.0
+
+def test_quota_retry_after_holds_every_call():
+    governor, clock, _ = make_governor(60)
+    governor.record("quota", retry_after=12.0)
+    assert governor.try_acquire() == 12.0
+    clock.advance(12.0)
+    assert governor.try_acquire() == 0.0
+
+def test_breaker_opens_probes_and_closes():
+    governor, clock, _ = make_governor(60)
+    fail(governor, app.ANALYSIS_BREAKER_FAILURES - 1)
+    assert governor.breaker == "closed"
+    fail(governor, 1)
+    assert governor.breaker == "open"
+    assert governor.try_acquire() == app.ANALYSIS_BREAKER_COOLDOWN_SEC
+
+    clock.advance(app.ANALYSIS_BREAKER_COOLDOWN_SEC)
+    assert governor.try_acquire() == 0.0 # The single probe call
+    assert governor.breaker == "half_open"
+    assert governor.try_acquire() > 0.0 # No second call while the probe runs
+
+    governor.record("ok")
+    assert (governor.breaker, governor.failures, governor.cooldown) == ("closed", 0, app.ANALYSIS_BREAKER_COOLDOWN_SEC)
+
+def test_failed_probe_reopens_for_twice_as_long():
+    governor, clock, _ = make_governor(60)
+    fail(governor, app.ANALYSIS_BREAKER_FAILURES)
+    clock.advance(app.ANALYSIS_BREAKER_COOLDOWN_SEC)
+    assert governor.try_acquire() == 0.0
+    governor.record("quota")
+    assert governor.breaker == "open"
+    assert governor.try_acquire() == 2 * app.ANALYSIS_BREAKER_COOLDOWN_SEC
+    clock.advance(2 * app.ANALYSIS_BREAKER_COOLDOWN_SEC)
+    assert governor.try_acquire() == 0.0 and governor.breaker == "half_open"
+
+def test_configured_rate_caps_a_backed_off_rate_and_moves_a_recovered_one():
+    governor, clock, configured = make_governor(6)
+    configured["rpm"] = 12
+    assert governor.status()["effectiveCallsPerMinute"] == 12 # Fully recovered: follows the setting
+    governor.record("error")
+    configured["rpm"] = 4
+    assert governor.status()["effectiveCallsPerMinute"] == 4 # Backed off to 6, never above the new setting
@@ -0,0 +1,31 @@
+""" SettingsStore versions and the order subscribers see them in. """
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def test_concurrent_updates_reach_subscribers_in_version_order():
+    store = app.SettingsStore(path="")
+    seen = []
+    def slow_subscriber(old, new):
+        if new.version == 1: time.sleep(0.2) # The second update is applied meanwhile
+        seen.append((old.version, new.version))
+    store.subscribe(slow_subscriber)
+
+    first = threading.Thread(target=store.update, kwargs={"values": {"greenLightDurationMs": 4000}})
+    first.start(); time.sleep(0.05)
+    second = threading.Thread(target=store.update, kwargs={"values": {"greenLightDurationMs": 5000}})
+    second.start()
+    first.join(); second.join()
+
+    assert seen == [(0, 1), (1, 2)]
+    assert store.current.version == 2 and store.get("greenLightDurationMs") == 5000
+
+def test_stale_expected_version_is_refused():
+    store = app.SettingsStore(path="")
+    store.update(values={"greenLightDurationMs": 4000})
+    with pytest.raises(app.SettingsVersionConflict): store.update(values={"greenLightDurationMs": 5000}, expected_version=0)
+    assert store.current.version == 1
@@ -0,0 +1,90 @@
+""" SignalController phase transitions, stepped deterministically on a VirtualClock. """
+import app
+
+SETTINGS = {"greenLightDurationMs": 3000, "yellowLightDurationMs": 1000, "maxTimeSmartA_Ms": 10000}
+
+
+def make_controller(smart):
+    clock = app.VirtualClock()
+    controller = app.SignalController(settings=dict(SETTINGS), clock=clock, smart_mode=lambda: smart)
+    return controller, clock
+
+def result(present):
+    return {"cameraId": app.get_camera().cam_id, "status": 200, "result": {"Vehicles_Present": "True" if present else "False"}}
+
+def error_result(status=429):
+    return {"cameraId": app.get_camera().cam_id, "status": status, "result": {"quota_error": "Quota exceeded."}}
+
+def advance_to(controller, clock, state):
+    """ Jumps from deadline to deadline until `state` is entered. Returns the clock time it was entered at. """
+    for _ in range(len(app.SIGNAL_CYCLE) + 1):
+        if controller.state == state: return controller.phase_started
+        clock.advance(controller.tick() - clock.now()); controller.tick()
+    raise AssertionError(f"{state} not reached, stuck in {controller.state}")
+
+
+def test_timer_mode_runs_the_fixed_cycle_on_deadlines():
+    controller, clock = make_controller(smart=False)
+    controller.tick()
+    entered = [(controller.state, controller.phase_started)]
+    for _ in range(len(app.SIGNAL_CYCLE)):
+        clock.advance(controller.tick() - clock.now()); controller.tick()
+        entered.append((controller.state, controller.phase_started))
+    # Each direction: 3 s green, 1 s yellow, 1 s all-red; the cycle repeats after 20 s
+    assert entered[:4] == [("A_GREEN", 0.0), ("A_YELLOW", 3.0), ("ALL_RED_BEFORE_B", 4.0), ("B_GREEN", 5.0)]
+    assert entered[-1] == ("A_GREEN", 20.0)
+    assert controller.snapshot()["lastGreenMs"]["D"] == 4000
+
+def test_smart_mode_skips_a_green_without_vehicles():
+    controller, clock = make_controller(smart=True)
+    controller.tick()
+    assert controller.state == "A_YELLOW"
+    assert controller.reason == "no vehicles detected on A, skipping green"
+
+def test_smart_mode_holds_a_green_until_max_time():
+    controller, clock = make_controller(smart=True)
+    controller.tick()
+    advance_to(controller, clock, "B_GREEN")
+    controller.on_analysis(result(True))
+    started = advance_to(controller, clock, "A_GREEN")
+    clock.advance(started + 5.0 - clock.now()); controller.tick()
+    assert controller.state == "A_GREEN" # Past the standard 3 s green, vehicles still waiting
+    clock.advance(started + 10.0 - clock.now()); controller.tick()
+    assert (controller.state, controller.reason) == ("A_YELLOW", "max time expired for A")
+
+def test_smart_mode_releases_a_when_vehicles_clear():
+    controller, clock = make_controller(smart=True)
+    controller.tick()
+    advance_to(controller, clock, "B_GREEN")
+    controller.on_analysis(result(True))
+    started = advance_to(controller, clock, "A_GREEN")
+    clock.advance(1.5); controller.on_analysis(result(False))
+    assert (controller.state, controller.reason) == ("A_YELLOW", "vehicles cleared on A")
+    assert controller.phase_started == started + 1.5
+
+def test_error_result_keeps_the_last_vehicle_state():
+    controller, clock = make_controller(smart=True)
+    controller.tick()
+    advance_to(controller, clock, "B_GREEN")
+    controller.on_analysis(result(True))
+    started = advance_to(controller, clock, "A_GREEN")
+
+    # Within the standard green time an error changes nothing
+    clock.advance(1.0); controller.on_analysis(error_result())
+    assert controller.state == "A_GREEN" and controller.vehicles_present
+
+    # After it, an error releases A, but the last good result (vehicles present) is kept
+    clock.advance(started + 4.0 - clock.now()); controller.on_analysis(error_result(504))
+    assert controller.state == "A_YELLOW" and controller.reason.startswith("analysis error (HTTP 504)")
+    assert controller.vehicles_present
+
+    # So the next A_GREEN is served instead of skipped
+    advance_to(controller, clock, "D_GREEN")
+    advance_to(controller, clock, "A_GREEN")
+    assert controller.state == "A_GREEN" and controller.reason == "timer"
+
+def test_results_from_other_cameras_are_ignored():
+    controller, clock = make_controller(smart=True)
+    controller.tick()
+    controller.on_analysis({**result(True), "cameraId": "not-a-camera"})
+    assert not controller.vehicles_present